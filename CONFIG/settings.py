@@ -78,6 +78,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Upload workers write from several processes, so wait for the lock instead of failing at once
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -135,5 +137,93 @@ LOGOUT_REDIRECT_URL = 'login'
 
 
 CRONJOBS = [
-    ('*/15 * * * *', 'transcriber.crons.generate_text_last_audio', '>> /tmp/cron.log 2>&1'),
-]
\ No newline at end of file
+    ('*/15 * * * *', 'transcriber.crons.transcribe_pending_audios', '>> /tmp/cron.log 2>&1'),
+    ('* * * * *', 'django.core.management.call_command', ['process_uploads', '--once'], {}, '>> /tmp/uploads.log 2>&1'),
+    ('*/10 * * * *', 'django.core.management.call_command', ['evict_previews'], {}, '>> /tmp/previews.log 2>&1'),
+]
+
+
+# Upload queue (see transcriber/jobs.py and the process_uploads command)
+UPLOAD_WORKERS = os.cpu_count() or 2
+# Running jobs whose worker has not reported for this long are put back in the queue
+UPLOAD_HEARTBEAT_TIMEOUT = 10 * 60
+# Bytes the upload workers may use together for decoded audio, see utils.estimate_split_memory
+UPLOAD_MEMORY_LIMIT = 1024 * 1024 * 1024
+
+
+# Automatic transcription (see transcriber/transcription.py and the transcribe_audios command)
+TRANSCRIPTION = {
+    'BACKEND': 'transcriber.transcription.GeminiBackend',
+    'OPTIONS': {'model': 'gemini-2.5-pro'},
+    # Comma separated list in the GEMINI_API_KEYS environment variable
+    'API_KEYS': [key.strip() for key in os.environ.get('GEMINI_API_KEYS', '').split(',') if key.strip()],
+    # Requests in flight at the same time, over all keys
+    'CONCURRENCY': 4,
+    # Rate limit of each key, with short bursts of up to BURST requests
+    'REQUESTS_PER_MINUTE': 5,
+    'BURST': 1,
+    'MAX_RETRIES': 3,
+    'BACKOFF_SECONDS': 5,
+    # The transcribe button keeps the annotator waiting, so it gives up sooner
+    'INTERACTIVE_MAX_RETRIES': 1,
+    # Clips are sent as mono at this sample rate, as 'flac', 'opus' or 'wav'
+    'AUDIO_FORMAT': 'flac',
+    'SAMPLE_RATE': 16000,
+    # A clip stays reserved for the run that claimed it this long, and failed clips wait this long before a retry
+    'LEASE_SECONDS': 10 * 60,
+    # The cron job stops claiming new clips after this long, so runs do not pile up
+    'RUN_SECONDS': 14 * 60,
+}
+
+
+# Annotator work queue (see transcriber/annotations.py)
+ANNOTATION = {
+    # A clip handed to an annotator is held for them this long, and given to somebody else afterwards
+    'LEASE_SECONDS': 15 * 60,
+    # Clips the annotation page holds ahead, so the next one is there as soon as the current one is done
+    'PREFETCH': 3,
+}
+
+
+# Compressed copies of the clips for the players (see transcriber/previews.py)
+AUDIO_PREVIEWS = {
+    'DIR': os.path.join(BASE_DIR, 'previews'),
+    # Opus sample rate; 8000, 12000, 16000, 24000 or 48000
+    'SAMPLE_RATE': 24000,
+    # The least recently played previews are removed above this size by the evict_previews command
+    'MAX_BYTES': 1024 * 1024 * 1024,
+}
+
+
+# Waveform peaks for the players, stored next to the clips (see transcriber/waveforms.py)
+WAVEFORMS = {
+    # Resolution of the finest level; each of the LEVELS levels halves the one before
+    'SAMPLES_PER_PEAK': 64,
+    'LEVELS': 6,
+    # Also compute them while uploads are split, so the list never has to decode a clip for them
+    'ON_INGEST': True,
+}
+
+
+# Training exports in shards (see transcriber/exports.py and export_dataset.py)
+DATASET_EXPORT = {
+    # Clips converted for an export are kept here, so the next export with the same conversion reuses them
+    'CACHE_DIR': os.path.join(BASE_DIR, 'export_cache'),
+    # A shard is closed when it reaches either limit
+    'SHARD_MAX_BYTES': 512 * 1024 * 1024,
+    'SHARD_MAX_SAMPLES': 10000,
+}
+
+
+# Audio quality pipeline (see transcriber/quality.py and the analyze_quality command)
+QUALITY = {
+    # Every clip is decoded once, and its trim and STFT computed once, for all of these
+    'ANALYZERS': [
+        'transcriber.quality.TailNoiseAnalyzer',
+        'transcriber.quality.ClarityAnalyzer',
+    ],
+    # Also analyse chunks while uploads are split, so new clips need no batch run
+    'ON_INGEST': True,
+}
+# Decoded audio features shared by the quality analyses (see transcriber/features.py)
+FEATURE_STORE_DIR = os.path.join(BASE_DIR, 'features')
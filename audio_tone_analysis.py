@@ -1,15 +1,21 @@
 # !pip install librosa numpy pandas soundfile
 
 import os
-import librosa
-import numpy as np
+import django
 import pandas as pd
 import warnings
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
-FOLDER_TO_CLASSIFY = 'media/wavs/'
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CONFIG.settings")
+django.setup()
 
+from transcriber.models import AudioTranscription
+from transcriber.analysis import clarity_score as contrast_clarity_score
+from transcriber.features import FeatureStore
+
+# Audios are read from the database. To store the clarity score on the records, use:
+# python manage.py analyze_quality
 
 AUDIO_CLASSES = {
     "internatta": {
@@ -29,51 +35,54 @@ AUDIO_CLASSES = {
     }
 }
 
-def calculate_clarity_score(audio_path):
+
+def clarity_score(features):
     """
     Audioning spektral kontrastining standart og'ishi asosida 'Aniqlik Ko'rsatkichi'ni hisoblaydi.
     Bizning tahlillarimizga ko'ra, bu ko'rsatkich qancha past bo'lsa, audio shuncha toza.
+    `features` - feature store yozuvi yoki ClarityAnalyzer natijasi.
     """
-    try:
-        y, sr = librosa.load(audio_path, sr=None)
-        if len(y) < sr * 0.5: return 10.0
-        
-        S = np.abs(librosa.stft(y))
-        contrast = librosa.feature.spectral_contrast(S=S, sr=sr)
-        clarity_score = np.mean(np.std(contrast, axis=1))
-        return clarity_score
-    except Exception as e:
-        print(f"  Xatolik ({os.path.basename(audio_path)}): {e}")
-        return 999.0
-
-classification_results = []
-valid_extensions = ('.wav', '.mp3', '.flac', '.m4a')
-
-print(f"--- '{FOLDER_TO_CLASSIFY}' papkasidagi fayllarni tasniflash boshlandi ---")
-print("Har bir fayl o'z klassiga tegishli shaxsiy chegara bilan solishtiriladi.")
-
-for filename in sorted(os.listdir(FOLDER_TO_CLASSIFY)):
-    if filename.lower().endswith(valid_extensions):
-        file_path = os.path.join(FOLDER_TO_CLASSIFY, filename)
-        
-        file_class = None
-        quality_threshold = None
-        for class_name in AUDIO_CLASSES:
-            if class_name in filename.lower():
-                file_class = class_name
-                quality_threshold = AUDIO_CLASSES[class_name]['threshold']
-                break
-        
+    return contrast_clarity_score(features['frames'], features['sample_rate'], features['contrast_std'])
+
+
+def audio_class(filename):
+    for class_name in AUDIO_CLASSES:
+        if class_name in filename.lower():
+            return class_name, AUDIO_CLASSES[class_name]['threshold']
+    return None, None
+
+
+if __name__ == '__main__':
+    classification_results = []
+
+    print("--- Ma'lumotlar bazasidagi audiolarni tasniflash boshlandi ---")
+    print("Har bir fayl o'z klassiga tegishli shaxsiy chegara bilan solishtiriladi.")
+
+    # Faqat yangi yoki o'zgargan fayllar dekodlanadi, qolganlari feature store'dan olinadi
+    audios = list(AudioTranscription.objects.order_by('audio_file').only('pk', 'audio_file', 'content_hash'))
+    store = FeatureStore()
+    extracted, kept, failed = store.update(
+        [(audio.pk, audio.audio_file.path, audio.content_hash) for audio in audios],
+        workers=os.cpu_count() or 4,
+        log=lambda message: print(f"  Xatolik: {message}")
+    )
+    print(f"{extracted} ta fayl tahlil qilindi, {kept} tasi feature store'dan olindi.")
+
+    for audio in audios:
+        filename = audio.file_name
+        file_class, quality_threshold = audio_class(filename)
+
         if file_class:
-            score = calculate_clarity_score(file_path)
-            
+            entry = store.get(audio.pk)
+            score = clarity_score(entry) if entry is not None else 999.0
+
             if score < quality_threshold:
                 classification = 0 # Toza
                 result_text = "Toza"
             else:
                 classification = 1 # Sifatsiz
                 result_text = "Sifatsiz"
-            
+
             classification_results.append({
                 'Fayl nomi': filename,
                 'Tasnifi': classification,
@@ -83,10 +92,10 @@ for filename in sorted(os.listdir(FOLDER_TO_CLASSIFY)):
         else:
             print(f"  Ogohlantirish: '{filename}' fayli uchun klass topilmadi. O'tkazib yuborildi.")
 
-if classification_results:
-    results_df = pd.DataFrame(classification_results)
-    # print("\n--- AUDIO SIFATI BO'YICHA YAKUNIY HISOBOT ---")
-    # print(results_df.to_string(index=False))
-    results_df.to_csv("audio_tone_analysis_results.csv", index=False, encoding="utf-8-sig")
-else:
-    print(f"\n'{FOLDER_TO_CLASSIFY}' papkasida tasniflanadigan audio fayllar topilmadi.")
\ No newline at end of file
+    if classification_results:
+        results_df = pd.DataFrame(classification_results)
+        # print("\n--- AUDIO SIFATI BO'YICHA YAKUNIY HISOBOT ---")
+        # print(results_df.to_string(index=False))
+        results_df.to_csv("audio_tone_analysis_results.csv", index=False, encoding="utf-8-sig")
+    else:
+        print("\nTasniflanadigan audio yozuvlar topilmadi. Barcha audiolar uchun: python manage.py analyze_quality")
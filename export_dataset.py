@@ -4,46 +4,376 @@
 import os
 import io
 import csv
-import zipfile
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import datetime
 import django
 
 # Django loyihangni settings.py ga ulash
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "CONFIG.settings")
 django.setup()
 
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
 from transcriber.models import AudioTranscription
+from transcriber.zipstream import ZipStream, ZIP_STORED
+from transcriber import exports
 
+MANIFEST_NAME = "manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024
 
-def export_dataset(output_zip="dataset.zip"):
+
+def checked_records():
     """
-    Script to generate dataset.zip with metadata.csv and wav files.
+    Yields (id, file_name, path, transcription, speaker_code) for every checked audio, oldest first.
     """
-    records = AudioTranscription.objects.select_related('speaker').filter(is_checked=True).order_by('created_at')
+    rows = (
+        AudioTranscription.objects.filter(status=AudioTranscription.STATUS_CHECKED)
+        .order_by('created_at')
+        .values_list('id', 'audio_file', 'transcription_text', 'speaker__code')
+    )
+    for pk, audio_file, transcription, speaker_code in rows.iterator():
+        yield pk, os.path.basename(audio_file), default_storage.path(audio_file), transcription or '', speaker_code
+
 
+def metadata_csv(rows):
     string_buffer = io.StringIO()
     csv_writer = csv.writer(string_buffer, delimiter='|', quoting=csv.QUOTE_MINIMAL)
+    for file_name, transcription, speaker_code in rows:
+        csv_writer.writerow([file_name, transcription, speaker_code])
+    return string_buffer.getvalue().encode("utf-8")
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha1(transcription, speaker_code):
+    return hashlib.sha1(f"{transcription}|{speaker_code}".encode("utf-8")).hexdigest()
 
-    for record in records:
-        transcription = record.transcription_text or ''
-        csv_writer.writerow([record.file_name, transcription, record.speaker.code])
 
-    zip_buffer = io.BytesIO()
+def format_throughput(files, size, seconds):
+    seconds = max(seconds, 1e-6)
+    mb = size / (1024 * 1024)
+    return f"{files} files, {mb:.1f} MB in {seconds:.1f}s ({files / seconds:.1f} files/s, {mb / seconds:.1f} MB/s)"
 
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
+
+def write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def export_dataset(output_zip="dataset.zip"):
+    """
+    Script to generate dataset.zip with metadata.csv and wav files.
+    The archive is streamed to disk, so memory use does not grow with the dataset.
+    """
+    records = [record for record in checked_records() if os.path.exists(record[2])]
+    archive = ZipStream()
+
+    with open(output_zip, "wb") as f:
         # metadata.csv yozish
-        zipf.writestr("dataset/metadata.csv", string_buffer.getvalue().encode("utf-8"))
+        data = metadata_csv((file_name, transcription, speaker_code)
+                            for _, file_name, _, transcription, speaker_code in records)
+        for chunk in archive.write_bytes("dataset/metadata.csv", data):
+            f.write(chunk)
 
         # audio fayllarni yozish
-        for record in records:
-            if record.audio_file and os.path.exists(record.audio_file.path):
-                zipf.write(record.audio_file.path, arcname=f"dataset/wavs/{record.file_name}")
+        for _, file_name, path, _, _ in records:
+            for chunk in archive.write_file(f"dataset/wavs/{file_name}", path, ZIP_STORED):
+                f.write(chunk)
 
-    # ZIP faylni saqlash
-    with open(output_zip, "wb") as f:
-        f.write(zip_buffer.getvalue())
+        for chunk in archive.close():
+            f.write(chunk)
 
     print(f"✅ Dataset exported to {output_zip}")
 
 
+class SnapshotExporter:
+    """
+    Exports the dataset incrementally into snapshot_dir.
+
+    manifest.json records what the last completed snapshot contained (record id,
+    file hash, transcription hash). A new snapshot only writes the records that
+    were added, changed or removed since then:
+
+    - mode "delta" writes snapshot-NNNN.zip with the changed WAVs, the full
+      metadata.csv and removed.txt;
+    - mode "tree" updates snapshot_dir/dataset/ in place.
+
+    Progress is journaled after every file, so an interrupted run continues
+    where it stopped when started again.
+    """
+
+    def __init__(self, snapshot_dir, mode="delta"):
+        self.snapshot_dir = snapshot_dir
+        self.mode = mode
+        self.manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME)
+
+    def shard_path(self, snapshot):
+        return os.path.join(self.snapshot_dir, f"snapshot-{snapshot:04d}.zip")
+
+    def journal_path(self, snapshot):
+        return os.path.join(self.snapshot_dir, f"snapshot-{snapshot:04d}.journal")
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {"snapshot": 0, "mode": self.mode, "entries": {}}
+        with open(self.manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["mode"] != self.mode:
+            raise SystemExit(f"{self.snapshot_dir} holds '{manifest['mode']}' snapshots, not '{self.mode}'.")
+        return manifest
+
+    def scan(self, previous_entries):
+        """
+        Builds the manifest entries of the current dataset. Files whose size and
+        mtime did not change since the last snapshot are not read again.
+        """
+        entries = {}
+        hashed_files = hashed_bytes = missing = 0
+        started = time.monotonic()
+
+        for pk, file_name, path, transcription, speaker_code in checked_records():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                missing += 1
+                continue
+
+            previous = previous_entries.get(str(pk))
+            if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+                file_hash = previous["file_hash"]
+            else:
+                file_hash = file_sha1(path)
+                hashed_files += 1
+                hashed_bytes += stat.st_size
+
+            entries[str(pk)] = {
+                "file_name": file_name,
+                "path": path,
+                "transcription": transcription,
+                "speaker": speaker_code,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "file_hash": file_hash,
+                "text_hash": text_sha1(transcription, speaker_code),
+            }
+
+        print(f"Scanned {len(entries)} records, hashed {format_throughput(hashed_files, hashed_bytes, time.monotonic() - started)}")
+        if missing:
+            print(f"⚠️ {missing} records skipped because their file is missing")
+        return entries
+
+    def open_journal(self, journal_path, snapshot):
+        """
+        Returns the lines of an unfinished journal for this snapshot, starting a new one if there is none.
+        """
+        done = []
+        if os.path.exists(journal_path):
+            with open(journal_path, encoding="utf-8") as f:
+                lines = [json.loads(line) for line in f if line.endswith("\n")]
+            if lines and lines[0] == {"snapshot": snapshot, "mode": self.mode}:
+                done = lines[1:]
+                print(f"Resuming snapshot {snapshot}: {len(done)} file operations already done")
+        if not done:
+            with open(journal_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"snapshot": snapshot, "mode": self.mode}) + "\n")
+        return done
+
+    def run(self):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        manifest = self.load_manifest()
+        previous_entries = manifest["entries"]
+
+        # A crash right after the manifest was saved can leave its journal behind
+        stale_journal = self.journal_path(manifest["snapshot"])
+        if os.path.exists(stale_journal):
+            os.remove(stale_journal)
+        entries = self.scan(previous_entries)
+
+        changed = [
+            pk for pk, entry in entries.items()
+            if pk not in previous_entries
+            or previous_entries[pk]["file_hash"] != entry["file_hash"]
+            or previous_entries[pk]["file_name"] != entry["file_name"]
+        ]
+        text_changed = [
+            pk for pk, entry in entries.items()
+            if pk in previous_entries and previous_entries[pk]["text_hash"] != entry["text_hash"]
+        ]
+        removed = sorted({
+            previous["file_name"] for pk, previous in previous_entries.items()
+            if pk not in entries or entries[pk]["file_name"] != previous["file_name"]
+        } - {entry["file_name"] for entry in entries.values()})
+
+        if not changed and not text_changed and not removed:
+            print(f"✅ No changes since snapshot {manifest['snapshot']}")
+            return
+
+        snapshot = manifest["snapshot"] + 1
+        print(f"Snapshot {snapshot}: {len(changed)} new or changed files, "
+              f"{len(text_changed)} transcription changes, {len(removed)} removed files")
+
+        journal_path = self.journal_path(snapshot)
+        if self.mode == "delta" and not os.path.exists(self.shard_path(snapshot)) and os.path.exists(journal_path):
+            # The journal is useless without the shard it describes
+            os.remove(journal_path)
+        done = self.open_journal(journal_path, snapshot)
+        metadata = metadata_csv(
+            (entry["file_name"], entry["transcription"], entry["speaker"]) for entry in entries.values()
+        )
+
+        started = time.monotonic()
+        with open(journal_path, "a", encoding="utf-8") as journal:
+            if self.mode == "delta":
+                written_files, written_bytes = self.write_delta(snapshot, entries, changed, removed, metadata, done, journal)
+            else:
+                written_files, written_bytes = self.write_tree(entries, changed, removed, metadata, done, journal)
+        print(f"Wrote {format_throughput(written_files, written_bytes, time.monotonic() - started)}")
+
+        manifest = {
+            "snapshot": snapshot,
+            "mode": self.mode,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "entries": {
+                pk: {key: entry[key] for key in ("file_name", "speaker", "size", "mtime", "file_hash", "text_hash")}
+                for pk, entry in entries.items()
+            },
+        }
+        write_atomic(self.manifest_path, json.dumps(manifest).encode("utf-8"))
+        os.remove(journal_path)
+        print(f"✅ Snapshot {snapshot} written to {self.snapshot_dir}")
+
+    def write_delta(self, snapshot, entries, changed, removed, metadata, done, journal):
+        shard_path = self.shard_path(snapshot)
+        done_hashes = {line["id"]: line["file_hash"] for line in done}
+
+        if done and os.path.exists(shard_path):
+            # Drop whatever was written after the last journaled member
+            archive = ZipStream(entries=[line["zip_entry"] for line in done], offset=done[-1]["offset"])
+            shard = open(shard_path, "r+b")
+            shard.truncate(archive.offset)
+            shard.seek(archive.offset)
+        else:
+            archive = ZipStream()
+            shard = open(shard_path, "wb")
+            done_hashes = {}
+
+        written_files = written_bytes = 0
+        with shard:
+            for pk in changed:
+                entry = entries[pk]
+                if done_hashes.get(pk) == entry["file_hash"]:
+                    continue
+                for chunk in archive.write_file(f"dataset/wavs/{entry['file_name']}", entry["path"], ZIP_STORED):
+                    shard.write(chunk)
+                shard.flush()
+                journal.write(json.dumps({
+                    "id": pk,
+                    "file_hash": entry["file_hash"],
+                    "zip_entry": archive.entries[-1],
+                    "offset": archive.offset,
+                }) + "\n")
+                journal.flush()
+                written_files += 1
+                written_bytes += entry["size"]
+
+            for chunk in archive.write_bytes("dataset/metadata.csv", metadata):
+                shard.write(chunk)
+            for chunk in archive.write_bytes("dataset/removed.txt", "".join(f"{name}\n" for name in removed).encode("utf-8")):
+                shard.write(chunk)
+            for chunk in archive.close():
+                shard.write(chunk)
+            shard.flush()
+            os.fsync(shard.fileno())
+
+        return written_files, written_bytes
+
+    def write_tree(self, entries, changed, removed, metadata, done, journal):
+        wavs_dir = os.path.join(self.snapshot_dir, "dataset", "wavs")
+        os.makedirs(wavs_dir, exist_ok=True)
+        done_hashes = {line["id"]: line["file_hash"] for line in done}
+
+        written_files = written_bytes = 0
+        for pk in changed:
+            entry = entries[pk]
+            if done_hashes.get(pk) == entry["file_hash"]:
+                continue
+            target = os.path.join(wavs_dir, entry["file_name"])
+            shutil.copyfile(entry["path"], f"{target}.tmp")
+            os.replace(f"{target}.tmp", target)
+            journal.write(json.dumps({"id": pk, "file_hash": entry["file_hash"]}) + "\n")
+            journal.flush()
+            written_files += 1
+            written_bytes += entry["size"]
+
+        for file_name in removed:
+            try:
+                os.remove(os.path.join(wavs_dir, file_name))
+            except FileNotFoundError:
+                pass
+
+        write_atomic(os.path.join(self.snapshot_dir, "dataset", "metadata.csv"), metadata)
+        return written_files, written_bytes
+
+
+def export_training_shards(output_dir, shard_format, conversion, workers, prune):
+    """
+    Exports the dataset as WebDataset tar shards or Parquet files, converting the clips
+    over a process pool (see transcriber/exports.py).
+    """
+    started = time.monotonic()
+    try:
+        counts = exports.export_shards(output_dir, shard_format, conversion, workers, prune=prune, log=print)
+    except ImproperlyConfigured as e:
+        raise SystemExit(str(e))
+    print(f"Converted {counts['converted']} clips, {counts['cached']} taken from the cache, "
+          f"{counts['failed']} failed, in {time.monotonic() - started:.1f}s")
+    if counts["missing"]:
+        print(f"⚠️ {counts['missing']} records skipped because their file is missing")
+    if counts["pruned"]:
+        print(f"Removed {counts['pruned']} clips no longer used from the cache")
+    print(f"✅ {counts['samples']} samples exported to {counts['shards']} {shard_format} shard(s) in {output_dir}")
+
+
 if __name__ == "__main__":
-    export_dataset()
+    parser = argparse.ArgumentParser(description="Export checked audios as a dataset.")
+    parser.add_argument("output", nargs="?",
+                        help="Zip file for a full export (dataset.zip), or directory of the shards (dataset_shards).")
+    parser.add_argument("--format", choices=["zip", *exports.SHARD_FORMATS], default="zip",
+                        help="zip: one archive with metadata.csv, tar: WebDataset shards, parquet: Parquet shards with the audio embedded.")
+    parser.add_argument("--sample-rate", type=int, help="Resample the clips of tar and parquet exports to this rate.")
+    parser.add_argument("--audio-format", choices=exports.AUDIO_FORMATS, default="wav",
+                        help="Format of the clips in tar and parquet exports.")
+    parser.add_argument("--normalize", action="store_true",
+                        help=f"Scale the clips of tar and parquet exports to peak at {exports.NORMALIZE_PEAK_DB} dBFS.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Processes converting the clips.")
+    parser.add_argument("--prune-cache", action="store_true",
+                        help="Remove the converted clips this export did not use from the cache.")
+    parser.add_argument("--snapshot-dir", help="Write an incremental snapshot into this directory instead.")
+    parser.add_argument("--mode", choices=["delta", "tree"], default="delta",
+                        help="delta: one zip shard per snapshot, tree: update a directory tree in place.")
+    args = parser.parse_args()
+
+    if args.snapshot_dir:
+        SnapshotExporter(args.snapshot_dir, args.mode).run()
+    elif args.format == "zip":
+        export_dataset(args.output or "dataset.zip")
+    else:
+        try:
+            conversion = exports.Conversion(args.audio_format, args.sample_rate, args.normalize)
+        except ValueError as e:
+            parser.error(str(e))
+        export_training_shards(args.output or "dataset_shards", args.format, conversion, args.workers, args.prune_cache)
@@ -1,14 +1,33 @@
 from django.contrib import admin
-from .models import AudioTranscription, Speaker
+from .models import AudioTranscription, Speaker, UploadJob, TranscriptionCache
 
 class SpeakerAdmin(admin.ModelAdmin):
     list_display = ('name', 'code')
     search_fields = ('name', 'code')
 
 class AudioTranscriptionAdmin(admin.ModelAdmin):
-    list_display = ('file_name', 'speaker', 'created_at')
-    list_filter = ('speaker',)
-    search_fields = ('audio_file',)
+    list_display = ('file_name', 'speaker', 'status', 'created_at')
+    list_filter = ('speaker', 'status')
+    search_fields = ('audio_file', 'content_hash')
+    raw_id_fields = ('duplicate_of',)
+
+    def save_model(self, request, obj, form, change):
+        # Edits of the transcription made on the main page before this one then conflict
+        if change and {'transcription_text', 'is_checked'} & set(form.changed_data):
+            obj.version += 1
+        super().save_model(request, obj, form, change)
+
+class UploadJobAdmin(admin.ModelAdmin):
+    list_display = ('original_name', 'speaker', 'status', 'chunks_created', 'duplicates_skipped', 'created_at', 'finished_at')
+    list_filter = ('status', 'speaker')
+    search_fields = ('original_name',)
+
+class TranscriptionCacheAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'is_checked', 'updated_at')
+    list_filter = ('is_checked',)
+    search_fields = ('content_hash', 'transcription_text')
 
 admin.site.register(Speaker, SpeakerAdmin)
-admin.site.register(AudioTranscription, AudioTranscriptionAdmin)
\ No newline at end of file
+admin.site.register(AudioTranscription, AudioTranscriptionAdmin)
+admin.site.register(UploadJob, UploadJobAdmin)
+admin.site.register(TranscriptionCache, TranscriptionCacheAdmin)
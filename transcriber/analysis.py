@@ -0,0 +1,54 @@
+# transcriber/analysis.py
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# 1. Amplitude thresholds
+AMPLITUDE_SILENCE_THRESHOLD = 0.015  # Raised slightly to allow for background noise
+AMPLITUDE_NOISE_THRESHOLD = 0.1
+
+# 2. Analysis frame length
+FRAME_DURATION_MS = 20  # Short, so subtle noises are caught
+
+# 3. A suspicious frame only counts when this many frames before it are silent
+CONTEXT_WINDOW_FRAMES = 5
+
+TRIM_THRESHOLD_DB = 20
+
+# Clarity: clips shorter than this get SHORT_CLIP_CLARITY, which counts as unclear for every book
+CLARITY_MIN_SECONDS = 0.5
+SHORT_CLIP_CLARITY = 10.0
+# librosa.feature.spectral_contrast returns its six bands and the valley band
+CONTRAST_BANDS = 7
+
+
+def frame_peaks(tail_segment, sr):
+    frame_length = int(sr * FRAME_DURATION_MS / 1000)
+    frame_count = len(tail_segment) // frame_length
+    frames = tail_segment[:frame_count * frame_length].reshape(frame_count, frame_length)
+    return np.abs(frames).max(axis=1)
+
+
+def has_tail_noise(peaks):
+    """
+    True when a frame with a peak between the silence and noise thresholds follows
+    CONTEXT_WINDOW_FRAMES silent frames, e.g. a breath or a click after the speech.
+    """
+    # Too short a tail for the context rule
+    if peaks is None or len(peaks) <= CONTEXT_WINDOW_FRAMES:
+        return False
+    # context_peaks[i] is the loudest of the CONTEXT_WINDOW_FRAMES frames before frame i + CONTEXT_WINDOW_FRAMES
+    context_peaks = sliding_window_view(peaks[:-1], CONTEXT_WINDOW_FRAMES).max(axis=1)
+    current = peaks[CONTEXT_WINDOW_FRAMES:]
+    suspicious = (AMPLITUDE_SILENCE_THRESHOLD < current) & (current < AMPLITUDE_NOISE_THRESHOLD)
+    return bool(np.any(suspicious & (context_peaks < AMPLITUDE_SILENCE_THRESHOLD)))
+
+
+def clarity_score(frames, sample_rate, contrast_std):
+    """
+    Mean over the bands of the standard deviation of the spectral contrast over time.
+    The lower the score, the cleaner the recording.
+    """
+    if frames < sample_rate * CLARITY_MIN_SECONDS:
+        return SHORT_CLIP_CLARITY
+    return float(np.mean(contrast_std))
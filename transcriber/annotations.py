@@ -0,0 +1,164 @@
+# transcriber/annotations.py
+
+import datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.urls import reverse
+from django.utils import timezone
+from .models import AudioTranscription
+
+# Most edits one save_transcriptions request may carry
+MAX_BATCH_SIZE = 200
+
+RESULT_SAVED = 'saved'
+RESULT_CONFLICT = 'conflict'
+RESULT_NOT_FOUND = 'not_found'
+
+# Statuses an annotator can ask the work queue for: clips to transcribe, or transcriptions to check
+QUEUE_STATUSES = (AudioTranscription.STATUS_UNTRANSCRIBED, AudioTranscription.STATUS_DRAFT)
+
+
+class EditError(ValueError):
+    pass
+
+
+def parse_edits(data):
+    """
+    Validates the edits of a save_transcriptions request: a list of
+    {audio_id, transcription, finish, version} dicts. version is the one the editor loaded
+    the audio with; without it the edit is applied whatever changed in the meantime.
+    Edits of the same audio are merged into the first one, with the transcription and version
+    of the last and finished when any of them is, as the first would otherwise conflict
+    with the next. Returns the edits as (audio_id, transcription, finish, version) tuples.
+    """
+    if not isinstance(data, list):
+        raise EditError('Expected a list of edits.')
+    if len(data) > MAX_BATCH_SIZE:
+        raise EditError(f'At most {MAX_BATCH_SIZE} edits can be saved at once.')
+
+    edits = {}
+    for edit in data:
+        if not isinstance(edit, dict):
+            raise EditError('Every edit must be an object.')
+        try:
+            audio_id = int(edit['audio_id'])
+            version = None if edit.get('version') is None else int(edit['version'])
+        except (KeyError, TypeError, ValueError):
+            raise EditError('Every edit needs a numeric audio_id, and version must be a number.')
+        transcription = edit.get('transcription')
+        if transcription is not None and not isinstance(transcription, str):
+            raise EditError('transcription must be a string.')
+        finish = bool(edit.get('finish')) or (audio_id in edits and edits[audio_id][2])
+        edits[audio_id] = (audio_id, transcription, finish, version)
+    return list(edits.values())
+
+
+def apply_edits(edits):
+    """
+    Saves the transcription of every edit, and marks it checked when `finish` is set, in one
+    transaction. An edit made on another version than the stored one would overwrite somebody
+    else's change, so it is left out. Returns one result dict per edit, in order, with the
+    new version, or the stored text and version for a conflict.
+    """
+    results = []
+    with transaction.atomic():
+        claimed = []
+        for audio_id, transcription, finish, version in edits:
+            # Bumping the version first locks the row, so the check and the write cannot interleave
+            # with another request; on SQLite the first write takes the database lock for the transaction
+            audios = AudioTranscription.objects.filter(pk=audio_id)
+            if version is not None:
+                audios = audios.filter(version=version)
+            claimed.append(bool(audios.update(version=F('version') + 1)))
+
+        # Loaded after the claims, so the statistics move from the state that is replaced
+        ids = [edit[0] for edit in edits]
+        audios = AudioTranscription.objects.in_bulk(ids)
+
+        for (audio_id, transcription, finish, version), is_claimed in zip(edits, claimed):
+            audio = audios.get(audio_id)
+            if audio is None:
+                results.append({'audio_id': audio_id, 'result': RESULT_NOT_FOUND})
+                continue
+            if not is_claimed:
+                results.append({
+                    'audio_id': audio_id, 'result': RESULT_CONFLICT, 'version': audio.version,
+                    'transcription': audio.transcription_text, 'is_checked': audio.is_checked,
+                })
+                continue
+
+            audio.transcription_text = transcription
+            update_fields = ['transcription_text']
+            if finish:
+                audio.is_checked = True
+                update_fields.append('is_checked')
+            # Only the edited columns are written, so concurrent changes to others are kept
+            audio.save(update_fields=update_fields)
+            results.append({'audio_id': audio_id, 'result': RESULT_SAVED, 'version': audio.version})
+    return results
+
+
+def work_queue(status=AudioTranscription.STATUS_UNTRANSCRIBED, speaker_id=None):
+    """
+    Returns the clips of the work queue, oldest first. The (status, created_at, id) and
+    (speaker, status, created_at, id) indexes serve this ordering, so the next clip is found
+    by walking the index past the few clips that are leased at the moment.
+    """
+    queryset = AudioTranscription.objects.filter(status=status)
+    if speaker_id is not None:
+        queryset = queryset.filter(speaker_id=speaker_id)
+    return queryset.order_by('created_at', 'pk')
+
+
+def claim_clips(user, count=1, status=AudioTranscription.STATUS_UNTRANSCRIBED, speaker_id=None, exclude=()):
+    """
+    Leases the next `count` clips of the work queue to the annotator for ANNOTATION['LEASE_SECONDS']
+    and returns them. Clips the annotator still holds are handed out again first, with a new lease,
+    so reloading the page does not take more. Nobody else gets a leased clip until the lease ends,
+    and neither does the automatic transcription. Clips in `exclude`, e.g. the ones the annotator
+    skipped, are not handed out.
+    """
+    now = timezone.now()
+    lease_until = now + datetime.timedelta(seconds=settings.ANNOTATION['LEASE_SECONDS'])
+    queue = work_queue(status, speaker_id).exclude(pk__in=exclude)
+    held = queue.filter(annotator=user, annotation_lease_until__gte=now)
+    available = queue.filter(
+        Q(annotation_lease_until__isnull=True) | Q(annotation_lease_until__lt=now),
+        Q(transcription_lease_until__isnull=True) | Q(transcription_lease_until__lt=now),
+    )
+
+    while True:
+        held_ids = list(held.values_list('pk', flat=True)[:count])
+        candidate_ids = list(available.values_list('pk', flat=True)[:count - len(held_ids)]) if len(held_ids) < count else []
+        # Only writes in the transaction, so on SQLite it waits for the lock (the database timeout)
+        # instead of failing when another annotator is claiming at the same time
+        with transaction.atomic():
+            AudioTranscription.objects.filter(pk__in=held_ids).update(annotation_lease_until=lease_until)
+            # Clips somebody else claimed since they were read no longer match, and are not taken
+            taken = available.filter(pk__in=candidate_ids).update(annotator=user, annotation_lease_until=lease_until)
+        if taken == len(candidate_ids):
+            break
+    return list(queue.filter(annotator=user, annotation_lease_until=lease_until).select_related('speaker')[:count])
+
+
+def release_clips(user, audio_ids):
+    """
+    Gives the annotator's leases on these clips back to the queue. Returns the number released.
+    """
+    return AudioTranscription.objects.filter(pk__in=audio_ids, annotator=user).update(
+        annotator=None, annotation_lease_until=None,
+    )
+
+
+def clip_as_dict(audio):
+    return {
+        'audio_id': audio.pk,
+        'url': reverse('audio', args=[audio.pk]),
+        'file_name': audio.file_name,
+        'speaker': audio.speaker.name,
+        'transcription': audio.transcription_text or '',
+        'is_checked': audio.is_checked,
+        'version': audio.version,
+        'lease_until': audio.annotation_lease_until.isoformat() if audio.annotation_lease_until else None,
+    }
@@ -0,0 +1,37 @@
+# transcriber/benchmarks.py
+# Shared by the benchmark commands and the tests
+
+import time
+import numpy as np
+from pydub import AudioSegment
+from . import segmenter
+
+
+def build_recording(segments, gaps_ms, noise_level):
+    """
+    Joins the sample files into one long recording with silences of varying length between them,
+    so overlapping keep_silence margins are covered too.
+    """
+    recording = AudioSegment.empty()
+    for index in range(len(gaps_ms)):
+        recording += segments[index % len(segments)]
+        gap = AudioSegment.silent(duration=gaps_ms[index], frame_rate=segments[0].frame_rate)
+        recording += gap.set_channels(segments[0].channels).set_sample_width(segments[0].sample_width)
+
+    samples = segmenter.samples_from_raw(recording.raw_data, recording.sample_width, recording.channels)
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-noise_level, noise_level + 1, size=samples.shape)
+    noisy = np.clip(samples.astype(np.int64) + noise, -32768, 32767).astype(samples.dtype)
+    return recording._spawn(noisy.tobytes())
+
+
+def best_time(repeat, function):
+    """
+    Seconds the fastest of `repeat` calls of function() took.
+    """
+    timings = []
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
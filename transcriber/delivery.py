@@ -0,0 +1,99 @@
+# transcriber/delivery.py
+
+import os
+import re
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) byte positions, end included, of a "Range: bytes=..." header for
+    a file of `size` bytes. Returns None when the whole file should be sent: no header, one the
+    server may ignore, or a request for several ranges. Raises ValueError when no byte of
+    the range is in the file.
+    """
+    match = RANGE_RE.match(header or '')
+    if not match:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        # The last `end` bytes
+        if int(end) == 0:
+            raise ValueError('Empty suffix range.')
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts after the end of the file.')
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+def read_range(file, start, length):
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def serve_file(request, path, content_type, etag=None, cache_control='private, max-age=3600'):
+    """
+    Sends a file with support for conditional requests (ETag and Last-Modified, answered with
+    304) and for single byte ranges (206), which audio players use to seek and to read the
+    length of a clip without downloading it. The ETag defaults to one made from the size and
+    the modification time of the file.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('File not found.')
+    etag = etag or f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = int(stat.st_mtime)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        for name, value in headers.items():
+            response.headers.setdefault(name, value)
+        return response
+
+    try:
+        byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response.headers['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    # A range of another version of the file than the client has would not fit with its part
+    if_range = request.headers.get('If-Range')
+    if byte_range is not None and if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        byte_range = None
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(read_range(open(path, 'rb'), start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response.headers['Content-Length'] = str(end - start + 1)
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    for name, value in headers.items():
+        response.headers[name] = value
+    return response
@@ -0,0 +1,373 @@
+# transcriber/exports.py
+
+import datetime
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from .models import AudioTranscription
+from . import features, transcription
+
+# Part of the cache keys, raise when the way clips are converted changes
+EXPORT_VERSION = 1
+# Training data is only exported in lossless formats
+AUDIO_FORMATS = ('wav', 'flac')
+SHARD_FORMATS = ('tar', 'parquet')
+# Sample rates clips can be converted to
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 192000
+# Level normalized clips peak at, in dBFS
+NORMALIZE_PEAK_DB = -1.0
+PARQUET_ROW_GROUP_SIZE = 256
+MANIFEST_NAME = 'shards.json'
+SHARD_NAME_RE = re.compile(r'^dataset-(\d{6})\.(tar|parquet)$')
+
+
+class Conversion:
+    """
+    How the clips of an export are converted: to mono `audio_format` at `sample_rate`, None
+    keeping the rate of each clip, and peak-normalized to NORMALIZE_PEAK_DB when `normalize`.
+    Converted clips are kept in DATASET_EXPORT['CACHE_DIR'] by content and conversion, so
+    another export with the same conversion only converts the clips that are new or changed.
+    Without any conversion the stored WAVs are exported as they are.
+    """
+
+    def __init__(self, audio_format='wav', sample_rate=None, normalize=False, cache_dir=None):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f'Unknown audio format: {audio_format}.')
+        if sample_rate and not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+            raise ValueError(f'The sample rate must be between {MIN_SAMPLE_RATE} and {MAX_SAMPLE_RATE} Hz.')
+        self.audio_format = audio_format
+        self.sample_rate = sample_rate or None
+        self.normalize = normalize
+        # Kept on the instance, since worker processes may not have the settings
+        self.cache_dir = cache_dir or settings.DATASET_EXPORT['CACHE_DIR']
+
+    @property
+    def is_copy(self):
+        return self.audio_format == 'wav' and self.sample_rate is None and not self.normalize
+
+    def as_dict(self):
+        return {'audio_format': self.audio_format, 'sample_rate': self.sample_rate, 'normalize': self.normalize}
+
+    def cache_path(self, path, content_hash=''):
+        version = f'export{EXPORT_VERSION}:{self.audio_format}:{self.sample_rate}:{int(self.normalize)}'
+        key = hashlib.sha1(features.file_key(version, path, content_hash).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f'{key}.{self.audio_format}')
+
+    def convert(self, path, content_hash=''):
+        """
+        Returns the path of the converted clip and whether it had to be converted, False when
+        it was in the cache.
+        """
+        if self.is_copy:
+            return path, False
+        target = self.cache_path(path, content_hash)
+        if os.path.exists(target):
+            return target, False
+
+        data, _ = transcription.encode_payload(path, self.audio_format, self.sample_rate,
+                                               NORMALIZE_PEAK_DB if self.normalize else None)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Written next to the cache and renamed, so an export at the same time never reads half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return target, True
+
+
+def checked_samples():
+    """
+    Returns the checked audios whose file exists, oldest first, as dicts with their id,
+    file_name, path, size, content_hash, text and speaker, and the number of them that were skipped
+    because their file is missing.
+    """
+    rows = (
+        AudioTranscription.objects.filter(status=AudioTranscription.STATUS_CHECKED)
+        .order_by('created_at', 'pk')
+        .values_list('id', 'audio_file', 'content_hash', 'transcription_text', 'speaker__code')
+    )
+    samples = []
+    missing = 0
+    for pk, audio_file, content_hash, text, speaker_code in rows.iterator():
+        path = default_storage.path(audio_file)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            missing += 1
+            continue
+        samples.append({
+            'id': pk,
+            'file_name': os.path.basename(audio_file),
+            'path': path,
+            'size': size,
+            'content_hash': content_hash,
+            'text': text or '',
+            'speaker': speaker_code,
+        })
+    return samples, missing
+
+
+def convert_item(item):
+    """
+    Process pool entry point: (position, path, content_hash, conversion) -> (position, path, converted, error).
+    """
+    position, path, content_hash, conversion = item
+    try:
+        return (position, *conversion.convert(path, content_hash), None)
+    except Exception as e:
+        return position, None, False, e
+
+
+def convert_samples(samples, conversion, workers=1):
+    """
+    Converts the clips of `samples` over `workers` processes. Yields (sample, audio path,
+    converted, error) in the order of `samples`, so shards can be written while clips are
+    still being converted.
+    """
+    items = [(position, sample['path'], sample['content_hash'], conversion) for position, sample in enumerate(samples)]
+    if conversion.is_copy or workers <= 1:
+        for position, path, converted, error in map(convert_item, items):
+            yield samples[position], path, converted, error
+        return
+
+    chunksize = max(1, min(64, len(items) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for position, path, converted, error in executor.map(convert_item, items, chunksize=chunksize):
+            yield samples[position], path, converted, error
+
+
+def sample_key(sample):
+    """
+    WebDataset groups the members of a sample by their name up to the first dot, which file
+    names may contain, so samples are named after the audio id.
+    """
+    return f"{sample['id']:09d}"
+
+
+def sample_metadata(sample):
+    return json.dumps({'id': sample['id'], 'file_name': sample['file_name'], 'speaker': sample['speaker']},
+                      ensure_ascii=False).encode('utf-8')
+
+
+class _ChunkBuffer:
+    """
+    File object that collects what is written to it, for generating archives while they are sent.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def tar_stream(samples, audio_format):
+    """
+    Generates a WebDataset shard: a tar archive with, for each of `samples` (sample, audio
+    path), the clip as <key>.<audio_format>, its transcription as <key>.txt and its id, file
+    name and speaker as <key>.json.
+    """
+    buffer = _ChunkBuffer()
+    with tarfile.open(fileobj=buffer, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+        for sample, audio_path in samples:
+            key = sample_key(sample)
+            info = archive.gettarinfo(audio_path, arcname=f'{key}.{audio_format}')
+            mtime = info.mtime
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            with open(audio_path, 'rb') as f:
+                archive.addfile(info, f)
+            for name, data in ((f'{key}.txt', sample['text'].encode('utf-8')), (f'{key}.json', sample_metadata(sample))):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = mtime
+                archive.addfile(info, io.BytesIO(data))
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def _pyarrow():
+    # Listed in requirements.txt, but only imported by Parquet exports as it is slow to load
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured('Parquet exports need pyarrow, install it with "pip install pyarrow".')
+    return pyarrow
+
+
+def write_parquet(path, samples):
+    """
+    Writes a Parquet shard with a row per sample: id, file_name, speaker, text and audio, a
+    struct of the encoded clip's bytes and file name as the Hugging Face Audio feature reads it.
+    """
+    pa = _pyarrow()
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('file_name', pa.string()),
+        ('speaker', pa.string()),
+        ('text', pa.string()),
+        ('audio', pa.struct([('bytes', pa.binary()), ('path', pa.string())])),
+    ])
+    with pa.parquet.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(samples), PARQUET_ROW_GROUP_SIZE):
+            rows = samples[start:start + PARQUET_ROW_GROUP_SIZE]
+            audio = []
+            for sample, audio_path in rows:
+                with open(audio_path, 'rb') as f:
+                    audio.append({'bytes': f.read(), 'path': sample['file_name']})
+            writer.write_table(pa.table({
+                'id': [sample['id'] for sample, _ in rows],
+                'file_name': [sample['file_name'] for sample, _ in rows],
+                'speaker': [sample['speaker'] for sample, _ in rows],
+                'text': [sample['text'] for sample, _ in rows],
+                'audio': audio,
+            }, schema=schema))
+
+
+def split_shards(samples, max_bytes=None, max_samples=None):
+    """
+    Groups samples into shards of at most `max_samples` samples and about `max_bytes` of stored
+    audio; a shard always holds at least one sample. The shards only depend on the records and
+    the stored files, not on the conversion, so the export command and the export view
+    number them the same way.
+    """
+    max_bytes = max_bytes or settings.DATASET_EXPORT['SHARD_MAX_BYTES']
+    max_samples = max_samples or settings.DATASET_EXPORT['SHARD_MAX_SAMPLES']
+    shard = []
+    size = 0
+    for sample in samples:
+        if shard and (len(shard) >= max_samples or size + sample['size'] > max_bytes):
+            yield shard
+            shard = []
+            size = 0
+        shard.append(sample)
+        size += sample['size']
+    if shard:
+        yield shard
+
+
+def write_shard(path, shard, shard_format, audio_format):
+    tmp_path = f'{path}.tmp'
+    try:
+        if shard_format == 'tar':
+            with open(tmp_path, 'wb') as f:
+                for chunk in tar_stream(shard, audio_format):
+                    f.write(chunk)
+        else:
+            write_parquet(tmp_path, shard)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def export_shards(output_dir, shard_format='tar', conversion=None, workers=1, max_bytes=None, max_samples=None,
+                  prune=False, log=None):
+    """
+    Exports the checked audios into `output_dir` as dataset-000000.tar, ... WebDataset shards
+    or as Parquet files, with the clips converted by `conversion` over `workers` processes.
+    shards.json lists the shards with their number of samples. Shards left from an earlier,
+    larger export are removed, and with `prune` the cached clips this export did not use.
+    Returns a dict of counts.
+    """
+    if shard_format not in SHARD_FORMATS:
+        raise ValueError(f'Unknown shard format: {shard_format}.')
+    if shard_format == 'parquet':
+        _pyarrow()
+    conversion = conversion or Conversion()
+    log = log or (lambda message: None)
+    os.makedirs(output_dir, exist_ok=True)
+
+    samples, missing = checked_samples()
+    counts = {'samples': 0, 'converted': 0, 'cached': 0, 'failed': 0, 'missing': missing, 'shards': 0, 'pruned': 0}
+    used = []
+
+    def converted():
+        for sample, audio_path, was_converted, error in convert_samples(samples, conversion, workers):
+            if error is not None:
+                counts['failed'] += 1
+                log(f'Could not convert audio {sample["id"]}: {error}')
+                continue
+            if not conversion.is_copy:
+                counts['converted' if was_converted else 'cached'] += 1
+            used.append(audio_path)
+            yield sample, audio_path
+
+    shards = []
+    # Clips are converted ahead of the shard being written; one that fails leaves its shard a sample short
+    converted_samples = converted()
+    pending = next(converted_samples, None)
+    for shard_samples in split_shards(samples, max_bytes, max_samples):
+        shard = []
+        ids = {sample['id'] for sample in shard_samples}
+        while pending is not None and pending[0]['id'] in ids:
+            shard.append(pending)
+            pending = next(converted_samples, None)
+        name = f'dataset-{len(shards):06d}.{shard_format}'
+        write_shard(os.path.join(output_dir, name), shard, shard_format, conversion.audio_format)
+        shards.append({'name': name, 'samples': len(shard)})
+        counts['samples'] += len(shard)
+        log(f'{name}: {len(shard)} samples')
+    counts['shards'] = len(shards)
+
+    for path in glob.glob(os.path.join(output_dir, 'dataset-*')):
+        match = SHARD_NAME_RE.match(os.path.basename(path))
+        if match and (int(match.group(1)) >= len(shards) or match.group(2) != shard_format):
+            os.remove(path)
+
+    if prune and not conversion.is_copy:
+        counts['pruned'], _ = prune_cache(used, conversion.cache_dir)
+
+    manifest = {
+        'format': shard_format,
+        **conversion.as_dict(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'samples': counts['samples'],
+        'shards': shards,
+    }
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(f'{manifest_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    return counts
+
+
+def prune_cache(keep, cache_dir=None):
+    """
+    Removes the converted clips in the cache that are not in `keep`, the paths an export
+    just used. Returns the number of files removed and the bytes freed.
+    """
+    cache_dir = cache_dir or settings.DATASET_EXPORT['CACHE_DIR']
+    keep = set(keep)
+    removed_count = 0
+    freed = 0
+    for shard in os.scandir(cache_dir) if os.path.isdir(cache_dir) else []:
+        if shard.is_dir():
+            for entry in os.scandir(shard.path):
+                if entry.path not in keep:
+                    freed += entry.stat().st_size
+                    os.remove(entry.path)
+                    removed_count += 1
+    return removed_count, freed
@@ -0,0 +1,321 @@
+# transcriber/features.py
+
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from django.core.files import locks
+from . import quality
+
+INDEX_NAME = 'index.npy'
+# Holds the number of the generation readers load, replaced last by every update
+CURRENT_NAME = 'CURRENT'
+LOCK_NAME = 'update.lock'
+# The values of every clip are written into a new generation again once the older
+# generations in use are this many, or hold more unused values than used ones
+MAX_GENERATIONS = 8
+# Loading is retried when an update removes the generations read from in the meantime
+LOAD_ATTEMPTS = 3
+
+# Computed for every clip by quality.extract, whatever the analyzers
+BASE_FIELDS = [
+    ('audio_id', '<i8'),
+    # index_key() of the audio the values were computed from
+    ('key', 'S40'),
+    ('sample_rate', '<i4'),
+    ('frames', '<i8'),
+    ('trim_start', '<i8'),
+    ('trim_end', '<i8'),
+    ('rms', '<f4'),
+]
+
+
+def index_dtype(analyzers):
+    """
+    One record per clip: the shared features, the fixed-size features of every analyzer, the
+    generation its varying-length features were written in and the offset and length of each
+    of them in its array file.
+    """
+    fields = [*BASE_FIELDS, ('generation', '<i8')]
+    for analyzer in analyzers:
+        fields += analyzer.fields
+        for name in analyzer.arrays:
+            fields += [(f'{name}_offset', '<i8'), (f'{name}_count', '<i8')]
+    return np.dtype(fields)
+
+
+def array_names(analyzers):
+    return [name for analyzer in analyzers for name in analyzer.arrays]
+
+
+def file_key(version, path, content_hash=''):
+    """
+    Identifies the audio something was computed from: its content hash when known,
+    otherwise the size and modification time of the file.
+    """
+    if content_hash:
+        return f'{version}:{content_hash}'
+    stat = os.stat(path)
+    return f'{version}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def index_key(version, path, content_hash=''):
+    """
+    The file_key() as stored in the index. Hashed to a fixed length, as NumPy silently cuts
+    strings longer than the field.
+    """
+    return hashlib.sha1(file_key(version, path, content_hash).encode()).hexdigest().encode()
+
+
+def extract_features(audio_path, analyzers):
+    """
+    Decodes a clip once and runs every analyzer on it.
+    """
+    return quality.extract(quality.Clip.load(audio_path), analyzers)
+
+
+def extract_item(item):
+    """
+    Process pool entry point: (audio_id, path, analyzers) -> (audio_id, features, error).
+    """
+    audio_id, path, analyzers = item
+    try:
+        return audio_id, extract_features(path, analyzers), None
+    except Exception as e:
+        return audio_id, None, e
+
+
+class FeatureStore:
+    """
+    Features of every clip, kept on disk as NumPy arrays that are memory-mapped when read:
+    a fixed-size record per clip, sorted by audio id, and for every varying-length feature
+    the values of clips one after another. Only clips that are new or whose audio changed
+    are decoded by update(), and each of them only once for all analyzers.
+
+    Every update writes a generation directory with the records of all clips and the values of
+    the clips it extracted, the values of the others stay in the generations they were written in.
+    The CURRENT file is replaced last, so readers load either the old generation or the new one.
+    Updates wait for each other on a lock file.
+    """
+
+    def __init__(self, directory=None, analyzers=None):
+        if directory is None:
+            from django.conf import settings
+            directory = settings.FEATURE_STORE_DIR
+        self.directory = directory
+        self.analyzers = quality.get_analyzers() if analyzers is None else analyzers
+        self.version = quality.features_version(self.analyzers)
+        self.dtype = index_dtype(self.analyzers)
+        self.generation = None
+        self.load()
+
+    def path(self, generation, name=''):
+        return os.path.join(self.directory, str(generation), name)
+
+    def load(self):
+        for attempt in range(LOAD_ATTEMPTS):
+            self.close()
+            try:
+                with open(os.path.join(self.directory, CURRENT_NAME)) as f:
+                    self.generation = int(f.read())
+            except FileNotFoundError:
+                self.generation = None
+                return
+            try:
+                self.open(self.generation)
+                return
+            except FileNotFoundError:
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+    def open(self, generation):
+        index = np.load(self.path(generation, INDEX_NAME), mmap_mode='r')
+        # Written with other analyzers: every clip is extracted again by the next update()
+        if index.dtype != self.dtype:
+            return
+        arrays = {}
+        for written in np.unique(index['generation']).tolist():
+            arrays[written] = {name: np.load(self.path(written, f'{name}.npy'), mmap_mode='r')
+                               for name in array_names(self.analyzers)}
+        self.index = index
+        self.arrays = arrays
+
+    def close(self):
+        """
+        Drops the memory maps of the loaded generation. Files that are still mapped cannot be
+        removed on Windows, so the features returned by get() should not be kept either.
+        """
+        self.index = np.zeros(0, dtype=self.dtype)
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, audio_id):
+        return self.position(audio_id) is not None
+
+    def position(self, audio_id):
+        position = int(np.searchsorted(self.index['audio_id'], audio_id))
+        if position < len(self.index) and self.index['audio_id'][position] == audio_id:
+            return position
+        return None
+
+    def get(self, audio_id):
+        """
+        Returns the features of a clip as a dict, or None when it is not in the store.
+        """
+        position = self.position(audio_id)
+        if position is None:
+            return None
+        return self.entry(position)
+
+    def entry(self, position):
+        record = self.index[position]
+        features = {name: record[name] for name in self.dtype.names}
+        for name, values in self.arrays[int(record['generation'])].items():
+            offset = int(record[f'{name}_offset'])
+            features[name] = values[offset:offset + int(record[f'{name}_count'])]
+        return features
+
+    def entries(self):
+        for position in range(len(self.index)):
+            yield self.entry(position)
+
+    def update(self, clips, workers=1, log=None, keep=()):
+        """
+        Brings the store in line with `clips`, an iterable of (audio_id, path, content_hash) of the clips
+        to check. The stored features of the other clips whose id is in `keep` are left as they are,
+        those of the rest are dropped. Returns (extracted, kept, failed) counts.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_NAME), 'ab') as lock_file:
+            locks.lock(lock_file, locks.LOCK_EX)
+            try:
+                # Another process may have updated the store since it was loaded
+                self.load()
+                return self._update(clips, workers, log, keep)
+            finally:
+                locks.unlock(lock_file)
+
+    def _update(self, clips, workers, log, keep):
+        kept = []
+        items = []
+        keys = {}
+        listed = set()
+        failed = 0
+        for audio_id, path, content_hash in clips:
+            listed.add(audio_id)
+            try:
+                key = index_key(self.version, path, content_hash)
+            except OSError as e:
+                failed += 1
+                if log:
+                    log(f'Could not read {path}: {e}')
+                continue
+            keys[audio_id] = key
+            position = self.position(audio_id)
+            if position is not None and self.index['key'][position] == key:
+                kept.append(position)
+            else:
+                items.append((audio_id, path, self.analyzers))
+        for position, audio_id in enumerate(self.index['audio_id'].tolist()):
+            if audio_id in keep and audio_id not in listed:
+                kept.append(position)
+
+        extracted = {}
+        if items:
+            workers = max(1, workers)
+            chunksize = max(1, min(64, len(items) // (workers * 4)))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for audio_id, features, error in executor.map(extract_item, items, chunksize=chunksize):
+                    if error is not None:
+                        failed += 1
+                        if log:
+                            log(f'Could not extract features of audio {audio_id}: {error}')
+                        continue
+                    features['audio_id'] = audio_id
+                    features['key'] = keys[audio_id]
+                    extracted[audio_id] = features
+
+        if extracted or len(kept) != len(self.index):
+            self.write(sorted(kept), extracted)
+            # The old generations are no longer mapped here, those the new one does not use can go
+            self.load()
+            self.remove_unused()
+        return len(extracted), len(kept), failed
+
+    def write(self, kept, extracted):
+        """
+        Writes the next generation with the records at the `kept` positions of the loaded one and
+        the `extracted` features, and makes it the current one.
+        """
+        generation = (self.generation or 0) + 1
+        # Left by an update that did not finish
+        shutil.rmtree(self.path(generation), ignore_errors=True)
+        os.makedirs(self.path(generation))
+
+        names = array_names(self.analyzers)
+        fields = [field[0] for field in BASE_FIELDS] + [field[0] for analyzer in self.analyzers for field in analyzer.fields]
+        new = np.zeros(len(extracted), dtype=self.dtype)
+        for position, audio_id in enumerate(sorted(extracted)):
+            for name in fields:
+                new[position][name] = extracted[audio_id][name]
+        # Copies, so the old memory maps are not used once written
+        old = self.index[np.array(kept, dtype=np.int64)]
+        rewrite = self.fragmented(old)
+        index = np.concatenate([old, new])
+        index = index[np.argsort(index['audio_id'], kind='stable')]
+
+        arrays = {name: [] for name in names}
+        offsets = dict.fromkeys(names, 0)
+        for position in range(len(index)):
+            record = index[position]
+            audio_id = int(record['audio_id'])
+            if audio_id not in extracted and not rewrite:
+                continue
+            features = extracted[audio_id] if audio_id in extracted else self.entry(self.position(audio_id))
+            for name in names:
+                values = np.asarray(features[name], dtype=np.float32)
+                record[f'{name}_offset'] = offsets[name]
+                record[f'{name}_count'] = len(values)
+                arrays[name].append(values)
+                offsets[name] += len(values)
+            record['generation'] = generation
+
+        for name, values in arrays.items():
+            np.save(self.path(generation, f'{name}.npy'), np.concatenate(values) if values else np.zeros(0, dtype=np.float32))
+        np.save(self.path(generation, INDEX_NAME), index)
+        temporary = os.path.join(self.directory, f'.{CURRENT_NAME}.tmp')
+        with open(temporary, 'w') as f:
+            f.write(str(generation))
+        os.replace(temporary, os.path.join(self.directory, CURRENT_NAME))
+
+    def fragmented(self, kept_index):
+        """
+        Whether the generations the kept clips were written in are too many, or hold more values
+        of dropped or extracted clips than of kept ones.
+        """
+        written = np.unique(kept_index['generation']).tolist()
+        if len(written) >= MAX_GENERATIONS:
+            return True
+        stored = sum(len(values) for generation in written for values in self.arrays[generation].values())
+        used = sum(int(kept_index[f'{name}_count'].sum()) for name in array_names(self.analyzers))
+        return used * 2 < stored
+
+    def remove_unused(self):
+        """
+        Removes the generations the current one does not use, and the files of stores written
+        before there were generations. Those another process still has mapped cannot be
+        removed on Windows, the next update tries again.
+        """
+        used = {self.generation, *self.arrays}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.isdigit() and int(name) not in used:
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.npy'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -0,0 +1,116 @@
+# transcriber/fingerprint.py
+
+import hashlib
+import numpy as np
+import soundfile
+from .models import AudioTranscription, TranscriptionCache
+
+FINGERPRINT_BITS = 64
+# Clips count as near duplicates when their fingerprints differ in at most this many bits
+# and their lengths by at most NEAR_DUPLICATE_MS
+NEAR_DUPLICATE_BITS = 6
+NEAR_DUPLICATE_MS = 50
+
+
+def content_hash(samples, sample_rate):
+    """
+    SHA-256 of the decoded PCM, so the same audio gets the same hash whatever file it came from.
+    """
+    samples = np.ascontiguousarray(samples, dtype='<i2')
+    digest = hashlib.sha256(f'{sample_rate}:{samples.shape[1]}:'.encode())
+    digest.update(samples.tobytes())
+    return digest.hexdigest()
+
+
+def acoustic_fingerprint(samples):
+    """
+    64-bit fingerprint of the loudness contour: the clip is cut into 65 equal slices and
+    every bit says whether a slice is louder than the one before. Re-encoding, small gain
+    changes and cuts a few milliseconds apart only flip a few bits.
+    Returned as a signed integer so it fits a BigIntegerField.
+    """
+    mono = samples.astype(np.float64).mean(axis=1)
+    if len(mono) <= FINGERPRINT_BITS:
+        return None
+    edges = np.linspace(0, len(mono), FINGERPRINT_BITS + 2).astype(np.int64)[:-1]
+    energy = np.add.reduceat(mono * mono, edges) / np.diff(np.append(edges, len(mono)))
+    bits = energy[1:] > energy[:-1]
+    value = int(np.packbits(bits).view('>u8')[0])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def fingerprint_samples(samples, sample_rate):
+    return {
+        'content_hash': content_hash(samples, sample_rate),
+        'fingerprint': acoustic_fingerprint(samples),
+    }
+
+
+def fingerprint_file(path):
+    samples, sample_rate = soundfile.read(path, dtype='int16', always_2d=True)
+    return fingerprint_samples(samples, sample_rate)
+
+
+def hamming_distance(a, b):
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+def find_original(content_hash, fingerprint, duration_ms, before=None):
+    """
+    Returns (original, exact) for the oldest clip with the same content hash, or else the oldest
+    one whose fingerprint is within NEAR_DUPLICATE_BITS, or (None, False). With `before`, only
+    clips with a smaller id are considered.
+    """
+    queryset = AudioTranscription.objects.order_by('pk')
+    if before is not None:
+        queryset = queryset.filter(pk__lt=before)
+
+    original = queryset.filter(content_hash=content_hash).first() if content_hash else None
+    if original is not None:
+        return original, True
+
+    if fingerprint is None or duration_ms is None:
+        return None, False
+    # Near duplicates are cut at almost the same places, so only clips of about the same length are compared
+    candidates = queryset.filter(
+        duration_ms__gte=duration_ms - NEAR_DUPLICATE_MS,
+        duration_ms__lte=duration_ms + NEAR_DUPLICATE_MS,
+        fingerprint__isnull=False,
+    ).values_list('pk', 'fingerprint')
+    for pk, candidate in candidates:
+        if hamming_distance(candidate, fingerprint) <= NEAR_DUPLICATE_BITS:
+            return queryset.get(pk=pk), False
+    return None, False
+
+
+def cached_transcription(audio):
+    """
+    Returns a transcription that can be reused for the clip without asking a model: a cached
+    one for the same audio, or the text of the clip it is a near duplicate of. None if there is none.
+    """
+    if audio.content_hash:
+        text = TranscriptionCache.objects.filter(content_hash=audio.content_hash).values_list(
+            'transcription_text', flat=True).first()
+        if text:
+            return text
+    if audio.duplicate_of_id:
+        text = AudioTranscription.objects.filter(pk=audio.duplicate_of_id).values_list(
+            'transcription_text', flat=True).first()
+        if text:
+            return text
+    return None
+
+
+def remember_transcription(content_hash, text, is_checked=False):
+    """
+    Stores a transcription in the cache. A checked transcription replaces a model one, never the other way round.
+    """
+    if not content_hash or not text:
+        return
+    entry, created = TranscriptionCache.objects.get_or_create(
+        content_hash=content_hash, defaults={'transcription_text': text, 'is_checked': is_checked}
+    )
+    if not created and (is_checked or not entry.is_checked) and entry.transcription_text != text:
+        entry.transcription_text = text
+        entry.is_checked = is_checked
+        entry.save(update_fields=['transcription_text', 'is_checked', 'updated_at'])
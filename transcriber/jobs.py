@@ -0,0 +1,236 @@
+# transcriber/jobs.py
+
+import os
+import socket
+import datetime
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import AudioTranscription, UploadJob
+from .utils import split_audio, estimate_split_memory
+from . import stats, fingerprint, waveforms
+
+
+class JobLost(Exception):
+    """
+    Raised when a job was put back in the queue, and possibly claimed again, while its worker was still running it.
+    """
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_upload(uploaded_file, speaker, user=None):
+    """
+    Stores an uploaded recording and queues it for splitting.
+    """
+    return UploadJob.objects.create(
+        source_file=uploaded_file,
+        original_name=os.path.basename(uploaded_file.name),
+        speaker=speaker,
+        uploaded_by=user if user is not None and user.is_authenticated else None,
+    )
+
+
+def claim_next_job(worker):
+    """
+    Marks the oldest pending job as running and returns it, or None when the queue is empty.
+    The conditional update makes sure two workers never claim the same job.
+    """
+    while True:
+        job_id = UploadJob.objects.filter(status=UploadJob.STATUS_PENDING).values_list('pk', flat=True).first()
+        if job_id is None:
+            return None
+        now = timezone.now()
+        claimed = UploadJob.objects.filter(pk=job_id, status=UploadJob.STATUS_PENDING).update(
+            status=UploadJob.STATUS_RUNNING, worker=worker, started_at=now, heartbeat_at=now, error='',
+        )
+        if claimed:
+            return UploadJob.objects.get(pk=job_id)
+
+
+def claimed(job):
+    """
+    The job as long as it is still running under the claim that returned `job`: a job that was
+    requeued and claimed again has another worker or start time.
+    """
+    return UploadJob.objects.filter(
+        pk=job.pk, status=UploadJob.STATUS_RUNNING, worker=job.worker, started_at=job.started_at,
+    )
+
+
+def heartbeat(worker, job_ids):
+    """
+    Records that the worker is still running these jobs, so requeue_stale_jobs leaves them alone
+    however long they take or wait for the jobs ahead of them.
+    """
+    return UploadJob.objects.filter(pk__in=job_ids, status=UploadJob.STATUS_RUNNING, worker=worker).update(
+        heartbeat_at=timezone.now(),
+    )
+
+
+def requeue_stale_jobs():
+    """
+    Puts jobs back in the queue when their worker has not reported for UPLOAD_HEARTBEAT_TIMEOUT
+    seconds, which means it died.
+    """
+    deadline = timezone.now() - datetime.timedelta(seconds=settings.UPLOAD_HEARTBEAT_TIMEOUT)
+    return UploadJob.objects.filter(
+        Q(heartbeat_at__lt=deadline) | Q(heartbeat_at__isnull=True, started_at__lt=deadline),
+        status=UploadJob.STATUS_RUNNING,
+    ).update(status=UploadJob.STATUS_PENDING, worker='')
+
+
+def process_upload_job(job_id):
+    """
+    Splits the recording of a claimed job and creates one AudioTranscription per chunk.
+    Returns the number of chunks created.
+    """
+    job = UploadJob.objects.get(pk=job_id)
+    return finish_upload_job(job, split_upload_job(job_id))
+
+
+def split_upload_job(job_id):
+    """
+    Splits the recording of a claimed job and writes every chunk once, straight to its
+    final storage path. Runs inside a worker process and returns (file name, audio_info)
+    pairs for finish_upload_job. If anything fails, the files written so far are removed.
+    """
+    job = UploadJob.objects.get(pk=job_id)
+    audio_field = AudioTranscription._meta.get_field('audio_file')
+    chunks = []
+    try:
+        # A job that is retried after a crash starts over from a clean slate
+        delete_chunks(job)
+
+        with job.source_file.open('rb') as source:
+            for chunk_file, audio_info in split_audio(File(source, name=job.original_name)):
+                name = audio_field.generate_filename(
+                    AudioTranscription(speaker_id=job.speaker_id, upload_job=job, **audio_info), chunk_file.name)
+                name = audio_field.storage.save(name, chunk_file, max_length=audio_field.max_length)
+                chunks.append((name, audio_info))
+                if settings.WAVEFORMS['ON_INGEST']:
+                    chunk_file.seek(0)
+                    waveforms.save_peaks(audio_field.storage.path(name), waveforms.compute_file_peaks(chunk_file))
+                # Progress for the uploads panel, the rows are inserted by finish_upload_job
+                UploadJob.objects.filter(pk=job.pk).update(chunks_created=len(chunks))
+    except Exception as e:
+        delete_files(name for name, _ in chunks)
+        mark_failed(job, e)
+        raise
+    return chunks
+
+
+def finish_upload_job(job, chunks):
+    """
+    Inserts the rows for the chunks split_upload_job wrote, in one transaction, and marks the job as done.
+    `job` is the job as claim_next_job returned it; JobLost is raised, and nothing inserted, when
+    the job was requeued in the meantime.
+
+    Chunks whose audio is already in the dataset, usually because the same recording was uploaded
+    again, are skipped and their files removed. Near duplicates are inserted but linked to the
+    clip they resemble, and chunks with a known transcription start with that text.
+    """
+    audios = []
+    duplicate_names = []
+    try:
+        with transaction.atomic():
+            # Taking the job first also keeps requeue_stale_jobs out until the rows are in
+            if not claimed(job).update(heartbeat_at=timezone.now()):
+                raise JobLost(f'{job.original_name} was requeued while it was being split.')
+            hashes = set()
+            for name, audio_info in chunks:
+                original, exact = fingerprint.find_original(
+                    audio_info.get('content_hash'), audio_info.get('fingerprint'), audio_info['duration_ms']
+                )
+                if exact or audio_info.get('content_hash') in hashes:
+                    duplicate_names.append(name)
+                    continue
+                hashes.add(audio_info.get('content_hash'))
+                audio = AudioTranscription(
+                    audio_file=name, speaker=job.speaker, upload_job=job, duplicate_of=original, **audio_info
+                )
+                audio.transcription_text = fingerprint.cached_transcription(audio)
+                # bulk_create does not call save(), which keeps the status
+                audio.status = audio.transcription_status
+                audios.append(audio)
+
+            AudioTranscription.objects.bulk_create(audios)
+            # bulk_create does not send post_save, so the statistics are updated here
+            stats.record_created(audios)
+            source_name = job.source_file.name
+            claimed(job).update(
+                status=UploadJob.STATUS_DONE, source_file='', chunks_created=len(audios),
+                duplicates_skipped=len(duplicate_names), finished_at=timezone.now(),
+            )
+    except JobLost:
+        # The files are this attempt's own, the job and its recording belong to the new one
+        delete_files(name for name, _ in chunks)
+        raise
+    except Exception as e:
+        delete_files(name for name, _ in chunks)
+        mark_failed(job, e)
+        raise
+
+    delete_files(duplicate_names)
+    # The original recording is no longer needed once it has been split
+    if source_name:
+        job.source_file.storage.delete(source_name)
+    return len(audios)
+
+
+def mark_failed(job, error):
+    """
+    Marks the job as failed, unless it was requeued and belongs to another attempt by now.
+    """
+    claimed(job).update(
+        status=UploadJob.STATUS_FAILED, error=str(error) or error.__class__.__name__, chunks_created=0,
+        finished_at=timezone.now(),
+    )
+
+
+def delete_files(names):
+    storage = AudioTranscription._meta.get_field('audio_file').storage
+    for name in names:
+        storage.delete(name)
+        waveforms.delete_peaks(storage.path(name))
+
+
+def estimate_job_memory(job):
+    """
+    Peak memory the job is expected to need in a worker, 0 when the header cannot be read
+    (the job will then fail quickly).
+    """
+    try:
+        with job.source_file.open('rb') as source:
+            return estimate_split_memory(source)
+    except Exception:
+        return 0
+
+
+def delete_chunks(job):
+    """
+    Removes the chunks an earlier attempt at the job created, with their files.
+    """
+    chunks = list(job.chunks.all())
+    with transaction.atomic():
+        job.chunks.all().delete()
+    delete_files(chunk.audio_file.name for chunk in chunks if chunk.audio_file)
+
+
+def job_as_dict(job):
+    return {
+        'id': job.pk,
+        'name': job.original_name,
+        'speaker': job.speaker.name,
+        'status': job.status,
+        'chunks_created': job.chunks_created,
+        'duplicates_skipped': job.duplicates_skipped,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
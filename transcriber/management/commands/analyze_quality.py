@@ -0,0 +1,100 @@
+import csv
+import os
+from django.core.management.base import BaseCommand
+from transcriber.models import AudioTranscription
+from transcriber import features, quality
+
+
+class Command(BaseCommand):
+    help = ('Runs the quality pipeline over every audio file and stores the results, e.g. whether there is '
+            'a breath or noise after the speech and the clarity score. Each file is decoded once for all '
+            'analyzers and its features are kept in the feature store, so only new or changed files are decoded. '
+            'Files evaluated with the same analyzers and thresholds since they last changed are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                            help='Number of files to decode in parallel.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of records to update per database query.')
+        parser.add_argument('--all', action='store_true',
+                            help='Evaluate every file again, even when it was evaluated before.')
+        parser.add_argument('--csv', help='Also write the results of this run to a CSV file.')
+
+    def handle(self, *args, **options):
+        store = features.FeatureStore()
+        version = quality.results_version(store.analyzers)
+
+        records = []
+        clips = []
+        audio_ids = set()
+        skipped_count = 0
+        queryset = AudioTranscription.objects.order_by('pk').only('pk', 'audio_file', 'content_hash', 'analysis_key')
+        for record in queryset.iterator(chunk_size=options['batch_size']):
+            audio_ids.add(record.pk)
+            clip = (record.pk, record.audio_file.path, record.content_hash)
+            try:
+                key = features.file_key(version, record.audio_file.path, record.content_hash)
+            except OSError:
+                # Reported by the feature store
+                clips.append(clip)
+                continue
+            # Evaluated at ingest or by an earlier run: not decoded again, its stored features are kept
+            if key == record.analysis_key and not options['all']:
+                skipped_count += 1
+                continue
+            record.analysis_key = key
+            records.append(record)
+            clips.append(clip)
+
+        # Only clips that are new or changed are decoded, the rest come from the store
+        extracted_count, kept_count, failed_count = store.update(
+            clips, workers=options['workers'], keep=audio_ids,
+            log=lambda message: self.stderr.write(self.style.ERROR(f'  - {message}')))
+        self.stdout.write(self.style.NOTICE(
+            f'Features of {extracted_count} files extracted, {kept_count} taken from the store. '
+            f'Evaluating {len(records)} files, {skipped_count} already evaluated...'
+        ))
+
+        updated_count = 0
+        noisy_count = 0
+        fields = {'analysis_key'}
+        batch = []
+        results = []
+
+        def flush():
+            AudioTranscription.objects.bulk_update(batch, sorted(fields))
+            batch.clear()
+
+        for record in records:
+            clip_features = store.get(record.pk)
+            if clip_features is None:
+                continue
+            values = quality.evaluate(clip_features, store.analyzers)
+            for name, value in values.items():
+                setattr(record, name, value)
+            fields.update(values)
+            batch.append(record)
+            row = {'file_name': record.file_name, **values}
+            # Flags as 0 and 1, like audio_analysis.py writes them
+            results.append({name: int(value) if isinstance(value, bool) else value for name, value in row.items()})
+            updated_count += 1
+            noisy_count += bool(values.get('is_noisy'))
+
+            if len(batch) >= options['batch_size']:
+                flush()
+                self.stdout.write(f'  {updated_count}/{len(records)} files evaluated')
+
+        if batch:
+            flush()
+
+        if options['csv']:
+            results.sort(key=lambda row: -row.get('is_noisy', 0))
+            with open(options['csv'], 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.DictWriter(f, fieldnames=['file_name', *sorted(fields - {'analysis_key'})])
+                writer.writeheader()
+                writer.writerows(results)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Analysis complete. {updated_count} file(s) evaluated, {noisy_count} with tail noise, '
+            f'{failed_count} failed, {skipped_count} skipped.'
+        ))
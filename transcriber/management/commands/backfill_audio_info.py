@@ -0,0 +1,79 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from transcriber.models import AudioTranscription
+from transcriber.utils import read_wav_info
+from transcriber import stats
+
+
+def _read_info(item):
+    pk, path = item
+    try:
+        return pk, read_wav_info(path), None
+    except Exception as e:
+        return pk, None, e
+
+
+class Command(BaseCommand):
+    help = 'Fills duration, sample rate and channel count for audio records that do not have them yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                            help='Number of files to read in parallel.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of records to update per database query.')
+        parser.add_argument('--all', action='store_true',
+                            help='Re-read every record, not only the ones missing a duration.')
+
+    def handle(self, *args, **options):
+        queryset = AudioTranscription.objects.order_by('pk')
+        if not options['all']:
+            queryset = queryset.filter(duration_ms__isnull=True)
+
+        total = queryset.count()
+        if not total:
+            self.stdout.write(self.style.SUCCESS('All audio records already have their duration. Nothing to do.'))
+            return
+
+        self.stdout.write(self.style.NOTICE(f'Reading WAV headers for {total} records with {options["workers"]} workers...'))
+
+        updated_count = 0
+        failed_count = 0
+        batch = []
+        records = {}
+
+        def flush():
+            AudioTranscription.objects.bulk_update(batch, ['duration_ms', 'sample_rate', 'channels'])
+            batch.clear()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            items = []
+            for record in queryset.only('pk', 'audio_file').iterator(chunk_size=options['batch_size']):
+                records[record.pk] = record
+                items.append((record.pk, record.audio_file.path))
+
+            for pk, audio_info, error in executor.map(_read_info, items):
+                record = records.pop(pk)
+                if error is not None:
+                    failed_count += 1
+                    self.stderr.write(self.style.ERROR(f'  - Could not read {record.audio_file.name}: {error}'))
+                    continue
+
+                for field, value in audio_info.items():
+                    setattr(record, field, value)
+                batch.append(record)
+                updated_count += 1
+
+                if len(batch) >= options['batch_size']:
+                    flush()
+                    self.stdout.write(f'  {updated_count}/{total} records updated')
+
+        if batch:
+            flush()
+
+        # bulk_update bypasses model signals, so the duration totals are recomputed once here
+        stats.rebuild()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Backfill complete. Updated {updated_count} record(s), {failed_count} failed.'
+        ))
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from transcriber.benchmarks import best_time
+from transcriber.models import AudioTranscription, Speaker
+from transcriber.views import FILTER_STATUSES, PAGE_SIZE
+
+UNTRANSCRIBED = Q(transcription_text__isnull=True) | Q(transcription_text__exact='')
+
+# The filter_by choices as main_view filtered them before the status column
+LEGACY_FILTERS = {
+    'all': Q(),
+    'with_transcription_all': ~UNTRANSCRIBED,
+    'with_transcription_checked': Q(is_checked=True),
+    'with_transcription_not_checked': ~UNTRANSCRIBED & Q(is_checked=False),
+    'without_transcription': UNTRANSCRIBED,
+}
+
+
+class Command(BaseCommand):
+    help = ('Shows the query plans and timings of the annotation list filters, as they were written on '
+            'transcription_text and is_checked and as they are now on the status column: the first page '
+            'and the count of the matching audios.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--speaker', type=int,
+                            help='Speaker id for the speaker filter. Defaults to the one with the most audios.')
+        parser.add_argument('--repeat', type=int, default=5, help='Timing runs per query; the best one is reported.')
+
+    def handle(self, *args, **options):
+        speaker_id = options['speaker'] or Speaker.objects.annotate(audio_count=Count('audios')).order_by(
+            '-audio_count').values_list('pk', flat=True).first()
+        self.stdout.write(f'{AudioTranscription.objects.count()} audios, speaker filter on speaker {speaker_id}\n')
+
+        for speaker in (None, speaker_id):
+            for filter_by, legacy in LEGACY_FILTERS.items():
+                before = AudioTranscription.objects.filter(legacy).order_by('-created_at')
+                after = AudioTranscription.objects.order_by('-created_at', '-pk')
+                if filter_by in FILTER_STATUSES:
+                    after = after.filter(status__in=FILTER_STATUSES[filter_by])
+                if speaker is not None:
+                    before = before.filter(speaker_id=speaker)
+                    after = after.filter(speaker_id=speaker)
+
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    f'filter_by={filter_by}' + (f' speaker={speaker}' if speaker is not None else '')
+                ))
+                for name, queryset in (('before', before), ('after', after)):
+                    page = queryset[:PAGE_SIZE + 1]
+                    page_time = best_time(options['repeat'], lambda: list(page.all()))
+                    count_time = best_time(options['repeat'], queryset.count)
+                    self.stdout.write(f'  {name}: page {page_time * 1000:.2f} ms, count {count_time * 1000:.2f} ms')
+                    for line in page.explain().splitlines():
+                        self.stdout.write(f'    {line}')
@@ -0,0 +1,88 @@
+import glob
+import librosa
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from transcriber import analysis, quality
+from transcriber.benchmarks import best_time
+
+
+def script_tail_noise(audio_path):
+    # What audio_analysis.py did for every file before the pipeline
+    y, sr = librosa.load(audio_path, sr=None)
+    _, index = librosa.effects.trim(y, top_db=analysis.TRIM_THRESHOLD_DB)
+    tail_segment = y[index[1]:]
+    frame_length = int(sr * analysis.FRAME_DURATION_MS / 1000)
+    if len(tail_segment) < frame_length * (analysis.CONTEXT_WINDOW_FRAMES + 1):
+        return False
+    frame_peaks = [np.max(np.abs(tail_segment[i:i + frame_length]))
+                   for i in range(0, len(tail_segment) - frame_length + 1, frame_length)]
+    for i in range(analysis.CONTEXT_WINDOW_FRAMES, len(frame_peaks)):
+        current_peak = frame_peaks[i]
+        if analysis.AMPLITUDE_SILENCE_THRESHOLD < current_peak < analysis.AMPLITUDE_NOISE_THRESHOLD:
+            context_peaks = frame_peaks[i - analysis.CONTEXT_WINDOW_FRAMES:i]
+            if max(context_peaks) < analysis.AMPLITUDE_SILENCE_THRESHOLD:
+                return True
+    return False
+
+
+def script_clarity(audio_path):
+    # What audio_tone_analysis.py did for every file before the pipeline
+    y, sr = librosa.load(audio_path, sr=None)
+    if len(y) < sr * analysis.CLARITY_MIN_SECONDS:
+        return analysis.SHORT_CLIP_CLARITY
+    S = np.abs(librosa.stft(y))
+    contrast = librosa.feature.spectral_contrast(S=S, sr=sr)
+    return float(np.mean(np.std(contrast, axis=1)))
+
+
+class Command(BaseCommand):
+    help = ('Compares the throughput of the quality pipeline, which decodes every file once for all analyzers, '
+            'with running the tail noise and the clarity scripts one after the other, and checks that both '
+            'give the same results.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='Audio files to run on. Defaults to audios_for_analysis/*.wav.')
+        parser.add_argument('--repeat', type=int, default=3, help='Timing runs; the best one is reported.')
+
+    def handle(self, *args, **options):
+        paths = options['files'] or sorted(glob.glob('audios_for_analysis/*.wav'))
+        if not paths:
+            raise CommandError('No audio files to run on.')
+        analyzers = [quality.TailNoiseAnalyzer(), quality.ClarityAnalyzer()]
+
+        def scripts():
+            noisy = [script_tail_noise(path) for path in paths]
+            clarity = [script_clarity(path) for path in paths]
+            return list(zip(noisy, clarity))
+
+        def pipeline():
+            results = []
+            for path in paths:
+                values = quality.evaluate(quality.extract(quality.Clip.load(path), analyzers), analyzers)
+                results.append((values['is_noisy'], values['clarity_score']))
+            return results
+
+        expected = scripts()
+        actual = pipeline()
+        mismatches = [
+            (path, old, new) for path, old, new in zip(paths, expected, actual)
+            if old[0] != new[0] or not np.isclose(old[1], new[1], rtol=0, atol=1e-9)
+        ]
+        for path, old, new in mismatches:
+            self.stderr.write(self.style.ERROR(f'  - {path}: scripts {old}, pipeline {new}'))
+
+        audio_seconds = sum(librosa.get_duration(path=path) for path in paths)
+        scripts_time = best_time(options['repeat'], scripts)
+        pipeline_time = best_time(options['repeat'], pipeline)
+        for name, elapsed in (('Both scripts', scripts_time), ('Pipeline', pipeline_time)):
+            self.stdout.write(
+                f'{name}: {elapsed * 1000:.1f} ms, {len(paths) / elapsed:.1f} files/s, '
+                f'{audio_seconds / elapsed:.0f}x real time'
+            )
+
+        if mismatches:
+            raise CommandError(f'{len(mismatches)} file(s) differ between the scripts and the pipeline.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Pipeline is {scripts_time / pipeline_time:.1f}x faster on {len(paths)} files '
+            f'({audio_seconds:.1f}s of audio), with the same results.'
+        ))
@@ -0,0 +1,62 @@
+import glob
+from django.core.management.base import BaseCommand, CommandError
+from pydub import AudioSegment, silence
+from transcriber import segmenter
+from transcriber.benchmarks import best_time, build_recording
+
+
+class Command(BaseCommand):
+    help = ('Times the NumPy silence segmenter, on the whole recording and streamed block by block, against '
+            'pydub.silence.split_on_silence. That they cut the same chunks is checked by the tests in '
+            'transcriber/tests.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', help='Audio files to time on. Defaults to audios_for_analysis/*.wav.')
+        parser.add_argument('--joined', type=int, default=12,
+                            help='Number of sample files to join into an extra long recording (0 to skip).')
+        parser.add_argument('--repeat', type=int, default=3, help='Timing runs per file; the best one is reported.')
+        parser.add_argument('--block-frames', type=int, default=4096,
+                            help='Block size used for the streaming timing.')
+
+    def handle(self, *args, **options):
+        paths = options['files'] or sorted(glob.glob('audios_for_analysis/*.wav'))
+        if not paths:
+            raise CommandError('No audio files to time on.')
+
+        recordings = [(path, AudioSegment.from_file(path)) for path in paths]
+        if options['joined']:
+            gaps_ms = [150, 900, 400, 2000, 650, 360, 1200, 500][:options['joined']] * (options['joined'] // 8 + 1)
+            joined = build_recording([audio for _, audio in recordings], gaps_ms[:options['joined']], noise_level=3)
+            recordings.append((f'{options["joined"]} joined files', joined))
+
+        for name, audio in recordings:
+            samples = segmenter.samples_from_raw(audio.raw_data, audio.sample_width, audio.channels)
+            pydub_time = best_time(options['repeat'], lambda: silence.split_on_silence(
+                audio, min_silence_len=350, silence_thresh=audio.dBFS - 35, keep_silence=350))
+            numpy_time = best_time(options['repeat'], lambda: self.numpy_split(audio))
+            stream_time = best_time(options['repeat'], lambda: self.stream_split(
+                samples, audio.frame_rate, options['block_frames'], min_silence_len=350,
+                silence_thresh=segmenter.dbfs(samples) - 35, keep_silence=350))
+            self.stdout.write(
+                f'{name}: {len(audio) / 1000:.1f}s of audio, pydub {pydub_time * 1000:.1f} ms, '
+                f'NumPy {numpy_time * 1000:.1f} ms ({pydub_time / numpy_time:.0f}x faster), '
+                f'streaming {stream_time * 1000:.1f} ms'
+            )
+
+    @staticmethod
+    def numpy_split(audio):
+        # Mirrors split_audio, including the conversion from the decoded AudioSegment
+        samples = segmenter.samples_from_raw(audio.raw_data, audio.sample_width, audio.channels)
+        energy = segmenter.cumulative_energy(samples)
+        return segmenter.split_on_silence(
+            samples, audio.frame_rate, min_silence_len=350,
+            silence_thresh=segmenter.dbfs(samples, energy) - 35, keep_silence=350, energy=energy)
+
+    @staticmethod
+    def stream_split(samples, sample_rate, block_frames, **params):
+        splitter = segmenter.StreamingSplitter(sample_rate, samples.shape[1], dtype=samples.dtype, **params)
+        chunks = []
+        for position in range(0, len(samples), block_frames):
+            chunks += splitter.feed(samples[position:position + block_frames])
+        chunks += splitter.finish()
+        return chunks
@@ -0,0 +1,224 @@
+import csv
+import datetime
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from transcriber.models import AudioTranscription
+from transcriber import media
+from transcriber.zipstream import ZipStream, ZIP_DEFLATED, ZIP_STORED, compress_file
+
+# Missing files listed by name, unless run with --verbosity 2
+MISSING_SHOWN = 20
+# Names looked up per database query when selecting by a CSV list
+LOOKUP_BATCH_SIZE = 500
+# Listed names matched per query by the end of the stored name, which scans the table
+ENDSWITH_BATCH_SIZE = 100
+PROGRESS_SECONDS = 5
+
+
+class Command(BaseCommand):
+    help = ('Builds a zip archive of the clips selected by status, speaker, date, the quality analysis flags '
+            'and/or a CSV list of file names, e.g. for the weekly reviews. Every file is checked before anything '
+            'is written, and the run stops with a summary when some are missing or listed names match no clip. '
+            'The archive is written as it is built; with --compression deflate the members are compressed on '
+            'worker threads while this one writes them in order.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Zip file to write.')
+        parser.add_argument('--status', action='append', choices=[value for value, _ in AudioTranscription.STATUS_CHOICES],
+                            help='Only clips with this status, can be given more than once.')
+        parser.add_argument('--speaker', action='append', help='Only clips of the speaker with this code, can be given more than once.')
+        parser.add_argument('--since', type=datetime.date.fromisoformat, help='Only clips created on or after this date (YYYY-MM-DD).')
+        parser.add_argument('--until', type=datetime.date.fromisoformat, help='Only clips created before this date (YYYY-MM-DD).')
+        parser.add_argument('--noise', choices=['noisy', 'clean', 'not_analyzed'],
+                            help='Only clips the quality analysis found noisy, clean, or did not analyze yet.')
+        parser.add_argument('--exclude-duplicates', action='store_true', help='Leave out clips marked as duplicates of another one.')
+        parser.add_argument('--csv', help='Only the clips whose file name is listed in this CSV file, in its order.')
+        parser.add_argument('--csv-column', help='Column of the CSV file with the file names, the first one by default.')
+        parser.add_argument('--limit', type=int, help='At most this many clips.')
+        parser.add_argument('--metadata', action='store_true',
+                            help='Also write metadata.csv with the file name, transcription and speaker of every clip.')
+        parser.add_argument('--compression', choices=['stored', 'deflate'], default='stored',
+                            help='WAV files hardly get smaller, so they are stored by default.')
+        parser.add_argument('--compresslevel', type=int, default=6, help='zlib level of deflated members.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help='Threads compressing members.')
+        parser.add_argument('--skip-missing', action='store_true',
+                            help='Leave out the listed files that are not in the database and the clips whose '
+                                 'file is missing instead of stopping.')
+
+    def handle(self, *args, **options):
+        records, unmatched = self.select(options)
+        missing = [audio_file for audio_file, _, _ in records if not default_storage.exists(audio_file)]
+        if missing:
+            self.report(f'{len(missing)} of the {len(records)} selected clips have no file on disk.', missing, options)
+        if (unmatched or missing) and not options['skip_missing']:
+            raise CommandError('Nothing was written. Pass --skip-missing to archive the other clips.')
+        if missing:
+            missing = set(missing)
+            records = [record for record in records if record[0] not in missing]
+        if not records:
+            raise CommandError('No clips match the selection.')
+
+        paths = [default_storage.path(audio_file) for audio_file, _, _ in records]
+        sizes = [os.path.getsize(path) for path in paths]
+        total_bytes = sum(sizes)
+        compress_type = ZIP_DEFLATED if options['compression'] == 'deflate' else ZIP_STORED
+        self.stdout.write(self.style.NOTICE(
+            f'Archiving {len(records)} clips, {total_bytes / 1024 / 1024:.1f} MB, into {options["output"]}...'))
+
+        started = time.monotonic()
+        tmp_path = f'{options["output"]}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                archive = ZipStream(compresslevel=options['compresslevel'])
+                if options['metadata']:
+                    for chunk in archive.write_bytes('metadata.csv', self.metadata(records)):
+                        f.write(chunk)
+
+                if compress_type == ZIP_STORED:
+                    members = (archive.write_file(os.path.basename(path), path, ZIP_STORED) for path in paths)
+                else:
+                    members = (archive.write_compressed(os.path.basename(path), member) for path, member in
+                               zip(paths, self.compressed(paths, options['compresslevel'], options['workers'])))
+
+                done_bytes = 0
+                last_report = started
+                for position, (member, size) in enumerate(zip(members, sizes), 1):
+                    for chunk in member:
+                        f.write(chunk)
+                    done_bytes += size
+                    if time.monotonic() - last_report >= PROGRESS_SECONDS:
+                        last_report = time.monotonic()
+                        self.stdout.write(f'  {position}/{len(records)} clips, '
+                                          f'{self.throughput(done_bytes, last_report - started)}')
+
+                for chunk in archive.close():
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, options['output'])
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(records)} clips archived in {options["output"]}, {archive.offset / 1024 / 1024:.1f} MB, '
+            f'{self.throughput(total_bytes, time.monotonic() - started)}.'))
+
+    def select(self, options):
+        """
+        Returns (audio_file, transcription, speaker code) of the selected clips, and the names of
+        the CSV list that matched none of them.
+        """
+        queryset = AudioTranscription.objects.all()
+        if options['status']:
+            queryset = queryset.filter(status__in=options['status'])
+        if options['speaker']:
+            queryset = queryset.filter(speaker__code__in=options['speaker'])
+        if options['since']:
+            queryset = queryset.filter(created_at__date__gte=options['since'])
+        if options['until']:
+            queryset = queryset.filter(created_at__date__lt=options['until'])
+        if options['noise'] == 'noisy':
+            queryset = queryset.filter(is_noisy=True)
+        elif options['noise'] == 'clean':
+            queryset = queryset.filter(is_noisy=False)
+        elif options['noise'] == 'not_analyzed':
+            queryset = queryset.filter(is_noisy__isnull=True)
+        if options['exclude_duplicates']:
+            queryset = queryset.filter(duplicate_of__isnull=True)
+        fields = ('audio_file', 'transcription_text', 'speaker__code')
+
+        if not options['csv']:
+            queryset = queryset.order_by('created_at', 'pk')
+            if options['limit'] is not None:
+                queryset = queryset[:options['limit']]
+            return list(queryset.values_list(*fields)), []
+
+        names = self.read_csv(options['csv'], options['csv_column'])
+        # Most files are where their name puts them, or still in the flat wavs/ directory (see
+        # the shard_media command), which the audio_file index finds right away
+        candidates = {}
+        for name in names:
+            candidates[media.sharded_name(name)] = name
+            candidates[f'{media.AUDIO_DIR}/{name}'] = name
+        found = {}
+        lookups = list(candidates)
+        for start in range(0, len(lookups), LOOKUP_BATCH_SIZE):
+            for record in queryset.filter(audio_file__in=lookups[start:start + LOOKUP_BATCH_SIZE]).values_list(*fields):
+                found[candidates[record[0]]] = record
+        # Names storage made unique, or stored before the shard was taken from the saved name,
+        # are in another directory: matched by the end of the stored name, the oldest clip first
+        rest = [name for name in names if name not in found]
+        for start in range(0, len(rest), ENDSWITH_BATCH_SIZE):
+            batch = rest[start:start + ENDSWITH_BATCH_SIZE]
+            condition = Q()
+            for name in batch:
+                condition |= Q(audio_file__endswith=f'/{name}')
+            for record in queryset.filter(condition).order_by('pk').values_list(*fields):
+                name = os.path.basename(record[0])
+                if name in batch and name not in found:
+                    found[name] = record
+        unmatched = [name for name in names if name not in found]
+        if unmatched:
+            self.report(f'{len(unmatched)} of the {len(names)} listed files are not in the database '
+                        f'or do not match the other filters.', unmatched, options)
+        records = [found[name] for name in names if name in found]
+        if options['limit'] is not None:
+            records = records[:options['limit']]
+        return records, unmatched
+
+    def read_csv(self, path, column):
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                column = column or (reader.fieldnames or [None])[0]
+                if column not in (reader.fieldnames or []):
+                    raise CommandError(f'{path} has no column {column!r}.')
+                names = [os.path.basename(row[column].strip()) for row in reader if row[column] and row[column].strip()]
+        except OSError as e:
+            raise CommandError(f'Could not read {path}: {e}')
+        # Listed twice, archived once
+        return list(dict.fromkeys(names))
+
+    def report(self, message, names, options):
+        self.stderr.write(self.style.WARNING(message))
+        shown = names if options['verbosity'] >= 2 else names[:MISSING_SHOWN]
+        for name in shown:
+            self.stderr.write(f'  - {name}')
+        if len(shown) < len(names):
+            self.stderr.write(f'  ... and {len(names) - len(shown)} more (list them all with --verbosity 2)')
+
+    @staticmethod
+    def metadata(records):
+        string_buffer = io.StringIO()
+        csv_writer = csv.writer(string_buffer, delimiter='|', quoting=csv.QUOTE_MINIMAL)
+        for audio_file, transcription, speaker_code in records:
+            csv_writer.writerow([os.path.basename(audio_file), transcription or '', speaker_code])
+        return string_buffer.getvalue().encode('utf-8')
+
+    @staticmethod
+    def compressed(paths, compresslevel, workers):
+        """
+        Yields the compress_file() results of `paths` in order. Up to twice as many files as there
+        are workers are read ahead, which bounds the memory they take.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = deque()
+            for path in paths:
+                pending.append(executor.submit(compress_file, path, ZIP_DEFLATED, compresslevel))
+                if len(pending) >= max(1, workers) * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @staticmethod
+    def throughput(size, seconds):
+        mb = size / 1024 / 1024
+        return f'{mb:.1f} MB in {seconds:.1f}s ({mb / max(seconds, 1e-6):.1f} MB/s)'
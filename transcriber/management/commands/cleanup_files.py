@@ -1,45 +1,144 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from transcriber.models import AudioTranscription
+from django.db import DatabaseError
+from django.utils import timezone
+from transcriber.models import AudioTranscription, UploadJob
+from transcriber import media, waveforms
+
+# Missing files listed by name, unless run with --verbosity 2
+MISSING_SHOWN = 20
+
 
 class Command(BaseCommand):
-    help = 'Cleans up orphan audio files that are on disk but not in the database.'
+    help = ('Cleans up orphan audio files, and their waveform peaks, that are on disk but not in the database, '
+            'and reports the audios whose file is missing. Goes through wavs/ one shard directory at a time '
+            'and looks the files up by the audio_file index, so memory use does not grow with the dataset. '
+            'Files written since the oldest running upload job started are kept, as their records may not exist yet.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the orphan files, without deleting them.')
+        parser.add_argument('--workers', type=int, default=8, help='Number of files to delete in parallel.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of files of the flat wavs/ directory to look up per query.')
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.NOTICE('Starting orphan file cleanup...'))
+        wavs_dir = os.path.join(settings.MEDIA_ROOT, media.AUDIO_DIR)
+        if not os.path.isdir(wavs_dir):
+            self.stdout.write(self.style.SUCCESS('WAVs directory does not exist. No cleanup needed.'))
+            return
+
+        orphan_files = []
+        missing_files = []
         try:
-            db_files = set(AudioTranscription.objects.values_list('audio_file', flat=True))
-        except Exception as e:
+            self.cutoff = self.upload_cutoff()
+            self.skipped_count = 0
+            self.check_flat_directory(wavs_dir, options['batch_size'], orphan_files, missing_files)
+            for shard in media.all_shards():
+                self.check_shard(os.path.join(wavs_dir, shard), shard, orphan_files, missing_files)
+        except DatabaseError as e:
             self.stderr.write(self.style.ERROR(f"Could not retrieve files from database: {e}"))
             return
 
-        wavs_dir = os.path.join(settings.MEDIA_ROOT, 'wavs')
-        if not os.path.isdir(wavs_dir):
-            self.stdout.write(self.style.SUCCESS('WAVs directory does not exist. No cleanup needed.'))
-            return
-            
-        disk_files = set()
-        for filename in os.listdir(wavs_dir):
-            if filename.lower().endswith('.wav'):
-                disk_files.add(os.path.join('wavs', filename).replace('\\', '/'))
+        if self.skipped_count:
+            self.stdout.write(f'{self.skipped_count} file(s) without a record were kept, '
+                              f'they may belong to uploads that are still being processed.')
 
-        orphan_files = disk_files - db_files
+        if missing_files:
+            self.stdout.write(self.style.WARNING(f'{len(missing_files)} audio(s) in the database have no file on disk.'))
+            shown = missing_files if options['verbosity'] >= 2 else missing_files[:MISSING_SHOWN]
+            for name in shown:
+                self.stdout.write(f'  - Missing: {name}')
+            if len(shown) < len(missing_files):
+                self.stdout.write(f'  ... and {len(missing_files) - len(shown)} more (list them all with --verbosity 2)')
 
         if not orphan_files:
             self.stdout.write(self.style.SUCCESS('No orphan files found. Everything is clean!'))
             return
 
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Found {len(orphan_files)} orphan files, not deleted (dry run).'))
+            for path in orphan_files:
+                self.stdout.write(f'  - Orphan: {path}')
+            return
+
         self.stdout.write(self.style.WARNING(f'Found {len(orphan_files)} orphan files to delete.'))
 
         deleted_count = 0
-        for orphan_file_rel_path in orphan_files:
-            full_path = os.path.join(settings.MEDIA_ROOT, orphan_file_rel_path)
-            try:
-                os.remove(full_path)
-                self.stdout.write(f'  - Deleted: {full_path}')
-                deleted_count += 1
-            except OSError as e:
-                self.stderr.write(self.style.ERROR(f'  - Error deleting {full_path}: {e}'))
-        
-        self.stdout.write(self.style.SUCCESS(f'Cleanup complete. Successfully deleted {deleted_count} orphan file(s).'))
\ No newline at end of file
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            for full_path, error in executor.map(self.delete, orphan_files):
+                if error is None:
+                    self.stdout.write(f'  - Deleted: {full_path}')
+                    deleted_count += 1
+                else:
+                    self.stderr.write(self.style.ERROR(f'  - Error deleting {full_path}: {error}'))
+
+        self.stdout.write(self.style.SUCCESS(f'Cleanup complete. Successfully deleted {deleted_count} orphan file(s).'))
+
+    @staticmethod
+    def delete(full_path):
+        try:
+            os.remove(full_path)
+        except OSError as e:
+            return full_path, e
+        return full_path, None
+
+    @staticmethod
+    def upload_cutoff():
+        """
+        Upload jobs write their chunks long before finish_upload_job inserts the rows, so files
+        modified since the oldest running job started, or since this run started, may still
+        get a record and are not orphans yet.
+        """
+        started = UploadJob.objects.filter(status=UploadJob.STATUS_RUNNING, started_at__isnull=False).order_by('started_at')
+        oldest = started.values_list('started_at', flat=True).first()
+        now = timezone.now()
+        return min(oldest, now).timestamp() if oldest else now.timestamp()
+
+    @staticmethod
+    def audio_files(directory):
+        """
+        Names of the audio files and waveform peaks directly in a directory, with their modification time.
+        """
+        with os.scandir(directory) as entries:
+            return {entry.name: entry.stat().st_mtime for entry in entries if entry.is_file() and (
+                entry.name.lower().endswith('.wav') or entry.name.endswith(waveforms.SUFFIX))}
+
+    def add_orphans(self, orphan_files, directory, names, mtimes):
+        for name in sorted(names):
+            if mtimes[name] >= self.cutoff:
+                self.skipped_count += 1
+            else:
+                orphan_files.append(os.path.join(directory, name))
+
+    def check_shard(self, directory, shard, orphan_files, missing_files):
+        # Both sides of one shard are small enough to compare as sets
+        db_files = {
+            os.path.basename(name) for name in
+            AudioTranscription.objects.filter(**media.shard_filter(shard)).values_list('audio_file', flat=True)
+        }
+        mtimes = self.audio_files(directory) if os.path.isdir(directory) else {}
+        self.add_orphans(orphan_files, directory,
+                         [name for name in mtimes if name.removesuffix(waveforms.SUFFIX) not in db_files], mtimes)
+        missing_files.extend(f'{media.AUDIO_DIR}/{shard}/{name}' for name in sorted(db_files - mtimes.keys()))
+
+    def check_flat_directory(self, wavs_dir, batch_size, orphan_files, missing_files):
+        """
+        Files from before the sharded layout, until they are moved with the shard_media command.
+        """
+        mtimes = self.audio_files(wavs_dir)
+        disk_files = sorted(mtimes)
+        for start in range(0, len(disk_files), batch_size):
+            batch = disk_files[start:start + batch_size]
+            names = {f'{media.AUDIO_DIR}/{name.removesuffix(waveforms.SUFFIX)}' for name in batch}
+            db_files = set(AudioTranscription.objects.filter(audio_file__in=names).values_list('audio_file', flat=True))
+            self.add_orphans(orphan_files, wavs_dir, [
+                name for name in batch if f'{media.AUDIO_DIR}/{name.removesuffix(waveforms.SUFFIX)}' not in db_files
+            ], mtimes)
+
+        flat = media.unsharded(AudioTranscription.objects)
+        for name in flat.values_list('audio_file', flat=True).iterator(chunk_size=batch_size):
+            if not os.path.exists(os.path.join(settings.MEDIA_ROOT, name)):
+                missing_files.append(name)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from transcriber import previews
+
+
+class Command(BaseCommand):
+    help = ('Removes the least recently played audio previews while the preview cache is larger than '
+            "AUDIO_PREVIEWS['MAX_BYTES']. Runs from cron, so the players never wait for it.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, help="Size limit to use instead of AUDIO_PREVIEWS['MAX_BYTES'].")
+
+    def handle(self, *args, **options):
+        max_bytes = options['max_bytes'] if options['max_bytes'] is not None else settings.AUDIO_PREVIEWS['MAX_BYTES']
+        removed_count, freed = previews.evict(max_bytes)
+        if removed_count:
+            self.stdout.write(self.style.SUCCESS(
+                f'Removed {removed_count} preview(s), {freed / 1024 / 1024:.1f} MB freed.'))
+        else:
+            self.stdout.write(self.style.SUCCESS('The preview cache is within its size limit.'))
@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from transcriber.models import AudioTranscription
+from transcriber import fingerprint
+
+
+def _fingerprint(item):
+    pk, path = item
+    try:
+        return pk, fingerprint.fingerprint_file(path), None
+    except Exception as e:
+        return pk, None, e
+
+
+class Command(BaseCommand):
+    help = ('Computes content hashes and acoustic fingerprints for records uploaded before they existed, '
+            'links duplicates to the oldest copy and fills the transcription cache.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                            help='Number of files to decode in parallel.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of records to update per database query.')
+
+    def handle(self, *args, **options):
+        queryset = AudioTranscription.objects.filter(content_hash='').order_by('pk')
+        total = queryset.count()
+        self.stdout.write(self.style.NOTICE(f'Fingerprinting {total} records with {options["workers"]} workers...'))
+
+        updated_count = 0
+        failed_count = 0
+        batch = []
+        records = {}
+
+        def flush():
+            AudioTranscription.objects.bulk_update(batch, ['content_hash', 'fingerprint'])
+            batch.clear()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            items = []
+            for record in queryset.only('pk', 'audio_file').iterator(chunk_size=options['batch_size']):
+                records[record.pk] = record
+                items.append((record.pk, record.audio_file.path))
+
+            for pk, fingerprints, error in executor.map(_fingerprint, items):
+                record = records.pop(pk)
+                if error is not None:
+                    failed_count += 1
+                    self.stderr.write(self.style.ERROR(f'  - Could not read {record.audio_file.name}: {error}'))
+                    continue
+
+                for field, value in fingerprints.items():
+                    setattr(record, field, value)
+                batch.append(record)
+                updated_count += 1
+
+                if len(batch) >= options['batch_size']:
+                    flush()
+                    self.stdout.write(f'  {updated_count}/{total} records fingerprinted')
+
+        if batch:
+            flush()
+
+        # Every clip is linked to the oldest clip it duplicates
+        exact_count = near_count = 0
+        unlinked = AudioTranscription.objects.filter(duplicate_of__isnull=True).exclude(content_hash='').order_by('pk')
+        for pk, content_hash, fingerprint_value, duration_ms in unlinked.values_list(
+                'pk', 'content_hash', 'fingerprint', 'duration_ms').iterator():
+            original, exact = fingerprint.find_original(content_hash, fingerprint_value, duration_ms, before=pk)
+            if original is not None:
+                AudioTranscription.objects.filter(pk=pk).update(duplicate_of=original)
+                if exact:
+                    exact_count += 1
+                else:
+                    near_count += 1
+
+        cached_count = 0
+        transcribed = AudioTranscription.objects.exclude(content_hash='').exclude(transcription_text__isnull=True) \
+            .exclude(transcription_text='').order_by('is_checked', 'pk')
+        for content_hash, text, is_checked in transcribed.values_list('content_hash', 'transcription_text', 'is_checked').iterator():
+            fingerprint.remember_transcription(content_hash, text, is_checked=is_checked)
+            cached_count += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Fingerprinted {updated_count} record(s), {failed_count} failed. Linked {exact_count} exact and '
+            f'{near_count} near duplicate(s). Cached {cached_count} transcription(s).'
+        ))
@@ -0,0 +1,97 @@
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from transcriber import jobs
+
+# How often the worker tells the queue it is still running its jobs, well within UPLOAD_HEARTBEAT_TIMEOUT
+HEARTBEAT_SECONDS = 30
+
+class Command(BaseCommand):
+    help = ('Splits queued uploads into audio chunks using a pool of worker processes. '
+            'Rows are inserted in upload order, whichever file finishes first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.UPLOAD_WORKERS,
+                            help='Number of uploads to process in parallel.')
+        parser.add_argument('--memory-limit', type=int, default=settings.UPLOAD_MEMORY_LIMIT,
+                            help='Bytes the workers may use together for decoded audio.')
+        parser.add_argument('--poll-interval', type=float, default=2.0,
+                            help='Seconds to wait before checking an empty queue again.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit as soon as the queue is empty instead of waiting for new uploads.')
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        max_workers = max(1, options['workers'])
+        memory_limit = options['memory_limit']
+        self.stdout.write(self.style.NOTICE(f'Upload worker {worker} started with {max_workers} process(es).'))
+
+        # Spawned processes start with a clean interpreter, so they never share the parent's database connection
+        context = multiprocessing.get_context('spawn')
+        # Jobs in the order they were claimed, with their future and estimated memory
+        running = OrderedDict()
+        waiting = None
+        last_heartbeat = time.monotonic()
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=django.setup) as pool:
+            while True:
+                if time.monotonic() - last_heartbeat >= HEARTBEAT_SECONDS:
+                    last_heartbeat = time.monotonic()
+                    jobs.heartbeat(worker, [job.pk for job in running] + ([waiting.pk] if waiting else []))
+                requeued = jobs.requeue_stale_jobs()
+                if requeued:
+                    self.stdout.write(self.style.WARNING(f'Requeued {requeued} stale job(s).'))
+
+                splitting = [future for future, _ in running.values() if not future.done()]
+                while len(splitting) < max_workers:
+                    job = waiting or jobs.claim_next_job(worker)
+                    if job is None:
+                        break
+                    memory = jobs.estimate_job_memory(job)
+                    in_use = sum(memory for future, memory in running.values() if not future.done())
+                    # A large file waits until enough memory is free, but one job always runs
+                    if splitting and in_use + memory > memory_limit:
+                        waiting = job
+                        break
+                    waiting = None
+                    self.stdout.write(f'  - Started: {job.original_name}')
+                    future = pool.submit(jobs.split_upload_job, job.pk)
+                    running[job] = (future, memory)
+                    splitting.append(future)
+
+                self.finish_in_order(running)
+
+                if not running:
+                    if options['once'] and waiting is None:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                wait([future for future, _ in running.values()], timeout=options['poll_interval'],
+                     return_when=FIRST_COMPLETED)
+
+        self.stdout.write(self.style.SUCCESS('Upload queue is empty.'))
+
+    def finish_in_order(self, running):
+        """
+        Inserts the rows of finished jobs, but only once every job claimed before them is
+        finished too, so chunks are added in upload order.
+        """
+        while running:
+            job, (future, _) = next(iter(running.items()))
+            if not future.done():
+                return
+            del running[job]
+            try:
+                chunks_created = jobs.finish_upload_job(job, future.result())
+            except jobs.JobLost as e:
+                self.stderr.write(self.style.WARNING(f'  - Dropped: {e}'))
+            except Exception as e:
+                # The job marks itself as failed, unless its process died before it could
+                jobs.mark_failed(job, e)
+                self.stderr.write(self.style.ERROR(f'  - Failed: {job.original_name}: {e}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'  - Done: {job.original_name} ({chunks_created} chunks)'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from transcriber import search
+
+
+class Command(BaseCommand):
+    help = 'Refills the full-text search index over the transcriptions, file names and speakers.'
+
+    def handle(self, *args, **options):
+        if not search.is_available(connection):
+            raise CommandError('The full-text index needs SQLite with FTS5; search uses LIKE on this database.')
+        self.stdout.write(self.style.NOTICE('Rebuilding the search index...'))
+        count = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Search index rebuilt: {count} audio(s) indexed.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from transcriber import stats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the dataset statistics counters from the audio records.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.NOTICE('Rebuilding dataset statistics...'))
+        stats.rebuild()
+        summary = stats.get_summary()
+        self.stdout.write(self.style.SUCCESS(
+            f"Statistics rebuilt: {summary['total']['count']} audio(s) across {len(summary['by_speaker'])} speaker(s)."
+        ))
@@ -0,0 +1,77 @@
+import os
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from transcriber.models import AudioTranscription
+from transcriber import media, waveforms
+
+
+class Command(BaseCommand):
+    help = ('Moves the audio files that are still in the flat wavs/ directory into their shard directory '
+            '(see transcriber/media.py), with their waveform peaks. Can be stopped and run again at any time: '
+            'a file that was moved before its record was updated is found in its shard and only recorded.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files to move per database transaction.')
+        parser.add_argument('--dry-run', action='store_true', help='Only show what would be moved.')
+
+    def handle(self, *args, **options):
+        storage = AudioTranscription._meta.get_field('audio_file').storage
+        flat = media.unsharded(AudioTranscription.objects).order_by('pk').only('pk', 'audio_file')
+
+        moved_count = 0
+        resumed_count = 0
+        missing = []
+        last_pk = 0
+        while True:
+            batch = list(flat.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            changed = []
+            for audio in batch:
+                source = audio.audio_file.name
+                target = media.sharded_name(source)
+                source_path = storage.path(source)
+                if not os.path.exists(source_path):
+                    # Moved by an earlier run that stopped before it could update the record
+                    if storage.exists(target) and not AudioTranscription.objects.filter(audio_file=target).exists():
+                        audio.audio_file.name = target
+                        changed.append(audio)
+                        resumed_count += 1
+                    else:
+                        missing.append(source)
+                    continue
+
+                if options['dry_run']:
+                    self.stdout.write(f'  - {source} -> {target}')
+                    moved_count += 1
+                    continue
+                collision = storage.exists(target)
+                if collision:
+                    target = storage.get_available_name(target)
+                target_path = storage.path(target)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                os.rename(source_path, target_path)
+                if os.path.exists(waveforms.peaks_path(source_path)):
+                    os.rename(waveforms.peaks_path(source_path), waveforms.peaks_path(target_path))
+                audio.audio_file.name = target
+                if collision:
+                    # A renamed file could not be found again by a later run, so it is recorded right away
+                    audio.save(update_fields=['audio_file'])
+                else:
+                    changed.append(audio)
+                moved_count += 1
+
+            if changed and not options['dry_run']:
+                with transaction.atomic():
+                    AudioTranscription.objects.bulk_update(changed, ['audio_file'])
+            self.stdout.write(f'  {moved_count + resumed_count} files moved so far')
+
+        for name in missing:
+            self.stderr.write(self.style.ERROR(f'  - File not found: {name}'))
+        verb = 'would be moved' if options['dry_run'] else 'moved'
+        self.stdout.write(self.style.SUCCESS(
+            f'{moved_count} file(s) {verb}, {resumed_count} moved by an earlier run recorded, '
+            f'{len(missing)} missing.'
+        ))
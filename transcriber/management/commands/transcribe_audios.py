@@ -0,0 +1,39 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ImproperlyConfigured
+from transcriber.transcription import TranscriptionEngine, get_backend
+
+
+class Command(BaseCommand):
+    help = ('Transcribes untranscribed clips with the backend in settings.TRANSCRIPTION, '
+            'several at a time, and reports latency and throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help='Transcribe at most this many clips.')
+        parser.add_argument('--max-seconds', type=float, help='Stop claiming new clips after this many seconds.')
+        parser.add_argument('--concurrency', type=int, help='Requests in flight at the same time.')
+        parser.add_argument('--requests-per-minute', type=float, help='Rate limit of each API key.')
+        parser.add_argument('--backend', help='Dotted path of the backend class, e.g. transcriber.transcription.FakeBackend.')
+        parser.add_argument('--json', action='store_true', help='Print the metrics as JSON.')
+
+    def handle(self, *args, **options):
+        try:
+            engine = TranscriptionEngine(
+                backend=get_backend(options['backend']) if options['backend'] else None,
+                concurrency=options['concurrency'],
+                requests_per_minute=options['requests_per_minute'],
+                log=self.stdout.write,
+            )
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.NOTICE(
+            f'Transcribing with {engine.backend.__class__.__name__}, {len(engine.keys)} key(s), '
+            f'{engine.concurrency} request(s) in flight.'
+        ))
+        metrics = engine.run(limit=options['limit'], max_seconds=options['max_seconds'])
+
+        if options['json']:
+            self.stdout.write(json.dumps(metrics.summary(), indent=2))
+        else:
+            self.stdout.write(self.style.SUCCESS(metrics.format()))
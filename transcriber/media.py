@@ -0,0 +1,54 @@
+# transcriber/media.py
+
+import hashlib
+import posixpath
+from django.core.files.storage import default_storage
+
+# Audio files are spread over 16 ** SHARD_DIGITS subdirectories of wavs/ by a hash of their
+# name, wavs/3f/x.wav, so no directory grows to hundreds of thousands of entries. The stored
+# name is what the database has: storage adds a suffix when the name is taken, so the shard
+# of a stored file cannot always be computed from its name again.
+AUDIO_DIR = 'wavs'
+SHARD_DIGITS = 2
+SHARDED_NAME_RE = rf'^{AUDIO_DIR}/[0-9a-f]{{{SHARD_DIGITS}}}/'
+
+
+def shard(file_name):
+    return hashlib.sha1(posixpath.basename(file_name).encode()).hexdigest()[:SHARD_DIGITS]
+
+
+def audio_upload_to(instance, filename):
+    """
+    upload_to of AudioTranscription.audio_file. The shard is that of the name storage will
+    save the file under, e.g. with spaces replaced, not of the uploaded one.
+    """
+    filename = default_storage.get_valid_name(posixpath.basename(filename))
+    return posixpath.join(AUDIO_DIR, shard(filename), filename)
+
+
+def sharded_name(name):
+    """
+    Where a file with this name is put in the sharded layout, before storage makes the name
+    unique. Look stored audios up by their name in the database instead.
+    """
+    return audio_upload_to(None, name)
+
+
+def all_shards():
+    return [f'{number:0{SHARD_DIGITS}x}' for number in range(16 ** SHARD_DIGITS)]
+
+
+def shard_filter(shard_name):
+    """
+    Lookups for the audio_file names in a shard, as a range the audio_file index can seek to:
+    '0' is the character right after '/'.
+    """
+    prefix = f'{AUDIO_DIR}/{shard_name}'
+    return {'audio_file__gt': f'{prefix}/', 'audio_file__lt': f'{prefix}0'}
+
+
+def unsharded(queryset):
+    """
+    The audios of a queryset whose file is still in the flat wavs/ directory of the layout before.
+    """
+    return queryset.filter(audio_file__startswith=f'{AUDIO_DIR}/').exclude(audio_file__regex=SHARDED_NAME_RE)
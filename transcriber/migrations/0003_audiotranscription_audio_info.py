@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0002_audiotranscription_is_checked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='channels',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='duration_ms',
+            field=models.PositiveIntegerField(blank=True, help_text='Length of the audio in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='sample_rate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
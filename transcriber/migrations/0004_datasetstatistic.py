@@ -0,0 +1,51 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_statistics(apps, schema_editor):
+    AudioTranscription = apps.get_model('transcriber', 'AudioTranscription')
+    DatasetStatistic = apps.get_model('transcriber', 'DatasetStatistic')
+
+    counters = {}
+    rows = AudioTranscription.objects.values_list('speaker_id', 'is_checked', 'transcription_text', 'duration_ms')
+    for speaker_id, is_checked, transcription_text, duration_ms in rows.iterator():
+        if is_checked:
+            status = 'checked'
+        elif not transcription_text:
+            status = 'untranscribed'
+        else:
+            status = 'draft'
+        counter = counters.setdefault((speaker_id, status), [0, 0])
+        counter[0] += 1
+        counter[1] += duration_ms or 0
+
+    DatasetStatistic.objects.bulk_create([
+        DatasetStatistic(speaker_id=speaker_id, status=status, audio_count=count, duration_ms=duration)
+        for (speaker_id, status), (count, duration) in counters.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0003_audiotranscription_audio_info'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatasetStatistic',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('untranscribed', 'Untranscribed'), ('draft', 'Draft'), ('checked', 'Checked')], max_length=20)),
+                ('audio_count', models.IntegerField(default=0)),
+                ('duration_ms', models.BigIntegerField(default=0)),
+                ('speaker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='transcriber.speaker')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('speaker', 'status'), name='unique_statistic_per_speaker_status')],
+            },
+        ),
+        migrations.RunPython(populate_statistics, migrations.RunPython.noop),
+    ]
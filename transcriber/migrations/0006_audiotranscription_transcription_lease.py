@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0005_uploadjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='transcription_lease_until',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='transcription_worker',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
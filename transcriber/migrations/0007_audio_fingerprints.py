@@ -0,0 +1,50 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0006_audiotranscription_transcription_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranscriptionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('transcription_text', models.TextField()),
+                ('is_checked', models.BooleanField(default=False, help_text='The text was checked by an annotator')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the decoded audio', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='transcriber.audiotranscription'),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='fingerprint',
+            field=models.BigIntegerField(blank=True, db_index=True, help_text='Acoustic fingerprint for finding near duplicates', null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadjob',
+            name='duplicates_skipped',
+            field=models.PositiveIntegerField(default=0, help_text='Chunks that were already in the dataset'),
+        ),
+        migrations.AlterField(
+            model_name='audiotranscription',
+            name='duration_ms',
+            field=models.PositiveIntegerField(blank=True, db_index=True, help_text='Length of the audio in milliseconds', null=True),
+        ),
+    ]
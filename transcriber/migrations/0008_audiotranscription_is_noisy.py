@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0007_audio_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='analysis_key',
+            field=models.CharField(blank=True, help_text='Analysis parameters and file version the noise flag belongs to', max_length=120),
+        ),
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='is_noisy',
+            field=models.BooleanField(blank=True, db_index=True, help_text='Breath or noise after the speech', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0008_audiotranscription_is_noisy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='clarity_score',
+            field=models.FloatField(blank=True, help_text='Spread of the spectral contrast, lower is cleaner', null=True),
+        ),
+        migrations.AlterField(
+            model_name='audiotranscription',
+            name='analysis_key',
+            field=models.CharField(blank=True, help_text='Analyzers, thresholds and file version the quality results belong to', max_length=120),
+        ),
+    ]
@@ -0,0 +1,52 @@
+from django.db import OperationalError, migrations
+
+# The schema as of this migration, so later changes to transcriber/search.py do not change what it does
+CREATE_TABLE_SQL = """CREATE VIRTUAL TABLE transcriber_audiosearch USING fts5(
+    transcription_text, file_name, speaker, tokenize = 'unicode61 remove_diacritics 2'
+)"""
+
+FILL_TABLE_SQL = """INSERT INTO transcriber_audiosearch(rowid, transcription_text, file_name, speaker)
+    SELECT audio.id, coalesce(audio.transcription_text, ''),
+           replace(audio.audio_file, rtrim(audio.audio_file, replace(audio.audio_file, '/', '')), ''),
+           (SELECT name || ' ' || code FROM transcriber_speaker WHERE id = audio.speaker_id)
+    FROM transcriber_audiotranscription AS audio"""
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS transcriber_audiosearch_speaker_update',
+    'DROP TRIGGER IF EXISTS transcriber_audiosearch_delete',
+    'DROP TRIGGER IF EXISTS transcriber_audiosearch_update',
+    'DROP TRIGGER IF EXISTS transcriber_audiosearch_insert',
+    'DROP TABLE IF EXISTS transcriber_audiosearch',
+]
+
+
+def create_search_index(apps, schema_editor):
+    # Only on SQLite built with FTS5; search falls back to LIKE elsewhere. The triggers that
+    # keep the index in sync are installed after the migrations, see transcriber/signals.py
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(CREATE_TABLE_SQL)
+        except OperationalError:
+            return
+        cursor.execute(FILL_TABLE_SQL)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for statement in DROP_SQL:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0009_audiotranscription_clarity_score'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0010_audio_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='audiotranscription',
+            index=models.Index(fields=['created_at', 'id'], name='audio_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:16
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def populate_status(apps, schema_editor):
+    AudioTranscription = apps.get_model('transcriber', 'AudioTranscription')
+    untranscribed = Q(transcription_text__isnull=True) | Q(transcription_text__exact='')
+    AudioTranscription.objects.filter(is_checked=True).update(status='checked')
+    AudioTranscription.objects.filter(is_checked=False).exclude(untranscribed).update(status='draft')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0011_audio_created_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='status',
+            field=models.CharField(choices=[('untranscribed', 'Untranscribed'), ('draft', 'Draft'), ('checked', 'Checked')], default='untranscribed', editable=False, max_length=20),
+        ),
+        migrations.RunPython(populate_status, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='audiotranscription',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='audio_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiotranscription',
+            index=models.Index(fields=['speaker', 'created_at', 'id'], name='audio_speaker_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiotranscription',
+            index=models.Index(fields=['speaker', 'status', 'created_at', 'id'], name='audio_speaker_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0012_audiotranscription_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiotranscription',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
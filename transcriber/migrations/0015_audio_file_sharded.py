@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:28
+
+import transcriber.media
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0014_audiotranscription_annotation_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='audiotranscription',
+            name='audio_file',
+            field=models.FileField(db_index=True, upload_to=transcriber.media.audio_upload_to),
+        ),
+    ]
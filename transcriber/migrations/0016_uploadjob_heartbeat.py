@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transcriber', '0015_audio_file_sharded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Last time the worker reported it was still running the job', null=True),
+        ),
+    ]
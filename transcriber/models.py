@@ -1,8 +1,10 @@
 # transcriber/models.py
 
 import os
+from django.conf import settings
 from django.db import models
 from mutagen.wave import WAVE
+from . import media
 
 class Speaker(models.Model):
     """
@@ -14,15 +16,107 @@ class Speaker(models.Model):
     def __str__(self):
         return f"{self.name} ({self.code})"
 
+class UploadJob(models.Model):
+    """
+    An uploaded recording waiting to be split into chunks by the process_uploads worker.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    source_file = models.FileField(upload_to='uploads/', blank=True)
+    original_name = models.CharField(max_length=255)
+    speaker = models.ForeignKey(Speaker, on_delete=models.PROTECT, related_name='upload_jobs')
+    uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    chunks_created = models.PositiveIntegerField(default=0)
+    duplicates_skipped = models.PositiveIntegerField(default=0, help_text="Chunks that were already in the dataset")
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True, help_text="Host and process id of the worker that claimed the job")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True, help_text="Last time the worker reported it was still running the job")
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.original_name} ({self.status})"
+
+
 class AudioTranscription(models.Model):
     """
     Model to store an audio file and its transcription.
     """
-    audio_file = models.FileField(upload_to='wavs/')
+    STATUS_UNTRANSCRIBED = 'untranscribed'
+    STATUS_DRAFT = 'draft'
+    STATUS_CHECKED = 'checked'
+    STATUS_CHOICES = [
+        (STATUS_UNTRANSCRIBED, 'Untranscribed'),
+        (STATUS_DRAFT, 'Draft'),
+        (STATUS_CHECKED, 'Checked'),
+    ]
+
+    # Sharded by a hash of the file name (see transcriber/media.py), indexed for the file reconciliation
+    audio_file = models.FileField(upload_to=media.audio_upload_to, db_index=True)
     transcription_text = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     speaker = models.ForeignKey(Speaker, on_delete=models.PROTECT, related_name='audios')
     is_checked = models.BooleanField(default=False)
+    # transcription_status stored for the list filters, kept up to date by save()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UNTRANSCRIBED, editable=False)
+    # Raised on every change of the transcription, so stale edits can be told apart (see transcriber/annotations.py)
+    version = models.PositiveIntegerField(default=0, editable=False)
+    duration_ms = models.PositiveIntegerField(null=True, blank=True, db_index=True, help_text="Length of the audio in milliseconds")
+    sample_rate = models.PositiveIntegerField(null=True, blank=True)
+    channels = models.PositiveSmallIntegerField(null=True, blank=True)
+    upload_job = models.ForeignKey(UploadJob, on_delete=models.SET_NULL, null=True, blank=True, related_name='chunks')
+    # Lease taken by the automatic transcription engine (see transcriber/transcription.py)
+    transcription_worker = models.CharField(max_length=100, blank=True)
+    transcription_lease_until = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Lease of the annotator the work queue handed the clip to (see transcriber/annotations.py)
+    annotator = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, related_name='leased_audios')
+    annotation_lease_until = models.DateTimeField(null=True, blank=True)
+    # See transcriber/fingerprint.py
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, help_text="SHA-256 of the decoded audio")
+    fingerprint = models.BigIntegerField(null=True, blank=True, db_index=True, help_text="Acoustic fingerprint for finding near duplicates")
+    duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='duplicates')
+    # Set by the quality pipeline (see transcriber/quality.py), None until the file was analysed
+    is_noisy = models.BooleanField(null=True, blank=True, db_index=True, help_text="Breath or noise after the speech")
+    clarity_score = models.FloatField(null=True, blank=True, help_text="Spread of the spectral contrast, lower is cleaner")
+    analysis_key = models.CharField(max_length=120, blank=True, help_text="Analyzers, thresholds and file version the quality results belong to")
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the annotation list (see transcriber/pagination.py),
+            # alone and after the status and speaker filters
+            models.Index(fields=['created_at', 'id'], name='audio_created_id_idx'),
+            models.Index(fields=['status', 'created_at', 'id'], name='audio_status_created_idx'),
+            models.Index(fields=['speaker', 'created_at', 'id'], name='audio_speaker_created_idx'),
+            models.Index(fields=['speaker', 'status', 'created_at', 'id'], name='audio_speaker_status_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored values so statistics can be updated without re-reading the row
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.status = self.transcription_status
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'transcription_text', 'is_checked'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'status'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         # Return the file name for a more readable representation in the admin panel
@@ -33,9 +127,61 @@ class AudioTranscription(models.Model):
         # A property to easily get just the filename
         return os.path.basename(self.audio_file.name)
     
+    @classmethod
+    def status_from_values(cls, is_checked, transcription_text):
+        """
+        The transcription status of a record with these field values, also used by the
+        statistics for rows that are not loaded as model instances.
+        """
+        if is_checked:
+            return cls.STATUS_CHECKED
+        if not transcription_text:
+            return cls.STATUS_UNTRANSCRIBED
+        return cls.STATUS_DRAFT
+
+    @property
+    def transcription_status(self):
+        return self.status_from_values(self.is_checked, self.transcription_text)
+
     @property
     def duration_seconds(self):
+        if self.duration_ms is not None:
+            return self.duration_ms // 1000
         if not self.audio_file:
             return None
         audio = WAVE(self.audio_file.path)
-        return int(audio.info.length)
\ No newline at end of file
+        return int(audio.info.length)
+
+
+class TranscriptionCache(models.Model):
+    """
+    Transcriptions by content hash, so the same audio is never sent to a model twice,
+    even after its record was deleted and uploaded again.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)
+    transcription_text = models.TextField()
+    is_checked = models.BooleanField(default=False, help_text="The text was checked by an annotator")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.content_hash
+
+
+class DatasetStatistic(models.Model):
+    """
+    Running totals of audio records per speaker and transcription status.
+    Kept up to date incrementally by transcriber.stats.
+    """
+    speaker = models.ForeignKey(Speaker, on_delete=models.CASCADE, related_name='statistics')
+    status = models.CharField(max_length=20, choices=AudioTranscription.STATUS_CHOICES)
+    audio_count = models.IntegerField(default=0)
+    duration_ms = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['speaker', 'status'], name='unique_statistic_per_speaker_status'),
+        ]
+
+    def __str__(self):
+        return f"{self.speaker.code} / {self.status}: {self.audio_count}"
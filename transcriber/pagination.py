@@ -0,0 +1,92 @@
+# transcriber/pagination.py
+
+import datetime
+from django.db.models import Q
+
+# Audios are listed newest first; the id breaks ties between audios created in the same microsecond
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# Counts above this are shown as "more than", so filtered counts stay cheap on a large table
+COUNT_LIMIT = 1000
+
+
+def encode_cursor(audio):
+    microseconds = (audio.created_at - EPOCH) // datetime.timedelta(microseconds=1)
+    return f'{microseconds}_{audio.pk}'
+
+
+def decode_cursor(cursor):
+    """
+    Returns (created_at, id) from a cursor made by encode_cursor, or None when it is not one.
+    """
+    try:
+        microseconds, pk = (int(part) for part in cursor.split('_'))
+        created_at = EPOCH + datetime.timedelta(microseconds=microseconds)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+    # Ids past a 64-bit integer could not even be sent to the database
+    if not 0 < pk < 2 ** 63:
+        return None
+    return created_at, pk
+
+
+class KeysetPage:
+    """
+    A page of a list ordered by (-created_at, -id). Instead of page numbers it links to its neighbours
+    by the first and last audio on it, so a page costs one index range scan however deep it is.
+    """
+
+    def __init__(self, object_list, has_previous, has_next):
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.object_list else None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.object_list else None
+
+
+def keyset_page(queryset, per_page, after=None, before=None, last=False):
+    """
+    Returns the page of `queryset` right after the `after` cursor or right before the `before` cursor,
+    the last page with `last`, and the first page otherwise.
+
+    The cursor conditions are written with a plain bound on created_at, which SQLite can seek
+    the (created_at, id) index to; it does not for the equivalent OR of the two comparisons.
+    """
+    after = decode_cursor(after)
+    before = decode_cursor(before)
+
+    if before is not None or last:
+        # Read backwards from the cursor or from the end, then put the page back in order
+        if before is not None:
+            created_at, pk = before
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(pk__gt=pk), created_at__gte=created_at)
+        rows = list(queryset.order_by('created_at', 'pk')[:per_page + 1])
+        return KeysetPage(rows[:per_page][::-1], has_previous=len(rows) > per_page, has_next=before is not None)
+
+    if after is not None:
+        created_at, pk = after
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(pk__lt=pk), created_at__lte=created_at)
+    rows = list(queryset.order_by('-created_at', '-pk')[:per_page + 1])
+    return KeysetPage(rows[:per_page], has_previous=after is not None, has_next=len(rows) > per_page)
+
+
+def limited_count(queryset, limit=COUNT_LIMIT):
+    """
+    Counts at most `limit` + 1 rows. Returns (count, exact).
+    """
+    count = queryset[:limit + 1].count()
+    return min(count, limit), count <= limit
@@ -0,0 +1,94 @@
+# transcriber/previews.py
+
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+from . import features, transcription
+
+# Part of the cache keys, raise when the way previews are encoded changes
+PREVIEW_VERSION = 1
+CONTENT_TYPE = 'audio/ogg'
+# Eviction stops this far below the size limit, so there is room for new previews until its next run
+LOW_WATER_MARK = 0.9
+
+
+def preview_key(audio):
+    """
+    Identifies the preview of an audio: its content, and how previews are encoded.
+    """
+    version = f"preview{PREVIEW_VERSION}:{settings.AUDIO_PREVIEWS['SAMPLE_RATE']}"
+    key = features.file_key(version, audio.audio_file.path, audio.content_hash)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def preview_path(key):
+    return os.path.join(settings.AUDIO_PREVIEWS['DIR'], key[:2], f'{key}.opus')
+
+
+def get_preview(audio):
+    """
+    Returns the path and the key of the Opus preview of an audio, which is a small fraction of
+    the size of the WAV. It is encoded the first time it is asked for and kept in
+    AUDIO_PREVIEWS['DIR'], whose least recently used previews the evict_previews command
+    removes when it grows past AUDIO_PREVIEWS['MAX_BYTES']. Exports and the transcription
+    always use the original.
+    """
+    key = preview_key(audio)
+    path = preview_path(key)
+    try:
+        # The modification time is the last use, which eviction goes by
+        os.utime(path)
+        return path, key
+    except FileNotFoundError:
+        pass
+
+    data, _ = transcription.encode_payload(audio.audio_file.path, 'opus', settings.AUDIO_PREVIEWS['SAMPLE_RATE'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written next to the cache and renamed, so a request at the same time never reads half a file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path, key
+
+
+def evict(max_bytes=None):
+    """
+    Removes the least recently used previews until the cache is below the size limit.
+    Returns the number of previews removed and the bytes freed.
+    """
+    if max_bytes is None:
+        max_bytes = settings.AUDIO_PREVIEWS['MAX_BYTES']
+    entries = []
+    for shard in os.scandir(settings.AUDIO_PREVIEWS['DIR']) if os.path.isdir(settings.AUDIO_PREVIEWS['DIR']) else []:
+        if shard.is_dir():
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.opus'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return 0, 0
+    target = max_bytes * LOW_WATER_MARK
+    removed_count = 0
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total - freed <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Removed by another process in the meantime
+            pass
+        except PermissionError:
+            # Being sent on Windows, it is removed by a later run if still unused
+            continue
+        removed_count += 1
+        freed += size
+    return removed_count, freed
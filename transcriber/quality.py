@@ -0,0 +1,159 @@
+# transcriber/quality.py
+
+import hashlib
+from functools import cached_property
+import librosa
+import numpy as np
+from . import analysis
+
+N_FFT = 2048
+
+# The shared part of every clip: how it is trimmed and transformed
+PIPELINE_VERSION = f'quality-1:{analysis.TRIM_THRESHOLD_DB}:{N_FFT}'
+
+
+class Clip:
+    """
+    A decoded clip as the analyzers see it: mono float32 samples in [-1, 1], like librosa.load
+    returns them. The trim and the STFT are computed the first time an analyzer asks for them
+    and shared by all the others.
+    """
+
+    def __init__(self, y, sr):
+        self.y = y
+        self.sr = sr
+
+    @classmethod
+    def load(cls, path):
+        y, sr = librosa.load(path, sr=None)
+        return cls(y, sr)
+
+    @classmethod
+    def from_samples(cls, samples, sr):
+        """
+        From int16 samples of shape (frames, channels), as the upload splitter produces them.
+        Gives the same samples as loading the chunk after it was written as a 16-bit WAV.
+        """
+        y = samples.astype(np.float32) / 32768
+        return cls(y.T.mean(axis=0) if y.shape[1] > 1 else y[:, 0], sr)
+
+    @cached_property
+    def trim(self):
+        """(start, end) of the speech, in samples."""
+        _, (start, end) = librosa.effects.trim(self.y, top_db=analysis.TRIM_THRESHOLD_DB)
+        return int(start), int(end)
+
+    @cached_property
+    def magnitude(self):
+        return np.abs(librosa.stft(self.y, n_fft=N_FFT))
+
+
+class QualityAnalyzer:
+    """
+    One check of the quality pipeline. extract() computes the features of a clip that are kept
+    in the feature store, evaluate() turns the features into values of AudioTranscription fields.
+    evaluate() gets the features back from the store, so thresholds can change without decoding again.
+    """
+    name = ''
+    # Change when extract() changes, so the stored features are computed again
+    feature_version = '1'
+    # Change when evaluate() changes, so the results are evaluated again
+    result_version = '1'
+    # Fixed-size features, as (name, dtype) or (name, dtype, shape) like in a NumPy structured dtype
+    fields = []
+    # Names of features of varying length, 1-D float32 arrays
+    arrays = []
+
+    def extract(self, clip):
+        raise NotImplementedError
+
+    def evaluate(self, features):
+        raise NotImplementedError
+
+
+class TailNoiseAnalyzer(QualityAnalyzer):
+    """
+    Breaths and noises after the speech, see analysis.has_tail_noise.
+    """
+    name = 'tail_noise'
+    feature_version = f'1:{analysis.FRAME_DURATION_MS}'
+    result_version = (f'1:{analysis.AMPLITUDE_SILENCE_THRESHOLD}:{analysis.AMPLITUDE_NOISE_THRESHOLD}:'
+                      f'{analysis.CONTEXT_WINDOW_FRAMES}')
+    arrays = ['tail_peaks']
+
+    def extract(self, clip):
+        return {'tail_peaks': analysis.frame_peaks(clip.y[clip.trim[1]:], clip.sr)}
+
+    def evaluate(self, features):
+        return {'is_noisy': analysis.has_tail_noise(features['tail_peaks'])}
+
+
+class ClarityAnalyzer(QualityAnalyzer):
+    """
+    Spread of the spectral contrast, see analysis.clarity_score.
+    """
+    name = 'clarity'
+    result_version = f'1:{analysis.CLARITY_MIN_SECONDS}'
+    fields = [('contrast_mean', '<f8', (analysis.CONTRAST_BANDS,)), ('contrast_std', '<f8', (analysis.CONTRAST_BANDS,))]
+
+    def extract(self, clip):
+        if len(clip.y) < clip.sr * analysis.CLARITY_MIN_SECONDS:
+            return {'contrast_mean': np.nan, 'contrast_std': np.nan}
+        contrast = librosa.feature.spectral_contrast(S=clip.magnitude, sr=clip.sr)
+        return {'contrast_mean': contrast.mean(axis=1), 'contrast_std': contrast.std(axis=1)}
+
+    def evaluate(self, features):
+        return {'clarity_score': analysis.clarity_score(features['frames'], features['sample_rate'], features['contrast_std'])}
+
+
+def get_analyzers(paths=None):
+    """
+    Instantiates the analyzer classes listed in settings.QUALITY['ANALYZERS'], or the given dotted paths.
+    """
+    from django.conf import settings
+    from django.utils.module_loading import import_string
+    return [import_string(path)() for path in (paths or settings.QUALITY['ANALYZERS'])]
+
+
+def extract(clip, analyzers):
+    """
+    Runs every analyzer on one decoded clip and returns all their features, with the shared ones.
+    """
+    start, end = clip.trim
+    features = {
+        'sample_rate': clip.sr,
+        'frames': len(clip.y),
+        'trim_start': start,
+        'trim_end': end,
+        'rms': float(np.sqrt(np.mean(np.square(clip.y, dtype=np.float64)))) if len(clip.y) else 0.0,
+    }
+    for analyzer in analyzers:
+        features.update(analyzer.extract(clip))
+    return features
+
+
+def evaluate(features, analyzers):
+    results = {}
+    for analyzer in analyzers:
+        results.update(analyzer.evaluate(features))
+    return results
+
+
+def features_version(analyzers):
+    return ';'.join([PIPELINE_VERSION, *(f'{analyzer.name}-{analyzer.feature_version}' for analyzer in analyzers)])
+
+
+def results_version(analyzers):
+    versions = ';'.join([features_version(analyzers), *(f'{analyzer.name}-{analyzer.result_version}' for analyzer in analyzers)])
+    # Shortened, so that it fits AudioTranscription.analysis_key with a content hash
+    return hashlib.sha1(versions.encode()).hexdigest()[:16]
+
+
+def analyze_samples(samples, sr, content_hash, analyzers):
+    """
+    Runs the pipeline on a chunk while it is ingested. Returns the AudioTranscription field values,
+    with the analysis_key that lets the batch run skip the chunk.
+    """
+    results = evaluate(extract(Clip.from_samples(samples, sr), analyzers), analyzers)
+    results['analysis_key'] = f'{results_version(analyzers)}:{content_hash}'
+    return results
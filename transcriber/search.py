@@ -0,0 +1,190 @@
+# transcriber/search.py
+
+import re
+from django.db import connections, transaction
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+# SQLite FTS5 index over the transcription, file name and speaker of every audio, with the audio id as rowid,
+# created by migration 0010 when SQLite has FTS5. It is kept in sync by triggers, so bulk_create() and
+# update() are covered too.
+TABLE = 'transcriber_audiosearch'
+AUDIO_TABLE = 'transcriber_audiotranscription'
+SPEAKER_TABLE = 'transcriber_speaker'
+
+# Matches in the transcription count more than in the file name, and those more than in the speaker
+COLUMN_WEIGHTS = (10.0, 5.0, 1.0)
+SNIPPET_TOKENS = 16
+
+# Connection attribute is_available() keeps its answer in
+AVAILABLE_ATTRIBUTE = 'audio_search_available'
+
+# Put around matches by SQLite and replaced with <mark> after the text is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+# The file name without the directories of the storage path
+FILE_NAME_SQL = "replace({0}.audio_file, rtrim({0}.audio_file, replace({0}.audio_file, '/', '')), '')"
+SPEAKER_SQL = f"(SELECT name || ' ' || code FROM {SPEAKER_TABLE} WHERE id = {{0}}.speaker_id)"
+
+
+def _row_sql(alias):
+    return (f"{alias}.id, coalesce({alias}.transcription_text, ''), "
+            f"{FILE_NAME_SQL.format(alias)}, {SPEAKER_SQL.format(alias)}")
+
+
+TRIGGER_SQL = [
+    f"""CREATE TRIGGER {TABLE}_insert AFTER INSERT ON {AUDIO_TABLE} BEGIN
+        INSERT INTO {TABLE}(rowid, transcription_text, file_name, speaker) VALUES ({_row_sql('new')});
+    END""",
+    f"""CREATE TRIGGER {TABLE}_update AFTER UPDATE OF transcription_text, audio_file, speaker_id ON {AUDIO_TABLE} BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id;
+        INSERT INTO {TABLE}(rowid, transcription_text, file_name, speaker) VALUES ({_row_sql('new')});
+    END""",
+    f"""CREATE TRIGGER {TABLE}_delete AFTER DELETE ON {AUDIO_TABLE} BEGIN
+        DELETE FROM {TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER {TABLE}_speaker_update AFTER UPDATE OF name, code ON {SPEAKER_TABLE} BEGIN
+        DELETE FROM {TABLE} WHERE rowid IN (SELECT id FROM {AUDIO_TABLE} WHERE speaker_id = new.id);
+        INSERT INTO {TABLE}(rowid, transcription_text, file_name, speaker)
+            SELECT {_row_sql('audio')} FROM {AUDIO_TABLE} AS audio WHERE audio.speaker_id = new.id;
+    END""",
+]
+
+DROP_TRIGGER_SQL = [
+    f'DROP TRIGGER IF EXISTS {TABLE}_speaker_update',
+    f'DROP TRIGGER IF EXISTS {TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {TABLE}_update',
+    f'DROP TRIGGER IF EXISTS {TABLE}_insert',
+]
+
+
+def install_triggers(connection):
+    """
+    (Re)creates the triggers that keep the index in sync. SQLite alters a table by copying it
+    to a new one, which drops the triggers on it and fails on the ones that refer to it, so
+    the triggers are removed before migrations run and installed again afterwards.
+    """
+    if not is_available(connection):
+        return
+    remove_triggers(connection)
+    with connection.cursor() as cursor:
+        for statement in TRIGGER_SQL:
+            cursor.execute(statement)
+
+
+def remove_triggers(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for statement in DROP_TRIGGER_SQL:
+            cursor.execute(statement)
+
+
+def is_available(connection):
+    """
+    Whether the database has the index. Looked up once per connection to the database, and
+    again after forget_availability(), e.g. once migrations ran.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    available = getattr(connection, AVAILABLE_ATTRIBUTE, None)
+    if available is None:
+        available = TABLE in connection.introspection.table_names()
+        setattr(connection, AVAILABLE_ATTRIBUTE, available)
+    return available
+
+
+def forget_availability(connection):
+    if hasattr(connection, AVAILABLE_ATTRIBUTE):
+        delattr(connection, AVAILABLE_ATTRIBUTE)
+
+
+def rebuild(connection=None):
+    """
+    Refills the index from the audio table and merges its segments. Returns the number of indexed audios.
+    """
+    connection = connection or connections['default']
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        cursor.execute(
+            f'INSERT INTO {TABLE}(rowid, transcription_text, file_name, speaker) '
+            f'SELECT {_row_sql("audio")} FROM {AUDIO_TABLE} AS audio'
+        )
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT count(*) FROM {TABLE}')
+        return cursor.fetchone()[0]
+
+
+def match_expression(query):
+    """
+    Turns what the user typed into an FTS5 query: every word must appear, as a prefix of a word,
+    so results show up while a word is still being typed. Returns '' when there are no words.
+    """
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
+
+
+def search(queryset, query):
+    """
+    Filters an AudioTranscription queryset to the audios matching `query`, best matches first.
+    With the index, every audio gets its `search_rank`; highlight_page() adds the matching parts.
+    """
+    expression = match_expression(query)
+    if not expression or not is_available(connections[queryset.db]):
+        return queryset.filter(
+            Q(transcription_text__icontains=query) |
+            Q(audio_file__icontains=query) |
+            Q(speaker__name__icontains=query) |
+            Q(speaker__code__icontains=query)
+        )
+
+    weights = ', '.join(str(weight) for weight in COLUMN_WEIGHTS)
+    # bm25() only works in the query with the MATCH. SQLite runs it once into a temporary table that
+    # every audio looks its rank up in; LIMIT -1 keeps it from being merged into the lookup, which
+    # would run the MATCH again for every audio.
+    rank = RawSQL(
+        f'SELECT matched.rank FROM (SELECT rowid AS audio_id, bm25({TABLE}, {weights}) AS rank FROM {TABLE} '
+        f'WHERE {TABLE} MATCH %s LIMIT -1) AS matched WHERE matched.audio_id = {AUDIO_TABLE}.id',
+        [expression], output_field=FloatField(),
+    )
+    return queryset.filter(
+        pk__in=RawSQL(f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s', [expression]),
+    ).annotate(search_rank=rank).order_by('search_rank', *queryset.query.order_by)
+
+
+def highlight(text):
+    """
+    Escapes a snippet from highlight_page() and marks its matches with <mark>.
+    """
+    if not text:
+        return ''
+    return mark_safe(escape(text).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>'))
+
+
+def highlight_page(audios, query):
+    """
+    Gives every audio of a page of search() results `search_snippet` and `search_file_name`, the
+    matching part of the transcription and the file name with the matches marked. Only done for
+    the page shown, snippets of every result would take longer than the search.
+    """
+    audios = list(audios)
+    expression = match_expression(query)
+    if not audios or not expression:
+        return
+    connection = connections[audios[0]._state.db]
+    if not is_available(connection):
+        return
+    placeholders = ', '.join(['%s'] * len(audios))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, snippet({TABLE}, 0, %s, %s, '…', {SNIPPET_TOKENS}), highlight({TABLE}, 1, %s, %s) "
+            f"FROM {TABLE} WHERE {TABLE} MATCH %s AND rowid IN ({placeholders})",
+            [MATCH_START, MATCH_END, MATCH_START, MATCH_END, expression, *(audio.pk for audio in audios)],
+        )
+        highlights = {audio_id: (snippet, file_name) for audio_id, snippet, file_name in cursor.fetchall()}
+    for audio in audios:
+        snippet, file_name = highlights.get(audio.pk, ('', ''))
+        audio.search_snippet = highlight(snippet)
+        audio.search_file_name = highlight(file_name)
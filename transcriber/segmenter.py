@@ -0,0 +1,380 @@
+# transcriber/segmenter.py
+
+import math
+import numpy as np
+
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def samples_from_raw(raw_data, sample_width, channels):
+    """
+    Returns PCM bytes as an integer array of shape (frames, channels).
+    """
+    return np.frombuffer(raw_data, dtype=SAMPLE_DTYPES[sample_width]).reshape(-1, channels)
+
+
+def max_possible_amplitude(samples):
+    return float(2 ** (samples.dtype.itemsize * 8) / 2)
+
+
+def length_ms(samples, sample_rate):
+    """
+    Length in milliseconds, rounded the same way as len(AudioSegment).
+    """
+    return round(1000 * (len(samples) / sample_rate))
+
+
+def ms_to_frame(ms, sample_rate):
+    # Same conversion as AudioSegment._parse_position, works on scalars and arrays
+    return (np.asarray(ms, dtype=np.int64) * sample_rate / 1000.0).astype(np.int64)
+
+
+def cumulative_energy(samples):
+    """
+    Cumulative sum of squared samples over all channels, with a leading zero,
+    so the energy of frames [a, b) is energy[b] - energy[a].
+    """
+    wide = samples.astype(np.int64)
+    # Adding the channel columns one by one is much faster than a strided sum(axis=1)
+    squares = wide[:, 0] * wide[:, 0]
+    for channel in range(1, samples.shape[1]):
+        squares += wide[:, channel] * wide[:, channel]
+    return np.concatenate(([0], np.cumsum(squares)))
+
+
+def rms(samples, energy=None):
+    """
+    Integer RMS of all samples, identical to audioop.rms.
+    """
+    if not samples.size:
+        return 0
+    if energy is None:
+        energy = cumulative_energy(samples)
+    return int(math.sqrt(energy[-1] / samples.size))
+
+
+def dbfs(samples, energy=None):
+    value = rms(samples, energy)
+    if not value:
+        return -float('inf')
+    return 20 * math.log(value / max_possible_amplitude(samples), 10)
+
+
+def dbfs_of_blocks(blocks):
+    """
+    dBFS of audio that is read block by block, the same value dbfs returns for the joined blocks.
+    """
+    energy = 0
+    sample_count = 0
+    max_amplitude = None
+    for block in blocks:
+        energy += int(cumulative_energy(block)[-1]) if len(block) else 0
+        sample_count += block.size
+        max_amplitude = max_possible_amplitude(block)
+    value = int(math.sqrt(energy / sample_count)) if sample_count else 0
+    if not value:
+        return -float('inf')
+    return 20 * math.log(value / max_amplitude, 10)
+
+
+def detect_silence(samples, sample_rate, min_silence_len=1000, silence_thresh=-16, seek_step=1, energy=None):
+    """
+    Returns [start, end] millisecond pairs of silent sections, like pydub.silence.detect_silence,
+    but evaluates every window with array operations instead of one slice at a time.
+    """
+    seg_len = length_ms(samples, sample_rate)
+    if seg_len < min_silence_len:
+        return []
+
+    channels = samples.shape[1]
+    threshold = 10 ** (silence_thresh / 20) * max_possible_amplitude(samples)
+    if energy is None:
+        energy = cumulative_energy(samples)
+
+    last_slice_start = seg_len - min_silence_len
+    slice_starts = np.arange(0, last_slice_start + 1, seek_step, dtype=np.int64)
+    if last_slice_start % seek_step:
+        slice_starts = np.append(slice_starts, last_slice_start)
+
+    # Windows that run past the last frame are padded with silence, as AudioSegment slicing does
+    start_frames = ms_to_frame(slice_starts, sample_rate)
+    end_frames = ms_to_frame(slice_starts + min_silence_len, sample_rate)
+    last_frame = len(samples)
+    sums = energy[np.minimum(end_frames, last_frame)] - energy[np.minimum(start_frames, last_frame)]
+    counts = (end_frames - start_frames) * channels
+    with np.errstate(divide='ignore', invalid='ignore'):
+        window_rms = np.where(counts > 0, np.sqrt(sums / np.maximum(counts, 1)), 0).astype(np.int64)
+
+    silence_starts = slice_starts[window_rms <= threshold]
+    if not silence_starts.size:
+        return []
+
+    # Combine starts into ranges, splitting only where the gap is wider than one window
+    steps = np.diff(silence_starts)
+    breaks = np.flatnonzero((steps != seek_step) & (steps > min_silence_len))
+    range_starts = silence_starts[np.concatenate(([0], breaks + 1))]
+    range_ends = silence_starts[np.concatenate((breaks, [silence_starts.size - 1]))] + min_silence_len
+    return [[int(start), int(end)] for start, end in zip(range_starts, range_ends)]
+
+
+def detect_nonsilent(samples, sample_rate, min_silence_len=1000, silence_thresh=-16, seek_step=1, energy=None):
+    """
+    Returns [start, end] millisecond pairs of non-silent sections, like pydub.silence.detect_nonsilent.
+    """
+    silent_ranges = detect_silence(samples, sample_rate, min_silence_len, silence_thresh, seek_step, energy)
+    len_seg = length_ms(samples, sample_rate)
+
+    if not silent_ranges:
+        return [[0, len_seg]]
+
+    if silent_ranges[0][0] == 0 and silent_ranges[0][1] == len_seg:
+        return []
+
+    prev_end_i = 0
+    nonsilent_ranges = []
+    for start_i, end_i in silent_ranges:
+        nonsilent_ranges.append([prev_end_i, start_i])
+        prev_end_i = end_i
+
+    if end_i != len_seg:
+        nonsilent_ranges.append([prev_end_i, len_seg])
+
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+
+    return nonsilent_ranges
+
+
+def split_on_silence(samples, sample_rate, min_silence_len=1000, silence_thresh=-16, keep_silence=100, seek_step=1,
+                     energy=None):
+    """
+    Returns the [start, end] millisecond ranges pydub.silence.split_on_silence would cut
+    the audio into. Use slice_frames to get the samples of each range. Pass the result of
+    cumulative_energy as energy when it was already computed, e.g. for dbfs.
+    """
+    len_seg = length_ms(samples, sample_rate)
+    if isinstance(keep_silence, bool):
+        keep_silence = len_seg if keep_silence else 0
+
+    nonsilent = detect_nonsilent(samples, sample_rate, min_silence_len, silence_thresh, seek_step, energy)
+    if not nonsilent:
+        return []
+
+    ranges = np.array(nonsilent, dtype=np.int64)
+    starts = ranges[:, 0] - keep_silence
+    ends = ranges[:, 1] + keep_silence
+
+    # When the kept silence of two neighbours overlaps, split it evenly between them
+    overlap = starts[1:] < ends[:-1]
+    middle = (ends[:-1] + starts[1:]) // 2
+    ends[:-1] = np.where(overlap, middle, ends[:-1])
+    starts[1:] = np.where(overlap, middle, starts[1:])
+
+    return [[max(int(start), 0), min(int(end), len_seg)] for start, end in zip(starts, ends)]
+
+
+def slice_frames(samples, sample_rate, start_ms, end_ms):
+    """
+    Returns the samples between two millisecond positions, the same frames AudioSegment[start:end] returns.
+    """
+    len_seg = length_ms(samples, sample_rate)
+    start = int(ms_to_frame(min(start_ms, len_seg), sample_rate))
+    end = int(ms_to_frame(min(end_ms, len_seg), sample_rate))
+    chunk = samples[start:end]
+    missing_frames = (end - start) - len(chunk)
+    if missing_frames > 0:
+        chunk = np.concatenate((chunk, np.zeros((missing_frames, samples.shape[1]), dtype=samples.dtype)))
+    return chunk
+
+
+class StreamingSplitter:
+    """
+    Cuts audio that is decoded block by block into the same chunks as split_on_silence, without
+    holding the whole recording in memory.
+
+    Pass every block to feed() and then call finish(). Both return the chunks whose boundaries
+    became known as (index, start_ms, end_ms, samples) tuples, numbered from 1. Only the samples
+    a later chunk may still need are buffered, and chunks longer than max_chunk_ms are returned
+    without samples (None), so memory depends on max_chunk_ms and not on the recording length.
+
+    silence_thresh is in dBFS like for split_on_silence. When it is relative to the loudness of
+    the file, measure that first with dbfs_of_blocks.
+    """
+
+    def __init__(self, sample_rate, channels, min_silence_len=1000, silence_thresh=-16, keep_silence=100,
+                 max_chunk_ms=None, dtype=np.int16):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.min_silence_len = min_silence_len
+        self.keep_silence = keep_silence
+        self.max_chunk_ms = max_chunk_ms
+        self.dtype = np.dtype(dtype)
+        self.threshold = 10 ** (silence_thresh / 20) * float(2 ** (self.dtype.itemsize * 8) / 2)
+
+        self.frames = 0
+        self.total_energy = 0
+        # Cumulative energy at the millisecond boundaries from self._energy_base on
+        self._energy = np.zeros(1, dtype=np.int64)
+        self._energy_base = 0
+        self._next_window = 0
+
+        # The last silent window, and the end of the silent range before the one it belongs to
+        self._last_silent = None
+        self._silence_end = 0
+
+        self._nonsilent = []
+        self._next_start = None
+        self._index = 0
+
+        self._buffer = np.zeros((0, channels), dtype=self.dtype)
+        self._buffer_start = 0
+
+    def feed(self, block):
+        block = np.asarray(block, dtype=self.dtype).reshape(-1, self.channels)
+        if not len(block):
+            return []
+        first_frame = self.frames
+        energy = cumulative_energy(block) + self.total_energy
+        self.frames += len(block)
+        self.total_energy = int(energy[-1])
+        self._buffer = np.concatenate((self._buffer, block))
+
+        known = self._energy_base + len(self._energy)
+        last = self._last_boundary(self.frames)
+        if last >= known:
+            boundaries = np.arange(known, last + 1, dtype=np.int64)
+            self._energy = np.concatenate((self._energy, energy[ms_to_frame(boundaries, self.sample_rate) - first_frame]))
+
+        # A window is only evaluated once it certainly ends before the end of the recording,
+        # windows that may need padding wait for finish()
+        self._evaluate(last - self.min_silence_len - 1)
+        chunks = self._cut()
+        self._trim()
+        return chunks
+
+    def finish(self):
+        len_seg = round(1000 * (self.frames / self.sample_rate))
+        missing = len_seg + 1 - (self._energy_base + len(self._energy))
+        if missing > 0:
+            # Boundaries past the last frame only add silence, as in detect_silence
+            self._energy = np.concatenate((self._energy, np.full(missing, self.total_energy, dtype=np.int64)))
+        self._evaluate(len_seg - self.min_silence_len)
+
+        if self._last_silent is None:
+            self._nonsilent.append([0, len_seg])
+        else:
+            self._silence_end = self._last_silent + self.min_silence_len
+            if self._silence_end != len_seg:
+                self._nonsilent.append([self._silence_end, len_seg])
+        return self._cut(len_seg)
+
+    def _last_boundary(self, frame):
+        # The last millisecond that starts at or before the given frame
+        boundary = (frame + 1) * 1000 // self.sample_rate + 1
+        while ms_to_frame(boundary, self.sample_rate) > frame:
+            boundary -= 1
+        return int(boundary)
+
+    @property
+    def _frontier(self):
+        # The earliest millisecond the next non-silent range can start at
+        if self._last_silent is None:
+            return 0
+        return self._last_silent + self.min_silence_len
+
+    def _evaluate(self, last_start):
+        first_start = self._next_window
+        if last_start < first_start:
+            return
+        starts = np.arange(first_start, last_start + 1, dtype=np.int64)
+        ends = starts + self.min_silence_len
+        sums = self._energy[ends - self._energy_base] - self._energy[starts - self._energy_base]
+        counts = (ms_to_frame(ends, self.sample_rate) - ms_to_frame(starts, self.sample_rate)) * self.channels
+        with np.errstate(divide='ignore', invalid='ignore'):
+            window_rms = np.where(counts > 0, np.sqrt(sums / np.maximum(counts, 1)), 0).astype(np.int64)
+        self._add_silence(starts[window_rms <= self.threshold])
+
+        self._next_window = last_start + 1
+        self._energy = self._energy[self._next_window - self._energy_base:]
+        self._energy_base = self._next_window
+
+    def _add_silence(self, silence_starts):
+        if not silence_starts.size:
+            return
+        if self._last_silent is None:
+            self._start_silence(int(silence_starts[0]))
+        else:
+            silence_starts = np.concatenate(([self._last_silent], silence_starts))
+
+        steps = np.diff(silence_starts)
+        for position in np.flatnonzero((steps != 1) & (steps > self.min_silence_len)):
+            self._silence_end = int(silence_starts[position]) + self.min_silence_len
+            self._start_silence(int(silence_starts[position + 1]))
+        self._last_silent = int(silence_starts[-1])
+
+    def _start_silence(self, start):
+        # The non-silent range before a silence is complete as soon as the silence starts.
+        # Only the very first one can be empty, detect_nonsilent drops it.
+        if start > self._silence_end:
+            self._nonsilent.append([self._silence_end, start])
+
+    def _cut(self, len_seg=None):
+        chunks = []
+        while self._nonsilent:
+            range_start, range_end = self._nonsilent[0]
+            end = range_end + self.keep_silence
+            if len(self._nonsilent) > 1:
+                next_start = self._nonsilent[1][0] - self.keep_silence
+            elif len_seg is not None or self._frontier - self.keep_silence >= end:
+                next_start = None
+            else:
+                # The next range may still start close enough to share the kept silence
+                break
+            overlap = next_start is not None and next_start < end
+            if overlap:
+                end = (end + next_start) // 2
+            if len_seg is None and ms_to_frame(end + 1, self.sample_rate) > self.frames:
+                break
+
+            start = range_start - self.keep_silence if self._next_start is None else self._next_start
+            self._next_start = end if overlap else None
+            self._nonsilent.pop(0)
+            self._index += 1
+
+            start = max(start, 0)
+            if len_seg is not None:
+                start, end = min(start, len_seg), min(end, len_seg)
+            chunks.append((self._index, start, end, self._take(start, end)))
+        return chunks
+
+    def _take(self, start_ms, end_ms):
+        start = int(ms_to_frame(start_ms, self.sample_rate))
+        end = int(ms_to_frame(end_ms, self.sample_rate))
+        if self.max_chunk_ms is not None and round(1000 * ((end - start) / self.sample_rate)) > self.max_chunk_ms:
+            return None
+        chunk = self._buffer[start - self._buffer_start:end - self._buffer_start]
+        missing_frames = (end - start) - len(chunk)
+        if missing_frames > 0:
+            chunk = np.concatenate((chunk, np.zeros((missing_frames, self.channels), dtype=self.dtype)))
+        return chunk.copy()
+
+    def _trim(self):
+        # A chunk starts at most keep_silence before its non-silent range. Ranges that are already
+        # longer than max_chunk_ms (plus rounding) will be dropped, so their samples are not kept.
+        limit = None if self.max_chunk_ms is None else self.max_chunk_ms + 2
+        keep_from = None
+        for range_start, range_end in self._nonsilent:
+            if limit is None or range_end - range_start <= limit:
+                keep_from = range_start - self.keep_silence
+                break
+        if keep_from is None:
+            if limit is not None and self._next_window - self._frontier > limit:
+                keep_from = self._next_window - self.keep_silence
+            else:
+                keep_from = self._frontier - self.keep_silence
+
+        frame = int(ms_to_frame(max(keep_from, 0), self.sample_rate))
+        drop = min(frame - self._buffer_start, len(self._buffer))
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._buffer_start += drop
@@ -0,0 +1,65 @@
+# transcriber/signals.py
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete, pre_migrate, post_migrate
+from django.dispatch import receiver
+from .models import AudioTranscription
+from . import stats, fingerprint, search
+
+
+@receiver(pre_save, sender=AudioTranscription)
+def remember_stored_state(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._stats_state = stats.stored_state(instance)
+
+
+@receiver(post_save, sender=AudioTranscription)
+def update_statistics_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    new_state = stats.current_state(instance)
+    stats.record_change(None if created else instance._stats_state, new_state)
+    # The row now matches the instance, so later saves start from this state
+    instance._loaded_values = {
+        **getattr(instance, '_loaded_values', {}),
+        **{field: getattr(instance, field) for field in stats.STATE_FIELDS},
+    }
+
+
+@receiver(post_save, sender=AudioTranscription)
+def cache_checked_transcription(sender, instance, raw=False, **kwargs):
+    # Checked transcriptions are reused for the same audio when it is uploaded again
+    if not raw and instance.is_checked:
+        fingerprint.remember_transcription(instance.content_hash, instance.transcription_text, is_checked=True)
+
+
+@receiver(post_delete, sender=AudioTranscription)
+def update_statistics_on_delete(sender, instance, **kwargs):
+    stats.record_change(stats.stored_state(instance), None)
+
+
+@receiver(pre_migrate)
+def remove_search_triggers(sender, using, plan=None, **kwargs):
+    # Schema changes on SQLite copy the tables, which the search triggers get in the way of
+    if sender.name == 'transcriber' and plan:
+        search.remove_triggers(connections[using])
+
+
+@receiver(post_migrate)
+def install_search_triggers(sender, using, plan=None, **kwargs):
+    # Rows changed by the migrations were not indexed while the triggers were off
+    if sender.name != 'transcriber' or not plan:
+        return
+    # The migrations may have created or dropped the index
+    search.forget_availability(connections[using])
+    if search.is_available(connections[using]):
+        search.install_triggers(connections[using])
+        search.rebuild(connections[using])
+
+
+@receiver(connection_created)
+def forget_search_availability(sender, connection, **kwargs):
+    # A new connection can be to another database, e.g. the test database
+    search.forget_availability(connection)
@@ -0,0 +1,149 @@
+# transcriber/stats.py
+
+from django.db import transaction
+from django.db.models import Q, F, Case, When, Value, Count, Sum, CharField
+from .models import AudioTranscription, DatasetStatistic
+
+STATE_FIELDS = ('speaker_id', 'is_checked', 'transcription_text', 'duration_ms')
+
+
+def state_from_values(values):
+    """
+    Returns the (speaker_id, status, duration_ms) triple the statistics are keyed by,
+    from a dict of AudioTranscription field values.
+    """
+    status = AudioTranscription.status_from_values(values['is_checked'], values['transcription_text'])
+    return values['speaker_id'], status, values['duration_ms'] or 0
+
+
+def current_state(audio):
+    return state_from_values({field: getattr(audio, field) for field in STATE_FIELDS})
+
+
+def stored_state(audio):
+    """
+    Returns the state of the row as it is in the database, or None for unsaved records.
+    """
+    loaded_values = getattr(audio, '_loaded_values', None)
+    if loaded_values is not None and all(field in loaded_values for field in STATE_FIELDS):
+        return state_from_values(loaded_values)
+    if audio.pk is None:
+        return None
+    values = AudioTranscription.objects.filter(pk=audio.pk).values(*STATE_FIELDS).first()
+    return state_from_values(values) if values else None
+
+
+def apply_delta(speaker_id, status, count, duration_ms):
+    """
+    Adds count and duration to a single (speaker, status) counter.
+    """
+    if not count and not duration_ms:
+        return
+    counters = DatasetStatistic.objects.filter(speaker_id=speaker_id, status=status)
+    changes = {'audio_count': F('audio_count') + count, 'duration_ms': F('duration_ms') + duration_ms}
+    if not counters.update(**changes):
+        DatasetStatistic.objects.get_or_create(speaker_id=speaker_id, status=status)
+        counters.update(**changes)
+
+
+def record_change(old_state, new_state):
+    """
+    Moves a record from one counter to another. Either state may be None
+    for created or deleted records.
+    """
+    if old_state == new_state:
+        return
+    if old_state is not None:
+        speaker_id, status, duration_ms = old_state
+        apply_delta(speaker_id, status, -1, -duration_ms)
+    if new_state is not None:
+        speaker_id, status, duration_ms = new_state
+        apply_delta(speaker_id, status, 1, duration_ms)
+
+
+def record_created(audios):
+    """
+    Counts records that were inserted without signals, e.g. with bulk_create.
+    """
+    totals = {}
+    for audio in audios:
+        speaker_id, status, duration_ms = current_state(audio)
+        count, total_duration = totals.get((speaker_id, status), (0, 0))
+        totals[(speaker_id, status)] = (count + 1, total_duration + duration_ms)
+    for (speaker_id, status), (count, duration_ms) in totals.items():
+        apply_delta(speaker_id, status, count, duration_ms)
+
+
+def status_expression():
+    """
+    SQL equivalent of AudioTranscription.transcription_status.
+    """
+    return Case(
+        When(is_checked=True, then=Value(AudioTranscription.STATUS_CHECKED)),
+        When(Q(transcription_text__isnull=True) | Q(transcription_text__exact=''),
+             then=Value(AudioTranscription.STATUS_UNTRANSCRIBED)),
+        default=Value(AudioTranscription.STATUS_DRAFT),
+        output_field=CharField(),
+    )
+
+
+@transaction.atomic
+def rebuild():
+    """
+    Recomputes every counter from the audio table. Use it to fix drift after
+    bulk operations that bypass model signals.
+    """
+    rows = (
+        AudioTranscription.objects
+        .annotate(stat_status=status_expression())
+        .values('speaker_id', 'stat_status')
+        .annotate(audio_count=Count('id'), total_ms=Sum('duration_ms', default=0))
+        .order_by()
+    )
+    DatasetStatistic.objects.all().delete()
+    DatasetStatistic.objects.bulk_create([
+        DatasetStatistic(
+            speaker_id=row['speaker_id'],
+            status=row['stat_status'],
+            audio_count=row['audio_count'],
+            duration_ms=row['total_ms'],
+        )
+        for row in rows
+    ])
+
+
+def count(statuses=None, speaker_id=None):
+    """
+    Number of audios with one of the statuses and of the speaker, from the counters.
+    """
+    counters = DatasetStatistic.objects.all()
+    if statuses is not None:
+        counters = counters.filter(status__in=statuses)
+    if speaker_id is not None:
+        counters = counters.filter(speaker_id=speaker_id)
+    return counters.aggregate(total=Sum('audio_count', default=0))['total']
+
+
+def get_summary():
+    """
+    Returns totals overall, per status and per speaker. Reads one row per
+    (speaker, status) pair, so the cost does not depend on the number of audios.
+    """
+    empty = lambda: {'count': 0, 'duration_ms': 0}
+    summary = {
+        'total': empty(),
+        'by_status': {status: empty() for status, _ in AudioTranscription.STATUS_CHOICES},
+        'by_speaker': {},
+    }
+    for statistic in DatasetStatistic.objects.select_related('speaker').order_by('speaker__code'):
+        speaker = summary['by_speaker'].setdefault(statistic.speaker.code, {
+            'id': statistic.speaker_id,
+            'name': statistic.speaker.name,
+            'total': empty(),
+            'by_status': {status: empty() for status, _ in AudioTranscription.STATUS_CHOICES},
+        })
+        for bucket in (summary['total'], summary['by_status'][statistic.status],
+                       speaker['total'], speaker['by_status'][statistic.status]):
+            bucket['count'] += statistic.audio_count
+            bucket['duration_ms'] += statistic.duration_ms
+    return summary
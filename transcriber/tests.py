@@ -1,3 +1,491 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import glob
+import io
+import json
+import os
+import shutil
+import tempfile
+import types
+import zipfile
+from unittest import mock
+import numpy as np
+import soundfile
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from pydub import AudioSegment, silence
+from transcriber import annotations, features, jobs, media, segmenter, stats, transcription
+from transcriber.models import AudioTranscription, Speaker
+from transcriber.benchmarks import build_recording
 
-# Create your tests here.
+# (min_silence_len, silence_thresh offset from the file dBFS, keep_silence)
+PARAMETER_SETS = [
+    (350, -35, 350),    # the values split_audio uses
+    (1000, -16, 100),   # pydub defaults
+    (200, -20, 0),
+]
+
+
+class SegmenterTests(TestCase):
+    """
+    The NumPy segmenter, on the whole recording and streamed block by block, must cut the
+    sample recordings exactly where pydub.silence does.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        paths = sorted(glob.glob(os.path.join(settings.BASE_DIR, 'audios_for_analysis', '*.wav')))
+        cls.recordings = [(os.path.basename(path), AudioSegment.from_file(path)) for path in paths]
+        if cls.recordings:
+            # Overlapping keep_silence margins and faint noise in the silences
+            segments = [audio for _, audio in cls.recordings]
+            joined = build_recording(segments, [150, 900, 360, 2000], noise_level=3)
+            cls.recordings.append(('joined', joined))
+
+    def setUp(self):
+        if not self.recordings:
+            self.skipTest('No sample recordings in audios_for_analysis/.')
+
+    def test_nonsilent_ranges_match_pydub(self):
+        for name, audio in self.recordings:
+            samples = segmenter.samples_from_raw(audio.raw_data, audio.sample_width, audio.channels)
+            for min_silence_len, offset, _ in PARAMETER_SETS:
+                with self.subTest(recording=name, min_silence_len=min_silence_len, offset=offset):
+                    expected = silence.detect_nonsilent(
+                        audio, min_silence_len=min_silence_len, silence_thresh=audio.dBFS + offset)
+                    actual = segmenter.detect_nonsilent(
+                        samples, audio.frame_rate, min_silence_len=min_silence_len,
+                        silence_thresh=segmenter.dbfs(samples) + offset)
+                    self.assertEqual([list(r) for r in actual], [list(r) for r in expected])
+
+    def test_chunks_match_pydub(self):
+        for name, audio in self.recordings:
+            samples = segmenter.samples_from_raw(audio.raw_data, audio.sample_width, audio.channels)
+            for min_silence_len, offset, keep_silence in PARAMETER_SETS:
+                params = {'min_silence_len': min_silence_len, 'keep_silence': keep_silence}
+                expected = [chunk.raw_data for chunk in silence.split_on_silence(
+                    audio, silence_thresh=audio.dBFS + offset, **params)]
+                silence_thresh = segmenter.dbfs(samples) + offset
+
+                with self.subTest(recording=name, params=params, offset=offset, method='whole'):
+                    ranges = segmenter.split_on_silence(samples, audio.frame_rate, silence_thresh=silence_thresh, **params)
+                    chunks = [segmenter.slice_frames(samples, audio.frame_rate, start, end).tobytes() for start, end in ranges]
+                    self.assertEqual(len(chunks), len(expected))
+                    self.assertTrue(chunks == expected)
+
+                for block_frames in (1000, 4096, 65536):
+                    with self.subTest(recording=name, params=params, offset=offset, block_frames=block_frames):
+                        splitter = segmenter.StreamingSplitter(
+                            audio.frame_rate, samples.shape[1], dtype=samples.dtype,
+                            silence_thresh=silence_thresh, **params)
+                        streamed = []
+                        for position in range(0, len(samples), block_frames):
+                            streamed += splitter.feed(samples[position:position + block_frames])
+                        streamed += splitter.finish()
+                        chunks = [chunk_samples.tobytes() for _, _, _, chunk_samples in streamed]
+                        self.assertEqual(len(chunks), len(expected))
+                        self.assertTrue(chunks == expected)
+
+
+class MediaTests(TestCase):
+
+    def test_shard_is_that_of_the_stored_name(self):
+        name = media.audio_upload_to(None, "uploads/book one's_0001.wav")
+        self.assertEqual(name, f'wavs/{media.shard("book_ones_0001.wav")}/book_ones_0001.wav')
+        self.assertEqual(media.sharded_name(name.rsplit('/', 1)[1]), name)
+
+
+class StatusTests(TestCase):
+
+    def test_status_rules_agree(self):
+        speaker = Speaker.objects.create(code='s1', name='Speaker')
+        for is_checked in (False, True):
+            for text in (None, '', 'text'):
+                AudioTranscription.objects.create(audio_file=f'wavs/00/{is_checked}{text}.wav', speaker=speaker,
+                                                  is_checked=is_checked, transcription_text=text)
+        audios = AudioTranscription.objects.annotate(expected=stats.status_expression())
+        self.assertEqual({audio.status for audio in audios}, {
+            AudioTranscription.STATUS_UNTRANSCRIBED, AudioTranscription.STATUS_DRAFT, AudioTranscription.STATUS_CHECKED})
+        for audio in audios:
+            with self.subTest(is_checked=audio.is_checked, text=audio.transcription_text):
+                self.assertEqual(audio.status, audio.expected)
+                self.assertEqual(stats.current_state(audio)[1], audio.expected)
+                self.assertEqual(stats.stored_state(audio)[1], audio.expected)
+
+
+class FeatureStoreTests(SimpleTestCase):
+
+    def test_unchanged_clips_are_not_extracted_again(self):
+        samples = sorted(glob.glob(os.path.join(settings.BASE_DIR, 'audios_for_analysis', '*.wav')))
+        if not samples:
+            self.skipTest('No sample recordings in audios_for_analysis/.')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # Keys longer than the index field once were cut, and never matched again
+        clips = [(1, samples[0], 'f' * 200)]
+        self.assertEqual(features.FeatureStore(directory).update(clips), (1, 0, 0))
+        store = features.FeatureStore(directory)
+        self.assertEqual(store.update(clips), (0, 1, 0))
+        self.assertEqual(store.index['key'][0], features.index_key(store.version, samples[0], 'f' * 200))
+        store.close()
+
+
+class BuildArchiveTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name, path):
+        speaker, _ = Speaker.objects.get_or_create(code='s1', defaults={'name': 'Speaker'})
+        with open(path, 'rb') as f:
+            job = jobs.enqueue_upload(SimpleUploadedFile(name, f.read()), speaker)
+        jobs.claim_next_job('test')
+        jobs.process_upload_job(job.pk)
+
+    def test_csv_of_uploaded_clips(self):
+        samples = sorted(glob.glob(os.path.join(settings.BASE_DIR, 'audios_for_analysis', '*.wav')))
+        if len(samples) < 2:
+            self.skipTest('Needs two sample recordings in audios_for_analysis/.')
+        # Stored as book_one_0001.wav, then book_one_0001_<suffix>.wav once the name is taken
+        self.upload('book one.wav', samples[0])
+        self.upload('book one.wav', samples[1])
+        # Stored before the shard was taken from the saved name
+        legacy = AudioTranscription.objects.order_by('pk').first()
+        legacy_name = 'wavs/00/book_one_0009.wav'
+        os.makedirs(os.path.join(self.media_root, 'wavs', '00'))
+        shutil.copy(legacy.audio_file.path, os.path.join(self.media_root, legacy_name))
+        AudioTranscription.objects.create(audio_file=legacy_name, speaker=legacy.speaker, duration_ms=legacy.duration_ms)
+
+        stored = list(AudioTranscription.objects.order_by('pk').values_list('audio_file', flat=True))
+        names = [os.path.basename(name) for name in stored]
+        self.assertEqual(len(names), 3)
+        self.assertNotEqual(names[0], names[1])
+        listing = os.path.join(self.media_root, 'list.csv')
+        with open(listing, 'w', encoding='utf-8') as f:
+            f.write('file_name\n' + '\n'.join(reversed(names)) + '\n')
+
+        output = os.path.join(self.media_root, 'archive.zip')
+        call_command('build_archive', output, '--csv', listing, stdout=io.StringIO())
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(archive.namelist(), list(reversed(names)))
+            for name, stored_name in zip(names, stored):
+                with open(os.path.join(self.media_root, stored_name), 'rb') as f:
+                    self.assertEqual(archive.read(name), f.read())
+
+
+class SaveTranscriptionTests(TestCase):
+
+    def setUp(self):
+        speaker = Speaker.objects.create(code='s1', name='Speaker')
+        self.audio = AudioTranscription.objects.create(audio_file='wavs/00/a.wav', speaker=speaker, duration_ms=1000)
+        self.user = User.objects.create_user('annotator', password='password')
+        self.client.force_login(self.user)
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_single_edit_views_need_a_login(self):
+        self.client.logout()
+        for url in (reverse('save_transcription'), reverse('finish_audio')):
+            response = self.post(url, {'audio_id': self.audio.pk, 'transcription': 'text'})
+            self.assertEqual(response.status_code, 302, url)
+        self.audio.refresh_from_db()
+        self.assertIsNone(self.audio.transcription_text)
+
+    def test_single_edit_views_return_404_for_an_unknown_audio(self):
+        for url in (reverse('save_transcription'), reverse('finish_audio')):
+            response = self.post(url, {'audio_id': self.audio.pk + 1, 'transcription': 'text'})
+            self.assertEqual(response.status_code, 404, url)
+
+    def test_single_edit_views_reject_malformed_requests(self):
+        for url in (reverse('save_transcription'), reverse('finish_audio')):
+            self.assertEqual(self.client.post(url, 'not json', content_type='application/json').status_code, 400)
+            self.assertEqual(self.post(url, ['not', 'an', 'object']).status_code, 400)
+            self.assertEqual(self.post(url, {'audio_id': 'x'}).status_code, 400)
+
+    def test_single_edit_conflict(self):
+        response = self.post(reverse('save_transcription'), {'audio_id': self.audio.pk, 'transcription': 'first', 'version': 0})
+        self.assertEqual(response.json()['version'], 1)
+        response = self.post(reverse('finish_audio'), {'audio_id': self.audio.pk, 'transcription': 'stale', 'version': 0})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['transcription'], 'first')
+
+    def test_batch_save(self):
+        other = AudioTranscription.objects.create(audio_file='wavs/00/b.wav', speaker=self.audio.speaker, duration_ms=1000)
+        response = self.post(reverse('save_transcriptions'), {'edits': [
+            {'audio_id': self.audio.pk, 'transcription': 'one', 'version': 0},
+            {'audio_id': other.pk, 'transcription': 'two', 'finish': True, 'version': 0},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'success', 'results': [
+            {'audio_id': self.audio.pk, 'result': annotations.RESULT_SAVED, 'version': 1},
+            {'audio_id': other.pk, 'result': annotations.RESULT_SAVED, 'version': 1},
+        ]})
+        self.audio.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.audio.transcription_text, self.audio.is_checked, self.audio.version), ('one', False, 1))
+        self.assertEqual((other.transcription_text, other.is_checked, other.status), ('two', True, AudioTranscription.STATUS_CHECKED))
+
+    def test_batch_save_partial(self):
+        self.post(reverse('save_transcriptions'), {'edits': [{'audio_id': self.audio.pk, 'transcription': 'theirs', 'version': 0}]})
+        other = AudioTranscription.objects.create(audio_file='wavs/00/b.wav', speaker=self.audio.speaker, duration_ms=1000)
+        response = self.post(reverse('save_transcriptions'), {'edits': [
+            {'audio_id': self.audio.pk, 'transcription': 'mine', 'finish': True, 'version': 0},
+            {'audio_id': other.pk, 'transcription': 'two', 'version': 0},
+            {'audio_id': other.pk + 1, 'transcription': 'gone', 'version': 0},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'partial', 'results': [
+            {'audio_id': self.audio.pk, 'result': annotations.RESULT_CONFLICT, 'version': 1,
+             'transcription': 'theirs', 'is_checked': False},
+            {'audio_id': other.pk, 'result': annotations.RESULT_SAVED, 'version': 1},
+            {'audio_id': other.pk + 1, 'result': annotations.RESULT_NOT_FOUND},
+        ]})
+        # The conflicting edit wrote nothing, not even the version
+        self.audio.refresh_from_db()
+        self.assertEqual((self.audio.transcription_text, self.audio.is_checked, self.audio.version), ('theirs', False, 1))
+
+    def test_edits_without_version_are_applied(self):
+        annotations.apply_edits([(self.audio.pk, 'first', False, 0)])
+        [result] = annotations.apply_edits([(self.audio.pk, 'second', False, None)])
+        self.assertEqual((result['result'], result['version']), (annotations.RESULT_SAVED, 2))
+        self.audio.refresh_from_db()
+        self.assertEqual((self.audio.transcription_text, self.audio.version), ('second', 2))
+
+    def test_duplicate_edits_are_merged(self):
+        edits = annotations.parse_edits([
+            {'audio_id': self.audio.pk, 'transcription': 'first', 'finish': True, 'version': 0},
+            {'audio_id': self.audio.pk, 'transcription': 'last', 'version': 0},
+        ])
+        self.assertEqual(edits, [(self.audio.pk, 'last', True, 0)])
+        [result] = annotations.apply_edits(edits)
+        self.assertEqual(result['result'], annotations.RESULT_SAVED)
+        self.audio.refresh_from_db()
+        self.assertEqual((self.audio.transcription_text, self.audio.is_checked), ('last', True))
+
+    def test_batch_save_rejects_malformed_requests(self):
+        self.assertEqual(self.post(reverse('save_transcriptions'), {'edits': 'x'}).status_code, 400)
+        self.assertEqual(self.post(reverse('save_transcriptions'), {'edits': [{'audio_id': 'x'}]}).status_code, 400)
+        too_many = [{'audio_id': self.audio.pk}] * (annotations.MAX_BATCH_SIZE + 1)
+        self.assertEqual(self.post(reverse('save_transcriptions'), {'edits': too_many}).status_code, 400)
+
+
+class CountingBackend(transcription.FakeBackend):
+    """
+    FakeBackend that answers every request and counts them.
+    """
+
+    def __init__(self):
+        super().__init__(latency=0.01)
+        self.requests = 0
+
+    async def transcribe(self, audio, mime_type, api_key):
+        self.requests += 1
+        return await super().transcribe(audio, mime_type, api_key)
+
+
+class FlakyBackend(transcription.TranscriptionBackend):
+    """
+    Raises the given errors one after another, then answers.
+    """
+    requires_api_key = False
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.keys = []
+
+    async def transcribe(self, audio, mime_type, api_key):
+        self.keys.append(api_key)
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'text'
+
+
+class FakeClock:
+    """
+    Stands in for time.monotonic() and asyncio.sleep(), sleeping only moves the clock.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+# The engine saves from the thread sync_to_async runs in, which cannot see the data of a
+# test wrapped in a transaction
+class TranscriptionEngineTests(TransactionTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.speaker = Speaker.objects.create(code='s1', name='Speaker')
+
+    def create_audios(self, count):
+        os.makedirs(os.path.join(self.media_root, 'wavs', '00'))
+        rng = np.random.default_rng(0)
+        for i in range(count):
+            name = f'wavs/00/clip_{i:04d}.wav'
+            soundfile.write(os.path.join(self.media_root, name), rng.uniform(-0.5, 0.5, 8000), 16000)
+            AudioTranscription.objects.create(audio_file=name, speaker=self.speaker, duration_ms=500)
+
+    def test_parallel_engines_transcribe_every_clip_once(self):
+        self.create_audios(12)
+        backend = CountingBackend()
+        engines = [transcription.TranscriptionEngine(backend=backend, concurrency=4, requests_per_minute=0,
+                                                     backoff_seconds=0) for _ in range(2)]
+
+        async def run_both():
+            return await asyncio.gather(*(engine.run_async() for engine in engines))
+
+        runs = asyncio.run(run_both())
+        self.assertEqual(backend.requests, 12)
+        self.assertEqual(sum(len(metrics.latencies) for metrics in runs), 12)
+        self.assertEqual(sum(metrics.skipped + metrics.failed for metrics in runs), 0)
+        self.assertFalse(transcription.untranscribed_audios().exists())
+        self.assertFalse(AudioTranscription.objects.exclude(transcription_worker='').exists())
+
+    def test_failed_clips_keep_their_lease(self):
+        self.create_audios(2)
+        backend = FlakyBackend([transcription.TranscriptionError('Rejected.', retryable=False)])
+        metrics = transcription.TranscriptionEngine(backend=backend, concurrency=1, requests_per_minute=0).run()
+        self.assertEqual((len(metrics.latencies), metrics.failed), (1, 1))
+        failed = transcription.untranscribed_audios().get()
+        self.assertIsNotNone(failed.transcription_lease_until)
+        self.assertIsNone(transcription.claim_audio('other', 60))
+
+
+class ClaimAudioTests(TestCase):
+
+    def setUp(self):
+        speaker = Speaker.objects.create(code='s1', name='Speaker')
+        self.audios = [
+            AudioTranscription.objects.create(audio_file=f'wavs/00/{i}.wav', speaker=speaker, duration_ms=1000)
+            for i in range(2)
+        ]
+
+    def test_a_leased_clip_is_not_claimed_again(self):
+        first = transcription.claim_audio('a', 60)
+        second = transcription.claim_audio('b', 60)
+        self.assertEqual([first.pk, second.pk], [audio.pk for audio in self.audios])
+        self.assertEqual(second.transcription_worker, 'b')
+        self.assertIsNone(transcription.claim_audio('c', 60))
+
+    def test_an_expired_lease_is_taken_over(self):
+        transcription.claim_audio('a', 60)
+        AudioTranscription.objects.filter(pk=self.audios[0].pk).update(
+            transcription_lease_until=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(transcription.claim_audio('b', 60).pk, self.audios[0].pk)
+        # The worker that lost the lease cannot save any more
+        self.assertFalse(transcription.save_transcription(self.audios[0].pk, 'a', 'late'))
+        self.assertTrue(transcription.save_transcription(self.audios[0].pk, 'b', 'text'))
+        self.audios[0].refresh_from_db()
+        self.assertEqual((self.audios[0].transcription_text, self.audios[0].transcription_worker), ('text', ''))
+
+    def test_clips_leased_by_an_annotator_are_skipped(self):
+        AudioTranscription.objects.filter(pk=self.audios[0].pk).update(
+            annotation_lease_until=timezone.now() + datetime.timedelta(minutes=5))
+        self.assertEqual(transcription.claim_audio('a', 60).pk, self.audios[1].pk)
+        self.assertIsNone(transcription.claim_audio('b', 60))
+
+
+class RequestTranscriptionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        for name, value in (('asyncio', types.SimpleNamespace(sleep=self.clock.sleep)),
+                            ('random', types.SimpleNamespace(uniform=lambda low, high: 1))):
+            patcher = mock.patch.object(transcription, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.retries = []
+
+    def request(self, backend, max_retries=3):
+        async def acquire_key():
+            return 'key'
+
+        return asyncio.run(transcription.request_transcription(
+            backend, b'audio', 'audio/flac', acquire_key, max_retries, 2, on_retry=self.retries.append))
+
+    def test_retryable_errors_are_retried_with_backoff(self):
+        errors = [transcription.TranscriptionError('Busy.'), transcription.TranscriptionError('Busy.')]
+        self.assertEqual(self.request(FlakyBackend(errors)), ('text', 3))
+        self.assertEqual(self.clock.sleeps, [2, 4])
+        self.assertEqual(len(self.retries), 2)
+
+    def test_other_errors_are_not_retried(self):
+        backend = FlakyBackend([transcription.TranscriptionError('Rejected.', retryable=False)])
+        with self.assertRaisesMessage(transcription.TranscriptionError, 'Rejected.'):
+            self.request(backend)
+        self.assertEqual((len(backend.keys), self.clock.sleeps), (1, []))
+
+    def test_gives_up_after_max_retries(self):
+        backend = FlakyBackend([transcription.TranscriptionError(f'Busy {i}.') for i in range(5)])
+        with self.assertRaisesMessage(transcription.TranscriptionError, 'Busy 2.'):
+            self.request(backend, max_retries=2)
+        self.assertEqual(len(backend.keys), 3)
+        self.assertEqual(self.clock.sleeps, [2, 4])
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        for name, value in (('time', types.SimpleNamespace(monotonic=self.clock.monotonic)),
+                            ('asyncio', types.SimpleNamespace(sleep=self.clock.sleep))):
+            patcher = mock.patch.object(transcription, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        bucket = transcription.TokenBucket(rate=2, capacity=2)
+        for _ in range(2):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+        self.assertEqual(bucket.delay(), 0.5)
+        self.clock.now += 0.25
+        self.assertEqual(bucket.delay(), 0.25)
+        # Idle time does not add up beyond the burst
+        self.clock.now += 10
+        self.assertEqual((bucket.delay(), bucket.tokens), (0, 2))
+
+    def test_token_bucket_without_rate(self):
+        bucket = transcription.TokenBucket(rate=None)
+        for _ in range(10):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+
+    def test_key_pool_limits_every_key(self):
+        pool = transcription.KeyPool(['a', 'b'], requests_per_minute=60)
+
+        async def acquire(count):
+            acquired = []
+            for _ in range(count):
+                key = await pool.acquire()
+                acquired.append((key, self.clock.now))
+            return acquired
+
+        acquired = asyncio.run(acquire(6))
+        # One request per second and key, both keys used in turn
+        self.assertEqual(sorted(key for key, _ in acquired), ['a', 'a', 'a', 'b', 'b', 'b'])
+        self.assertEqual([now for _, now in acquired], [0, 0, 1, 1, 2, 2])
+        self.assertNotEqual(acquired[0][0], acquired[1][0])
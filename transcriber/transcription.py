@@ -0,0 +1,474 @@
+# transcriber/transcription.py
+
+import asyncio
+import datetime
+import io
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+import numpy as np
+import soundfile
+import soxr
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import AudioTranscription
+from .jobs import worker_name
+from . import fingerprint
+
+DEFAULT_PROMPT = (
+    "This is a Karakalpak audio. Create a transcription of the speech "
+    "in the Karakalpak language and the Latin alphabet."
+)
+
+
+class TranscriptionError(Exception):
+    """
+    Raised by backends. Errors that are not retryable, like a rejected request, are not tried again.
+    """
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class TranscriptionBackend:
+    """
+    Interface of a speech-to-text service. transcribe() receives the encoded audio
+    with its MIME type and an API key, and returns the transcription.
+    """
+    requires_api_key = True
+
+    async def transcribe(self, audio, mime_type, api_key):
+        raise NotImplementedError
+
+
+class GeminiBackend(TranscriptionBackend):
+    def __init__(self, model='gemini-2.5-pro', prompt=DEFAULT_PROMPT):
+        self.model = model
+        self.prompt = prompt
+        self._clients = {}
+
+    async def transcribe(self, audio, mime_type, api_key):
+        from google import genai
+        from google.genai import errors, types
+
+        client = self._clients.get(api_key)
+        if client is None:
+            client = self._clients[api_key] = genai.Client(api_key=api_key)
+        try:
+            # Chunks are at most 25 s long, small enough to send inline instead of uploading them first
+            response = await client.aio.models.generate_content(
+                model=self.model, contents=[self.prompt, types.Part.from_bytes(data=audio, mime_type=mime_type)]
+            )
+        except errors.APIError as e:
+            # Rate limits, timeouts and server errors are worth another try, other client errors are not.
+            # Errors without a status code never got an answer from the server, so they are retried too
+            code = e.code
+            raise TranscriptionError(str(e), retryable=code is None or code in (408, 429) or code >= 500) from e
+
+        text = (response.text or '').strip()
+        if not text:
+            raise TranscriptionError('The response contained no text.')
+        return text
+
+
+class FakeBackend(TranscriptionBackend):
+    """
+    Local stand-in for tests and load checks. Answers after `latency` seconds
+    and fails the given share of requests.
+    """
+    requires_api_key = False
+
+    def __init__(self, latency=0.05, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    async def transcribe(self, audio, mime_type, api_key):
+        await asyncio.sleep(self.latency)
+        if self._random.random() < self.failure_rate:
+            raise TranscriptionError('Simulated failure.')
+        return f'Fake transcription of {len(audio)} bytes of {mime_type}.'
+
+
+def get_backend(backend=None, options=None):
+    """
+    Instantiates the backend class named in settings.TRANSCRIPTION, or the given dotted path.
+    """
+    config = settings.TRANSCRIPTION
+    if options is None:
+        options = config.get('OPTIONS', {}) if backend is None else {}
+    return import_string(backend or config['BACKEND'])(**options)
+
+
+def get_api_keys(backend, keys=None):
+    """
+    Returns the given keys or the configured ones, [None] for backends that do not need any.
+    """
+    keys = list(settings.TRANSCRIPTION.get('API_KEYS', []) if keys is None else keys)
+    if not keys:
+        if backend.requires_api_key:
+            raise ImproperlyConfigured('No transcription API keys are configured, set GEMINI_API_KEYS.')
+        keys = [None]
+    return keys
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average, with bursts of up to `capacity`.
+    A rate of None means no limit.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """
+        Seconds until a request may be sent.
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class KeyPool:
+    """
+    Rate limits every API key separately. acquire() returns whichever key is free first.
+    The pool can be shared by event loops in several threads, like the requests of the
+    transcribe button.
+    """
+
+    def __init__(self, keys, requests_per_minute=None, burst=1):
+        rate = requests_per_minute / 60 if requests_per_minute else None
+        self.buckets = {key: TokenBucket(rate, burst) for key in keys}
+        # Only held while no coroutine awaits, so a thread lock also serves coroutines of one loop
+        self._lock = threading.Lock()
+
+    async def acquire(self):
+        while True:
+            with self._lock:
+                key, bucket = min(self.buckets.items(), key=lambda item: item[1].delay())
+                wait = bucket.delay()
+                if wait <= 0:
+                    bucket.take()
+                    return key
+            await asyncio.sleep(wait)
+
+
+def untranscribed_audios():
+    return AudioTranscription.objects.filter(status=AudioTranscription.STATUS_UNTRANSCRIBED)
+
+
+def claim_audio(worker, lease_seconds):
+    """
+    Leases the oldest untranscribed clip that nobody else holds to the worker and returns it,
+    or None when there is none left. The conditional update makes sure two workers never
+    claim the same clip.
+    """
+    now = timezone.now()
+    available = untranscribed_audios().filter(
+        Q(transcription_lease_until__isnull=True) | Q(transcription_lease_until__lt=now),
+        # Clips an annotator is working on are left to them
+        Q(annotation_lease_until__isnull=True) | Q(annotation_lease_until__lt=now),
+    )
+    while True:
+        audio_id = available.order_by('pk').values_list('pk', flat=True).first()
+        if audio_id is None:
+            return None
+        claimed = available.filter(pk=audio_id).update(
+            transcription_worker=worker,
+            transcription_lease_until=now + datetime.timedelta(seconds=lease_seconds),
+        )
+        if claimed:
+            return AudioTranscription.objects.get(pk=audio_id)
+
+
+def save_transcription(audio_id, worker, text, cache=True):
+    """
+    Stores the text and releases the lease, and adds it to the transcription cache unless
+    cache is False. Returns False without storing anything when the lease was lost or
+    somebody typed a transcription in the meantime.
+    """
+    with transaction.atomic():
+        audio = AudioTranscription.objects.filter(pk=audio_id, transcription_worker=worker).first()
+        if audio is None or audio.transcription_text:
+            return False
+        audio.transcription_text = text
+        audio.transcription_worker = ''
+        audio.transcription_lease_until = None
+        # A new version, so an annotator saving over the empty text gets a conflict
+        audio.version += 1
+        # save() rather than update() so the statistics follow the status change
+        audio.save(update_fields=['transcription_text', 'transcription_worker', 'transcription_lease_until', 'version'])
+        if cache:
+            fingerprint.remember_transcription(audio.content_hash, text)
+    return True
+
+
+AUDIO_FORMATS = {
+    # format: (soundfile format, subtype, MIME type)
+    'flac': ('FLAC', 'PCM_16', 'audio/flac'),
+    'opus': ('OGG', 'OPUS', 'audio/ogg'),
+    'wav': ('WAV', 'PCM_16', 'audio/wav'),
+}
+
+
+def encode_payload(audio_file, audio_format='flac', sample_rate=16000, peak_db=None):
+    """
+    Re-encodes a clip as mono at the given sample rate in a compact format, which is all
+    a speech model needs and a fraction of the size of the stored WAV. With `peak_db`, the
+    clip is also scaled so its loudest sample is at that level in dBFS.
+    Returns the encoded bytes and their MIME type.
+    """
+    file_format, subtype, mime_type = AUDIO_FORMATS[audio_format]
+    samples, source_rate = soundfile.read(audio_file, dtype='float32', always_2d=True)
+    mono = samples.mean(axis=1)
+    if sample_rate and source_rate != sample_rate:
+        mono = soxr.resample(mono, source_rate, sample_rate)
+    else:
+        sample_rate = source_rate
+    if peak_db is not None:
+        peak = np.abs(mono).max(initial=0)
+        if peak > 0:
+            mono = mono * (10 ** (peak_db / 20) / peak)
+    encoded = io.BytesIO()
+    soundfile.write(encoded, np.clip(mono, -1, 1), sample_rate, format=file_format, subtype=subtype)
+    return encoded.getvalue(), mime_type
+
+
+def read_payload(audio):
+    """
+    Returns the audio to send to the backend with its MIME type, encoded as set in settings.TRANSCRIPTION.
+    """
+    config = settings.TRANSCRIPTION
+    with audio.audio_file.open('rb') as audio_file:
+        return encode_payload(audio_file, config.get('AUDIO_FORMAT', 'flac'), config.get('SAMPLE_RATE', 16000))
+
+
+async def request_transcription(backend, payload, mime_type, acquire_key, max_retries, backoff_seconds, on_retry=None):
+    """
+    Sends one clip to the backend with the key acquire_key() returns, retrying failed requests
+    with exponential backoff. Returns the text and the number of attempts it took.
+    """
+    for attempt in range(max_retries + 1):
+        key = await acquire_key()
+        try:
+            return await backend.transcribe(payload, mime_type, key), attempt + 1
+        except Exception as e:
+            if not getattr(e, 'retryable', True) or attempt == max_retries:
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            await asyncio.sleep(backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_interactive_key_pool = None
+
+
+def interactive_key_pool(backend):
+    """
+    The KeyPool of transcribe_audio(), shared by all requests of this process, so the transcribe
+    button keeps to the per-key rate limit of settings.TRANSCRIPTION like the engine does.
+    """
+    global _interactive_key_pool
+    config = settings.TRANSCRIPTION
+    keys = get_api_keys(backend)
+    with _in_flight_lock:
+        if _interactive_key_pool is None or list(_interactive_key_pool.buckets) != keys:
+            _interactive_key_pool = KeyPool(keys, config['REQUESTS_PER_MINUTE'], config['BURST'])
+        return _interactive_key_pool
+
+
+def transcribe_audio(audio):
+    """
+    Transcribes a single clip on request, e.g. for the transcribe button, without storing it on
+    the record. Returns (text, cached). Cached and near-duplicate transcriptions are reused, new
+    ones go to the cache, and concurrent calls for the same clip in this process share one request.
+    """
+    text = fingerprint.cached_transcription(audio)
+    if text:
+        return text, True
+
+    key = audio.content_hash or f'pk:{audio.pk}'
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        return future.result(), True
+
+    try:
+        config = settings.TRANSCRIPTION
+        backend = get_backend()
+        key_pool = interactive_key_pool(backend)
+        payload, mime_type = read_payload(audio)
+        text, _ = asyncio.run(request_transcription(
+            backend, payload, mime_type, key_pool.acquire,
+            config.get('INTERACTIVE_MAX_RETRIES', 1), config['BACKOFF_SECONDS'],
+        ))
+        fingerprint.remember_transcription(audio.content_hash, text)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(text)
+        return text, False
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+
+
+class RunMetrics:
+    """
+    Latency of every transcribed clip and the totals of one engine run.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.failed = 0
+        self.skipped = 0
+        self.cached = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'transcribed': len(latencies),
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'cached': self.cached,
+            'retries': self.retries,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'clips_per_minute': round(len(latencies) / self.elapsed * 60, 2) if self.elapsed else 0,
+            'latency_mean': round(statistics.fmean(latencies), 3) if latencies else None,
+            'latency_p50': round(statistics.median(latencies), 3) if latencies else None,
+            'latency_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+            'latency_max': round(latencies[-1], 3) if latencies else None,
+        }
+
+    def format(self):
+        summary = self.summary()
+        text = (f"{summary['transcribed']} transcribed, {summary['cached']} from cache, "
+                f"{summary['failed']} failed, {summary['skipped']} skipped, "
+                f"{summary['retries']} retries in {summary['elapsed_seconds']:.1f}s "
+                f"({summary['clips_per_minute']:.1f} clips/min)")
+        if summary['transcribed']:
+            text += (f", latency mean {summary['latency_mean']:.2f}s, p50 {summary['latency_p50']:.2f}s, "
+                     f"p95 {summary['latency_p95']:.2f}s, max {summary['latency_max']:.2f}s")
+        return text
+
+
+class TranscriptionEngine:
+    """
+    Transcribes untranscribed clips with several requests in flight at once.
+
+    Every clip is leased before it is sent, so engines running in parallel (overlapping
+    cron runs, the management command) never transcribe the same clip. Each API key has
+    its own token bucket, and failed requests are retried with exponential backoff.
+    Arguments left as None come from settings.TRANSCRIPTION.
+    """
+
+    def __init__(self, backend=None, keys=None, concurrency=None, requests_per_minute=None, burst=None,
+                 max_retries=None, backoff_seconds=None, lease_seconds=None, log=None):
+        config = settings.TRANSCRIPTION
+        self.backend = backend or get_backend()
+        self.keys = get_api_keys(self.backend, keys)
+        self.concurrency = concurrency or config['CONCURRENCY']
+        self.requests_per_minute = config['REQUESTS_PER_MINUTE'] if requests_per_minute is None else requests_per_minute
+        self.burst = burst or config['BURST']
+        self.max_retries = config['MAX_RETRIES'] if max_retries is None else max_retries
+        self.backoff_seconds = config['BACKOFF_SECONDS'] if backoff_seconds is None else backoff_seconds
+        self.lease_seconds = lease_seconds or config['LEASE_SECONDS']
+        self.worker = f'{worker_name()}:{uuid.uuid4().hex[:8]}'
+        self.log = log or (lambda message: None)
+
+    def run(self, limit=None, max_seconds=None):
+        """
+        Transcribes up to `limit` clips, stopping early when the queue is empty or after
+        `max_seconds`. Returns the RunMetrics of the run.
+        """
+        return asyncio.run(self.run_async(limit, max_seconds))
+
+    async def run_async(self, limit=None, max_seconds=None):
+        self.metrics = RunMetrics()
+        self._key_pool = KeyPool(self.keys, self.requests_per_minute, self.burst)
+        self._remaining = limit
+        self._deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        await asyncio.gather(*(self._work() for _ in range(self.concurrency)))
+        self.metrics.finished = time.monotonic()
+        return self.metrics
+
+    async def _work(self):
+        while True:
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                return
+            if self._remaining is not None:
+                if self._remaining <= 0:
+                    return
+                self._remaining -= 1
+            audio = await sync_to_async(claim_audio)(self.worker, self.lease_seconds)
+            if audio is None:
+                return
+            await self._transcribe(audio)
+
+    async def _transcribe(self, audio):
+        started = time.monotonic()
+        # The same audio, or a near duplicate of it, may have been transcribed before
+        text = await sync_to_async(fingerprint.cached_transcription)(audio)
+        if text:
+            if await sync_to_async(save_transcription)(audio.pk, self.worker, text, cache=False):
+                self.metrics.cached += 1
+                self.log(f'  - {audio.file_name}: reused a cached transcription')
+            else:
+                self.metrics.skipped += 1
+            return
+
+        def count_retry(error):
+            self.metrics.retries += 1
+
+        try:
+            payload, mime_type = await sync_to_async(read_payload)(audio)
+            text, attempts = await request_transcription(
+                self.backend, payload, mime_type, self._key_pool.acquire,
+                self.max_retries, self.backoff_seconds, on_retry=count_retry,
+            )
+        except Exception as e:
+            # The clip keeps its lease until it runs out, so it is retried by a later run
+            self.metrics.failed += 1
+            self.log(f'  - Failed: {audio.file_name}: {e}')
+            return
+
+        if not await sync_to_async(save_transcription)(audio.pk, self.worker, text):
+            self.metrics.skipped += 1
+            self.log(f'  - Skipped: {audio.file_name} was changed while it was being transcribed')
+            return
+        latency = time.monotonic() - started
+        self.metrics.latencies.append(latency)
+        self.log(f'  - {audio.file_name}: {latency:.2f}s, {attempts} attempt(s)')
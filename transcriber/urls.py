@@ -7,8 +7,18 @@ urlpatterns = [
     # Map the root URL to our main_view
     path('', views.main_view, name='main_view'),
     path('upload/', views.upload_audio_view, name='upload_audio'),
+    path('upload-jobs/', views.upload_jobs_view, name='upload_jobs'),
     path('save-transcription/', views.save_transcription_view, name='save_transcription'),
+    path('save-transcriptions/', views.save_transcriptions_view, name='save_transcriptions'),
+    path('annotate/', views.annotate_view, name='annotate'),
+    path('annotate/next/', views.next_clips_view, name='next_clips'),
+    path('annotate/release/', views.release_clips_view, name='release_clips'),
+    path('transcribe-audio/', views.transcribe_audio_view, name='transcribe_audio'),
     path('delete-audio/', views.delete_audio_view, name='delete_audio'),
     path('finish-audio/', views.finish_audio_view, name='finish_audio'),
+    path('audio/<int:audio_id>/', views.audio_view, name='audio'),
+    path('audio/<int:audio_id>/original/', views.original_audio_view, name='original_audio'),
+    path('waveform/<int:audio_id>/', views.waveform_view, name='waveform'),
     path('export/', views.export_dataset_view, name='export_dataset'),
+    path('stats/', views.stats_view, name='stats'),
 ]
\ No newline at end of file
@@ -1,22 +1,108 @@
-from pydub import AudioSegment, silence
-import tempfile
-from django.core.files import File
+import io
+import soundfile
+from django.conf import settings
+from django.core.files.base import ContentFile
+from mutagen.wave import WAVE
+from . import segmenter, fingerprint, quality
+
+# Chunks outside this range are not kept
+MIN_CHUNK_MS = 5000
+MAX_CHUNK_MS = 25000
+
+MIN_SILENCE_LEN = 350
+KEEP_SILENCE = 350
+
+# Frames decoded at a time, about 1.5 s at 44.1 kHz
+BLOCK_FRAMES = 65536
+
+
+def read_wav_info(path):
+    """
+    Reads duration, sample rate and channel count from a WAV header
+    without decoding the audio data.
+    """
+    info = WAVE(path).info
+    return {
+        'duration_ms': int(round(info.length * 1000)),
+        'sample_rate': info.sample_rate,
+        'channels': info.channels,
+    }
 
 
 def split_audio(uploaded_file):
-    audio = AudioSegment.from_file(uploaded_file, format="mp3")
+    """
+    Splits an uploaded recording (WAV, FLAC, OGG or MP3) on silence and yields (ContentFile, audio_info)
+    pairs for every chunk between 5 and 25 seconds long. The chunks are encoded in memory.
+
+    The recording is decoded block by block twice, once to measure its loudness and once to
+    split it, and chunks are yielded as soon as their end is known, so memory use does not
+    grow with the length of the recording.
+
+    With settings.QUALITY['ON_INGEST'], the quality pipeline runs on every chunk too.
+    """
     file_name = uploaded_file.name.split('.')[0]
+    analyzers = quality.get_analyzers() if settings.QUALITY['ON_INGEST'] else []
+    uploaded_file.seek(0)
+
+    with soundfile.SoundFile(uploaded_file) as audio:
+        silence_thresh = segmenter.dbfs_of_blocks(read_blocks(audio)) - 35
+        audio.seek(0)
+        splitter = segmenter.StreamingSplitter(
+            audio.samplerate,
+            audio.channels,
+            min_silence_len=MIN_SILENCE_LEN,
+            silence_thresh=silence_thresh,
+            keep_silence=KEEP_SILENCE,
+            max_chunk_ms=MAX_CHUNK_MS
+        )
+
+        for block in read_blocks(audio):
+            for chunk in splitter.feed(block):
+                yield from _save_chunk(chunk, audio, file_name, analyzers)
+        for chunk in splitter.finish():
+            yield from _save_chunk(chunk, audio, file_name, analyzers)
+
+
+def estimate_split_memory(uploaded_file):
+    """
+    Rough peak memory in bytes that split_audio needs for a recording, from its header.
+    The splitter buffers at most one chunk with its kept silence, which is copied while the
+    buffer grows and again for the chunk and its WAV encoding, and the quality pipeline
+    transforms one chunk at a time.
+    """
+    uploaded_file.seek(0)
+    info = soundfile.info(uploaded_file)
+    uploaded_file.seek(0)
+    buffered_ms = MAX_CHUNK_MS + 2 * KEEP_SILENCE + MIN_SILENCE_LEN
+    buffer_bytes = info.samplerate * buffered_ms // 1000 * info.channels * 2
+    # Each block is also widened to int64 to compute its energy
+    block_bytes = BLOCK_FRAMES * info.channels * 8 * 3
+    memory = 4 * buffer_bytes + block_bytes
+    if settings.QUALITY['ON_INGEST']:
+        # The complex STFT of a chunk, its magnitude and the float32 samples it is computed from
+        stft_frames = info.samplerate * MAX_CHUNK_MS // 1000 // (quality.N_FFT // 4) + 1
+        memory += (quality.N_FFT // 2 + 1) * stft_frames * (8 + 4) + buffer_bytes * 2
+    return memory
+
+
+def read_blocks(audio):
+    return audio.blocks(blocksize=BLOCK_FRAMES, dtype='int16', always_2d=True)
+
 
-    chunks = silence.split_on_silence(
-        audio,
-        min_silence_len=350,
-        silence_thresh=audio.dBFS - 35, 
-        keep_silence=350
-    )
-
-    for index, chunk in enumerate(chunks, start=1):
-        duration_sec = len(chunk) / 1000
-        if 5 <= duration_sec <= 25:
-            tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".wav")
-            chunk.export(tmp_file.name, format="wav")
-            yield File(open(tmp_file.name, "rb"), name=f"{file_name}_{index:04d}.wav")
\ No newline at end of file
+def _save_chunk(chunk, audio, file_name, analyzers):
+    index, start_ms, end_ms, samples = chunk
+    if samples is None:
+        return
+    duration_ms = segmenter.length_ms(samples, audio.samplerate)
+    if MIN_CHUNK_MS <= duration_ms <= MAX_CHUNK_MS:
+        wav = io.BytesIO()
+        soundfile.write(wav, samples, audio.samplerate, subtype='PCM_16', format='WAV')
+        audio_info = {
+            'duration_ms': duration_ms,
+            'sample_rate': audio.samplerate,
+            'channels': audio.channels,
+            **fingerprint.fingerprint_samples(samples, audio.samplerate),
+        }
+        if analyzers:
+            audio_info.update(quality.analyze_samples(samples, audio.samplerate, audio_info['content_hash'], analyzers))
+        yield ContentFile(wav.getvalue(), name=f"{file_name}_{index:04d}.wav"), audio_info
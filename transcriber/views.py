@@ -1,19 +1,32 @@
 # transcriber/views.py
 
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import AudioTranscription, Speaker
+from .models import AudioTranscription, Speaker, UploadJob
 from django.views.decorators.http import require_POST
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.core.files.storage import default_storage
 import json
 import io
-import zipfile
+import os
 import csv 
-from django.db.models import Q
 from django.core.paginator import Paginator
+from django.utils.cache import get_conditional_response
 from django.contrib.auth.decorators import login_required
-from .utils import split_audio
+from . import stats, jobs, transcription, search, pagination, annotations, previews, delivery, waveforms, exports
+from .zipstream import ZipStream, ZIP_DEFLATED, ZIP_STORED
 import datetime
+from urllib.parse import urlencode
 
+PAGE_SIZE = 10
+
+# Statuses of the audios each filter_by choice lists, None for all
+FILTER_STATUSES = {
+    'with_transcription_all': [AudioTranscription.STATUS_DRAFT, AudioTranscription.STATUS_CHECKED],
+    'with_transcription_checked': [AudioTranscription.STATUS_CHECKED],
+    'with_transcription_not_checked': [AudioTranscription.STATUS_DRAFT],
+    'without_transcription': [AudioTranscription.STATUS_UNTRANSCRIBED],
+}
 
 
 @login_required
@@ -21,61 +34,85 @@ def main_view(request):
     """
     Display the main page with filtering, search, pagination, and statistics.
     """
-    total_audios = AudioTranscription.objects.count()
-    with_transcription_count = AudioTranscription.objects.filter(is_checked=True).count()
+    summary = stats.get_summary()
+    total_audios = summary['total']['count']
+    with_transcription_count = summary['by_status'][AudioTranscription.STATUS_CHECKED]['count']
     without_transcription_count = total_audios - with_transcription_count
 
-    total_time = 0
-    for audio in AudioTranscription.objects.all():
-        total_time += audio.duration_seconds
-    
-    with_transcription_time = 0
-    for audio in AudioTranscription.objects.filter(is_checked=True):
-        with_transcription_time += audio.duration_seconds
-
+    total_time = summary['total']['duration_ms'] // 1000
+    with_transcription_time = summary['by_status'][AudioTranscription.STATUS_CHECKED]['duration_ms'] // 1000
     without_transcription_time = total_time - with_transcription_time
 
-
-
-    queryset = AudioTranscription.objects.all().order_by('-created_at')
+    queryset = AudioTranscription.objects.all().order_by('-created_at', '-pk')
     speakers = Speaker.objects.all()
 
     filter_by = request.GET.get('filter_by', 'all')
-    if filter_by == 'with_transcription_all':
-        queryset = queryset.exclude(Q(transcription_text__isnull=True) | Q(transcription_text__exact=''))
-    elif filter_by == 'with_transcription_checked':
-        queryset = queryset.filter(is_checked=True)
-    elif filter_by == 'with_transcription_not_checked':
-        queryset = queryset.exclude(Q(transcription_text__isnull=True) | Q(transcription_text__exact=''))
-        queryset = queryset.filter(is_checked=False)
-    elif filter_by == 'without_transcription':
-        queryset = queryset.filter(Q(transcription_text__isnull=True) | Q(transcription_text__exact=''))
-    
-    
-    speaker_filter = request.GET.get('speaker', 'all')
-    if speaker_filter != 'all' and speaker_filter.isdigit():
-        queryset = queryset.filter(speaker__id=speaker_filter)
+    if filter_by in FILTER_STATUSES:
+        queryset = queryset.filter(status__in=FILTER_STATUSES[filter_by])
 
+    speaker_filter = request.GET.get('speaker', 'all')
+    speaker_id = int(speaker_filter) if speaker_filter != 'all' and speaker_filter.isdigit() else None
+    if speaker_id is not None:
+        queryset = queryset.filter(speaker__id=speaker_id)
+
+    # Set by the quality pipeline
+    noise_filter = request.GET.get('noise', 'all')
+    if noise_filter == 'noisy':
+        queryset = queryset.filter(is_noisy=True)
+    elif noise_filter == 'clean':
+        queryset = queryset.filter(is_noisy=False)
+    elif noise_filter == 'not_analyzed':
+        queryset = queryset.filter(is_noisy__isnull=True)
+
+    # Links keep the filters and replace the position in the list
+    params = request.GET.copy()
+    for name in ('page', 'after', 'before', 'last'):
+        params.pop(name, None)
+    page_url = lambda **position: '?' + urlencode({**params.dict(), **position})
+
+    # Ranked full-text search on SQLite, LIKE on other databases
     search_query = request.GET.get('q', '')
     if search_query:
-        queryset = queryset.filter(
-            Q(transcription_text__icontains=search_query) |
-            Q(audio_file__icontains=search_query) |
-            Q(speaker__name__icontains=search_query) |
-            Q(speaker__code__icontains=search_query)
+        # Search results are ordered by rank, so they are paged by number
+        queryset = search.search(queryset, search_query)
+        paginator = Paginator(queryset, PAGE_SIZE)
+        page_obj = paginator.get_page(request.GET.get('page'))
+        result_audios, exact_count = paginator.count, True
+        page_links = {
+            'number': page_obj.number,
+            'first': page_url(page=1) if page_obj.has_previous() else None,
+            'previous': page_url(page=page_obj.previous_page_number()) if page_obj.has_previous() else None,
+            'next': page_url(page=page_obj.next_page_number()) if page_obj.has_next() else None,
+            'last': page_url(page=paginator.num_pages) if page_obj.has_next() else None,
+        }
+    else:
+        page_obj = pagination.keyset_page(
+            queryset, PAGE_SIZE,
+            after=request.GET.get('after'), before=request.GET.get('before'), last='last' in request.GET,
         )
-
-    paginator = Paginator(queryset, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+        if noise_filter == 'all':
+            # The statistics counters have every status and speaker combination
+            result_audios, exact_count = stats.count(FILTER_STATUSES.get(filter_by), speaker_id), True
+        else:
+            result_audios, exact_count = pagination.limited_count(queryset)
+        page_links = {
+            'first': page_url() if page_obj.has_previous else None,
+            'previous': page_url(before=page_obj.previous_cursor) if page_obj.has_previous else None,
+            'next': page_url(after=page_obj.next_cursor) if page_obj.has_next else None,
+            'last': page_url(last=1) if page_obj.has_next else None,
+        }
+    search.highlight_page(page_obj, search_query)
 
     context = {
         'page_obj': page_obj,
         'speakers': speakers,
         'filter_by': filter_by,
         'speaker_filter': speaker_filter,
+        'noise_filter': noise_filter,
         'q': search_query,
-        'result_audios': queryset.count(),
+        'page_links': page_links,
+        'result_audios': result_audios,
+        'exact_count': exact_count,
         'stats': {
             'total': total_audios,
             'total_time': datetime.timedelta(seconds=total_time),
@@ -89,6 +126,14 @@ def main_view(request):
 
 
 
+@login_required
+def stats_view(request):
+    """
+    Returns the dataset statistics overall, per status and per speaker as JSON.
+    """
+    return JsonResponse(stats.get_summary())
+
+
 @require_POST
 def upload_audio_view(request):
     uploaded_files = request.FILES.getlist('audio_files')
@@ -98,14 +143,26 @@ def upload_audio_view(request):
 
     speaker = get_object_or_404(Speaker, pk=speaker_id)
 
+    # Splitting takes minutes for long recordings, so it is left to the process_uploads worker
     for file in uploaded_files:
-        for chunk_file in split_audio(file):
-            AudioTranscription.objects.create(audio_file=chunk_file, speaker=speaker)
+        jobs.enqueue_upload(file, speaker, request.user)
 
     return redirect('main_view')
 
 
+@login_required
+def upload_jobs_view(request):
+    """
+    Returns the state of the most recent upload jobs, or of the jobs given in ?ids=1,2,3, as JSON.
+    """
+    queryset = UploadJob.objects.select_related('speaker').order_by('-created_at')
+    ids = [job_id for job_id in request.GET.get('ids', '').split(',') if job_id.isdigit()]
+    queryset = queryset.filter(pk__in=ids) if ids else queryset[:20]
+    return JsonResponse({'jobs': [jobs.job_as_dict(job) for job in queryset]})
+
+
 
+@login_required
 @require_POST
 def save_transcription_view(request):
     """
@@ -113,43 +170,253 @@ def save_transcription_view(request):
     """
     try:
         data = json.loads(request.body)
-        audio_id = data.get('audio_id')
-        transcription = data.get('transcription')
+        [edit] = annotations.parse_edits([{**data, 'finish': False}])
+    except (ValueError, TypeError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return save_single_edit(edit, 'Transcription saved!')
+
+
+@login_required
+@require_POST
+def save_transcriptions_view(request):
+    """
+    Saves many transcriptions at once via AJAX, in one transaction. Takes {"edits": [{audio_id,
+    transcription, finish, version}, ...]} and returns the result of every edit; edits made on
+    an older version than the stored one are rejected as conflicts and saved nothing.
+    """
+    try:
+        data = json.loads(request.body)
+        edits = annotations.parse_edits(data.get('edits') if isinstance(data, dict) else None)
+    except (ValueError, annotations.EditError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    results = annotations.apply_edits(edits)
+    saved = all(result['result'] == annotations.RESULT_SAVED for result in results)
+    return JsonResponse({'status': 'success' if saved else 'partial', 'results': results})
+
+
+@login_required
+def annotate_view(request):
+    """
+    The work queue page: shows one clip at a time from the clips leased to the annotator.
+    """
+    return render(request, 'annotate.html', {
+        'speakers': Speaker.objects.all(),
+        'prefetch': settings.ANNOTATION['PREFETCH'],
+        'lease_seconds': settings.ANNOTATION['LEASE_SECONDS'],
+    })
+
+
+@login_required
+@require_POST
+def next_clips_view(request):
+    """
+    Leases the next clips of the work queue to the annotator and returns them as JSON. Takes
+    {"count", "status", "speaker", "release": [audio ids], "exclude": [audio ids]}; the clips in
+    release, usually the ones just saved or skipped, are given back to the queue first, and the
+    ones in exclude, the skipped ones, are not handed out. Clips the annotator still holds count
+    towards `count` and are returned again. Only staff review the draft queue.
+    """
+    try:
+        data = json.loads(request.body)
+        # The clip on screen and the ones loaded ahead of it
+        count = min(max(int(data.get('count', 1)), 0), settings.ANNOTATION['PREFETCH'] + 1)
+        status = data.get('status', AudioTranscription.STATUS_UNTRANSCRIBED)
+        speaker_id = int(data['speaker']) if data.get('speaker') else None
+        release = [int(audio_id) for audio_id in data.get('release', [])]
+        exclude = [int(audio_id) for audio_id in data.get('exclude', [])]
+        if status not in annotations.QUEUE_STATUSES:
+            raise ValueError(f'status must be one of {", ".join(annotations.QUEUE_STATUSES)}.')
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    if status == AudioTranscription.STATUS_DRAFT and not request.user.is_staff:
+        return JsonResponse({'status': 'error', 'message': 'Only staff can review drafts.'}, status=403)
+
+    annotations.release_clips(request.user, release)
+    clips = annotations.claim_clips(request.user, count, status, speaker_id, exclude) if count else []
+    return JsonResponse({'status': 'success', 'clips': [annotations.clip_as_dict(audio) for audio in clips]})
+
+
+@login_required
+@require_POST
+def release_clips_view(request):
+    """
+    Gives the annotator's leases on {"audio_ids": [...]} back to the work queue, e.g. when the page is closed.
+    """
+    try:
+        audio_ids = [int(audio_id) for audio_id in json.loads(request.body).get('audio_ids', [])]
+    except (ValueError, TypeError, AttributeError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'released': annotations.release_clips(request.user, audio_ids)})
+
+
+def save_single_edit(edit, message):
+    """
+    Applies one edit for the save and finish views, which take the same fields as an edit
+    of save_transcriptions_view. An unknown audio is a 404.
+    """
+    [result] = annotations.apply_edits([edit])
+    if result['result'] == annotations.RESULT_NOT_FOUND:
+        raise Http404('No AudioTranscription matches the given query.')
+    if result['result'] == annotations.RESULT_CONFLICT:
+        return JsonResponse({
+            'status': 'error', 'message': 'The transcription was changed by somebody else in the meantime.', **result,
+        }, status=409)
+    return JsonResponse({'status': 'success', 'message': message, 'version': result['version']})
 
-        audio_transcription = get_object_or_404(AudioTranscription, pk=audio_id)
-        audio_transcription.transcription_text = transcription
-        audio_transcription.save()
 
-        return JsonResponse({'status': 'success', 'message': 'Transcription saved!'})
+@login_required
+@require_POST
+def transcribe_audio_view(request):
+    """
+    Transcribes one audio file on the server with the configured backend and returns the text
+    via AJAX, without saving it. The API key never reaches the browser.
+    """
+    try:
+        data = json.loads(request.body)
+        audio_transcription = get_object_or_404(AudioTranscription, pk=data.get('audio_id'))
+        text, cached = transcription.transcribe_audio(audio_transcription)
+        return JsonResponse({'status': 'success', 'transcription': text, 'cached': cached})
+    except transcription.TranscriptionError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=502)
     except Exception as e:
         return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
-    
+
+@login_required
+def audio_view(request, audio_id):
+    """
+    Streams the compressed preview of an audio for the players, with Range and conditional
+    request support. Falls back to the original when the file cannot be encoded.
+    """
+    audio = get_object_or_404(AudioTranscription, pk=audio_id)
+    try:
+        path, key = previews.get_preview(audio)
+    except (RuntimeError, ValueError, OSError):
+        # The browser may still play what soundfile cannot read; a missing file is a 404 there
+        return delivery.serve_file(request, audio.audio_file.path, 'audio/wav')
+    # The preview of the same content never changes, so its key is the ETag
+    return delivery.serve_file(request, path, previews.CONTENT_TYPE, etag=f'"{key}"', cache_control='private, max-age=86400')
+
+
+@login_required
+def original_audio_view(request, audio_id):
+    """
+    Streams the original WAV of an audio, with Range and conditional request support.
+    """
+    audio = get_object_or_404(AudioTranscription, pk=audio_id)
+    return delivery.serve_file(request, audio.audio_file.path, 'audio/wav')
+
+
+@login_required
+def waveform_view(request, audio_id):
+    """
+    Returns the waveform of an audio as JSON, at the level of detail closest to ?peaks= peaks
+    (about one per pixel of the player): {"sample_rate", "frames", "samples_per_peak",
+    "peaks": [min, max, min, max, ...]}, with the values between -128 and 127.
+    """
+    audio = get_object_or_404(AudioTranscription, pk=audio_id)
+    try:
+        peak_count = max(int(request.GET.get('peaks', 600)), 1)
+        waveform = waveforms.get_peaks(audio.audio_file.path)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    except (RuntimeError, OSError):
+        raise Http404('Audio file not found.')
+
+    samples_per_peak, peaks = waveforms.pick_level(waveform, peak_count)
+    # Stored peaks change only with the audio
+    stat = os.stat(waveforms.peaks_path(audio.audio_file.path))
+    etag = f'"{waveforms.WAVEFORM_VERSION}-{stat.st_mtime_ns:x}-{samples_per_peak}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse({
+            'sample_rate': waveform['sample_rate'],
+            'frames': waveform['frames'],
+            'samples_per_peak': samples_per_peak,
+            'peaks': peaks.ravel().tolist(),
+        })
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+@login_required
 def export_dataset_view(request):
     """
-    View to generate and serve the dataset as a zip file using the correct CSV format.
+    View to stream the dataset as a zip file using the correct CSV format.
+    The archive is generated while it is sent, so memory use does not depend on the dataset size.
+    WAV files are stored without compression unless ?compression=deflate is given.
+    ?format=tar sends WebDataset tar shards instead, see export_shard_response.
     """
-    records = AudioTranscription.objects.select_related('speaker').filter(is_checked=True).order_by('created_at')
+    if request.GET.get('format') == 'tar':
+        return export_shard_response(request)
+    audio_compress_type = ZIP_DEFLATED if request.GET.get('compression') == 'deflate' else ZIP_STORED
+    records = AudioTranscription.objects.filter(status=AudioTranscription.STATUS_CHECKED).order_by('created_at').values_list(
+        'audio_file', 'transcription_text', 'speaker__code'
+    )
+
     string_buffer = io.StringIO()
-    
     csv_writer = csv.writer(string_buffer, delimiter='|', quoting=csv.QUOTE_MINIMAL)
 
-    for record in records:
-        transcription = record.transcription_text or ''
-        csv_writer.writerow([record.file_name, transcription, record.speaker.code])
+    audio_paths = []
+    for audio_file, transcription, speaker_code in records:
+        path = default_storage.path(audio_file)
+        if not os.path.exists(path):
+            # An error can no longer be reported once streaming has started, so skip missing files up front
+            continue
+        file_name = os.path.basename(audio_file)
+        csv_writer.writerow([file_name, transcription or '', speaker_code])
+        audio_paths.append((file_name, path))
+
+    def stream():
+        archive = ZipStream()
+        yield from archive.write_bytes('dataset/metadata.csv', string_buffer.getvalue().encode('utf-8'))
+        for file_name, path in audio_paths:
+            yield from archive.write_file(f'dataset/wavs/{file_name}', path, audio_compress_type)
+        yield from archive.close()
+
+    response = StreamingHttpResponse(stream(), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="dataset.zip"'
 
-    zip_buffer = io.BytesIO()
+    return response
 
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        zipf.writestr('dataset/metadata.csv', string_buffer.getvalue().encode('utf-8'))
-        
-        for record in records:
-            zipf.write(record.audio_file.path, arcname=f'dataset/wavs/{record.file_name}')
+def export_shard_response(request):
+    """
+    Streams shard ?shard=N (from 0) of the dataset as a WebDataset tar archive, the same
+    shard as dataset-N.tar of export_dataset.py, with the X-Shard-Count header giving the
+    number of shards. The clips can be converted with ?audio_format=flac, ?sample_rate= and
+    ?normalize=1. Converted clips come from the export cache when an earlier export made them;
+    whole exports are faster with export_dataset.py, which converts over several processes.
+    """
+    try:
+        shard = int(request.GET.get('shard', 0))
+        conversion = exports.Conversion(
+            request.GET.get('audio_format', 'wav'),
+            int(request.GET.get('sample_rate') or 0),
+            request.GET.get('normalize') == '1',
+        )
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
 
-    zip_buffer.seek(0)
-    
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = 'attachment; filename="dataset.zip"'
-    
+    samples, _ = exports.checked_samples()
+    shards = list(exports.split_shards(samples)) or [[]]
+    if not 0 <= shard < len(shards):
+        raise Http404('No such shard.')
+    samples = shards[shard]
+
+    def converted():
+        for sample in samples:
+            try:
+                audio_path, _ = conversion.convert(sample['path'], sample['content_hash'])
+            except (RuntimeError, ValueError, OSError):
+                # An error can no longer be reported once streaming has started
+                continue
+            yield sample, audio_path
+
+    response = StreamingHttpResponse(exports.tar_stream(converted(), conversion.audio_format),
+                                     content_type='application/x-tar')
+    response['Content-Disposition'] = f'attachment; filename="dataset-{shard:06d}.tar"'
+    response['X-Shard-Count'] = str(len(shards))
     return response
 
 @require_POST
@@ -173,6 +440,7 @@ def delete_audio_view(request):
         return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
 
 
+@login_required
 @require_POST
 def finish_audio_view(request):
     """
@@ -180,15 +448,7 @@ def finish_audio_view(request):
     """
     try:
         data = json.loads(request.body)
-        audio_id = data.get('audio_id')
-        transcription = data.get('transcription')
-        
-        audio_transcription = get_object_or_404(AudioTranscription, pk=audio_id)
-        audio_transcription.is_checked = True
-        audio_transcription.transcription_text = transcription
-        audio_transcription.save()
-
-        return JsonResponse({'status': 'success', 'message': 'Audio marked as finished.'})
-    
-    except Exception as e:
-        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
\ No newline at end of file
+        [edit] = annotations.parse_edits([{**data, 'finish': True}])
+    except (ValueError, TypeError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return save_single_edit(edit, 'Audio marked as finished.')
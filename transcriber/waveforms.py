@@ -0,0 +1,132 @@
+# transcriber/waveforms.py
+
+import os
+import tempfile
+import numpy as np
+import soundfile
+from django.conf import settings
+
+# Stored in the peaks files, raise when compute_peaks changes so they are computed again
+WAVEFORM_VERSION = 1
+# The peaks of wavs/x.wav are kept in wavs/x.wav.peaks.npz
+SUFFIX = '.peaks.npz'
+
+
+def peaks_path(audio_path):
+    return audio_path + SUFFIX
+
+
+def compute_peaks(samples, sample_rate):
+    """
+    Computes the waveform of a clip from its int16 samples of shape (frames, channels), as the
+    minimum and maximum of the mono signal over every WAVEFORMS['SAMPLES_PER_PEAK'] samples,
+    scaled to int8. Each of the WAVEFORMS['LEVELS'] levels halves the resolution of the one
+    before, so a player of any width can get about one peak per pixel.
+    Returns {'sample_rate', 'frames', 'levels': {samples per peak: (peaks, 2) int8 array}}.
+    """
+    mono = np.asarray(samples, dtype=np.float64)
+    if mono.ndim == 2:
+        mono = mono.mean(axis=1)
+    samples_per_peak = settings.WAVEFORMS['SAMPLES_PER_PEAK']
+    count = -(-len(mono) // samples_per_peak)
+    padded = np.zeros(count * samples_per_peak)
+    padded[:len(mono)] = mono
+    if len(mono):
+        # The last peak only covers the end of the clip
+        padded[len(mono):] = mono[-1]
+    frames = padded.reshape(count, samples_per_peak)
+    low, high = frames.min(axis=1), frames.max(axis=1)
+
+    levels = {}
+    for _ in range(settings.WAVEFORMS['LEVELS']):
+        levels[samples_per_peak] = np.stack([low, high], axis=1) // 256
+        if len(low) <= 1:
+            break
+        if len(low) % 2:
+            low, high = np.append(low, low[-1]), np.append(high, high[-1])
+        low = low.reshape(-1, 2).min(axis=1)
+        high = high.reshape(-1, 2).max(axis=1)
+        samples_per_peak *= 2
+    return {
+        'sample_rate': sample_rate,
+        'frames': len(mono),
+        'levels': {level: peaks.astype(np.int8) for level, peaks in levels.items()},
+    }
+
+
+def compute_file_peaks(file):
+    """
+    compute_peaks of an audio file, given as a path or a file object.
+    """
+    samples, sample_rate = soundfile.read(file, dtype='int16', always_2d=True)
+    return compute_peaks(samples, sample_rate)
+
+
+def save_peaks(audio_path, waveform):
+    """
+    Writes the peaks next to the audio. Written to a temporary file and renamed, so a request
+    at the same time never reads half a file.
+    """
+    path = peaks_path(audio_path)
+    arrays = {f'level_{level}': peaks for level, peaks in waveform['levels'].items()}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=WAVEFORM_VERSION, sample_rate=waveform['sample_rate'],
+                     frames=waveform['frames'], **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_peaks(audio_path):
+    """
+    Returns the stored peaks of an audio, or None when there are none, they are older than
+    the audio or were computed by another version.
+    """
+    path = peaks_path(audio_path)
+    try:
+        if os.stat(path).st_mtime_ns < os.stat(audio_path).st_mtime_ns:
+            return None
+        with np.load(path) as stored:
+            if int(stored['version']) != WAVEFORM_VERSION:
+                return None
+            return {
+                'sample_rate': int(stored['sample_rate']),
+                'frames': int(stored['frames']),
+                'levels': {int(name[len('level_'):]): stored[name] for name in stored.files if name.startswith('level_')},
+            }
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_peaks(audio_path):
+    """
+    Returns the peaks of an audio, computed and stored the first time they are asked for
+    when the upload worker did not store them already.
+    """
+    waveform = load_peaks(audio_path)
+    if waveform is None:
+        waveform = compute_file_peaks(audio_path)
+        save_peaks(audio_path, waveform)
+    return waveform
+
+
+def delete_peaks(audio_path):
+    try:
+        os.remove(peaks_path(audio_path))
+    except FileNotFoundError:
+        pass
+
+
+def pick_level(waveform, peak_count):
+    """
+    Returns (samples per peak, peaks) of the coarsest level that still has `peak_count` peaks,
+    or of the finest one when none has that many.
+    """
+    levels = sorted(waveform['levels'].items())
+    for samples_per_peak, peaks in reversed(levels):
+        if len(peaks) >= peak_count:
+            return samples_per_peak, peaks
+    return levels[0]
@@ -0,0 +1,227 @@
+# transcriber/zipstream.py
+
+import os
+import struct
+import time
+import zlib
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+CHUNK_SIZE = 64 * 1024
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_COUNT_LIMIT = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+_END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+_END_OF_CENTRAL_DIR64 = struct.Struct('<IQHHIIQQQQ')
+_END_OF_CENTRAL_DIR64_LOCATOR = struct.Struct('<IIQI')
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_MADE_BY_UNIX = 3 << 8
+_FILE_ATTRIBUTES = 0o100644 << 16
+
+
+def _dos_date_time(timestamp):
+    year, month, day, hour, minute, second = time.localtime(timestamp)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
+
+
+def compress_file(path, compress_type=ZIP_DEFLATED, compresslevel=6):
+    """
+    Reads and compresses a file for ZipStream.write_compressed(). zlib releases the GIL,
+    so files compressed on several threads are compressed in parallel.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15) if compress_type == ZIP_DEFLATED else None
+    chunks = []
+    crc = 0
+    file_size = 0
+    with open(path, 'rb') as f:
+        mtime = os.fstat(f.fileno()).st_mtime
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            chunks.append(compressor.compress(chunk) if compressor is not None else chunk)
+    if compressor is not None:
+        chunks.append(compressor.flush())
+    return {
+        'data': b''.join(chunks),
+        'crc': crc,
+        'file_size': file_size,
+        'compress_type': compress_type,
+        'mtime': mtime,
+    }
+
+
+class ZipStream:
+    """
+    Writes a ZIP archive as a sequence of byte strings, without seeking and
+    without holding member data in memory.
+
+    Every member is followed by a data descriptor, so sizes and checksums are
+    only needed once the member has been written. Members and archives larger
+    than 4 GB are written with Zip64 records.
+    """
+
+    def __init__(self, compresslevel=6, entries=None, offset=0):
+        self.compresslevel = compresslevel
+        self._entries = list(entries or [])
+        self._offset = offset
+
+    @property
+    def offset(self):
+        """
+        Number of bytes produced so far.
+        """
+        return self._offset
+
+    @property
+    def entries(self):
+        """
+        Plain-dict records of the members written so far. Together with offset they
+        can be saved and passed back to the constructor to continue an interrupted archive.
+        """
+        return list(self._entries)
+
+    def _emit(self, data):
+        self._offset += len(data)
+        return data
+
+    def _local_header(self, arcname, compress_type, zip64, mtime):
+        """
+        Returns the local header of a member and the record of it, completed by _data_descriptor.
+        """
+        name = arcname.encode('utf-8')
+        dos_date, dos_time = _dos_date_time(time.time() if mtime is None else mtime)
+        flags = _FLAG_DATA_DESCRIPTOR | _FLAG_UTF8
+        version = _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT
+
+        extra = b''
+        if zip64:
+            # Sizes are not known yet, the data descriptor carries the real values
+            extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        entry = {
+            'arcname': arcname,
+            'flags': flags,
+            'compress_type': compress_type,
+            'dos_date': dos_date,
+            'dos_time': dos_time,
+            'header_offset': self._offset,
+        }
+        header = _LOCAL_HEADER.pack(
+            0x04034b50, version, flags, compress_type, dos_time, dos_date,
+            0, ZIP32_LIMIT if zip64 else 0, ZIP32_LIMIT if zip64 else 0, len(name), len(extra),
+        ) + name + extra
+        return header, entry
+
+    def _data_descriptor(self, entry, zip64, crc, compress_size, file_size):
+        if not zip64 and max(file_size, compress_size) >= ZIP32_LIMIT:
+            raise ValueError(f"{entry['arcname']} is larger than its size hint and needs Zip64")
+        descriptor = _DATA_DESCRIPTOR64 if zip64 else _DATA_DESCRIPTOR
+        self._entries.append({**entry, 'crc': crc, 'compress_size': compress_size, 'file_size': file_size})
+        return descriptor.pack(0x08074b50, crc, compress_size, file_size)
+
+    def write_iter(self, arcname, chunks, compress_type=ZIP_STORED, size_hint=None, mtime=None):
+        """
+        Yields a member built from an iterable of byte strings. Pass size_hint when
+        the uncompressed size is known so small members avoid Zip64 extra fields.
+        """
+        zip64 = size_hint is None or size_hint * 1.05 >= ZIP32_LIMIT or self._offset >= ZIP32_LIMIT
+        header, entry = self._local_header(arcname, compress_type, zip64, mtime)
+        yield self._emit(header)
+
+        compressor = None
+        if compress_type == ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -15)
+
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compress_size += len(chunk)
+                yield self._emit(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            yield self._emit(chunk)
+
+        yield self._emit(self._data_descriptor(entry, zip64, crc, compress_size, file_size))
+
+    def write_compressed(self, arcname, member):
+        """
+        Yields a member compressed beforehand by compress_file(), which can run on other
+        threads while this one writes the archive.
+        """
+        data = member['data']
+        zip64 = max(member['file_size'], len(data)) >= ZIP32_LIMIT or self._offset >= ZIP32_LIMIT
+        header, entry = self._local_header(arcname, member['compress_type'], zip64, member['mtime'])
+        yield self._emit(header)
+        yield self._emit(data)
+        yield self._emit(self._data_descriptor(entry, zip64, member['crc'], len(data), member['file_size']))
+
+    def write_bytes(self, arcname, data, compress_type=ZIP_DEFLATED, mtime=None):
+        yield from self.write_iter(arcname, [data], compress_type, size_hint=len(data), mtime=mtime)
+
+    def write_file(self, arcname, path, compress_type=ZIP_STORED):
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            yield from self.write_iter(
+                arcname, iter(lambda: f.read(CHUNK_SIZE), b''), compress_type,
+                size_hint=stat.st_size, mtime=stat.st_mtime,
+            )
+
+    def close(self):
+        """
+        Yields the central directory and end records. Call once after the last member.
+        """
+        central_dir_offset = self._offset
+        for entry in self._entries:
+            name = entry['arcname'].encode('utf-8')
+            zip64_fields = []
+            file_size, compress_size, header_offset = entry['file_size'], entry['compress_size'], entry['header_offset']
+            if file_size >= ZIP32_LIMIT or compress_size >= ZIP32_LIMIT:
+                zip64_fields += [file_size, compress_size]
+                file_size = compress_size = ZIP32_LIMIT
+            if header_offset >= ZIP32_LIMIT:
+                zip64_fields.append(header_offset)
+                header_offset = ZIP32_LIMIT
+            extra = b''
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = _VERSION_ZIP64 if zip64_fields else _VERSION_DEFAULT
+            yield self._emit(_CENTRAL_HEADER.pack(
+                0x02014b50, _MADE_BY_UNIX | version, version, entry['flags'], entry['compress_type'],
+                entry['dos_time'], entry['dos_date'], entry['crc'], compress_size, file_size,
+                len(name), len(extra), 0, 0, 0, _FILE_ATTRIBUTES, header_offset,
+            ) + name + extra)
+
+        central_dir_size = self._offset - central_dir_offset
+        count = len(self._entries)
+        if count >= ZIP32_COUNT_LIMIT or central_dir_offset >= ZIP32_LIMIT or central_dir_size >= ZIP32_LIMIT:
+            end64_offset = self._offset
+            yield self._emit(_END_OF_CENTRAL_DIR64.pack(
+                0x06064b50, _END_OF_CENTRAL_DIR64.size - 12, _MADE_BY_UNIX | _VERSION_ZIP64, _VERSION_ZIP64,
+                0, 0, count, count, central_dir_size, central_dir_offset,
+            ))
+            yield self._emit(_END_OF_CENTRAL_DIR64_LOCATOR.pack(0x07064b50, 0, end64_offset, 1))
+            count = min(count, ZIP32_COUNT_LIMIT)
+            central_dir_size = min(central_dir_size, ZIP32_LIMIT)
+            central_dir_offset = min(central_dir_offset, ZIP32_LIMIT)
+        yield self._emit(_END_OF_CENTRAL_DIR.pack(
+            0x06054b50, 0, 0, count, count, central_dir_size, central_dir_offset, 0,
+        ))